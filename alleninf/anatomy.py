@@ -0,0 +1,92 @@
+import os
+import numpy as np
+import pandas as pd
+from sklearn.datasets.base import Bunch
+from alleninf.datasets import _get_dataset_dir
+
+_well_masks = {}
+
+
+def _annotations_path(data_dir=None, create_dir=False):
+    return os.path.join(_get_dataset_dir('microarray_expression', data_dir=data_dir,
+                                         create_dir=create_dir), "well_annotations.csv")
+
+
+def get_annotations_file(data_dir=None):
+    """Path of the well annotation index: the one built in the alleninf data
+    directory or, if there is none, the copy shipped with the package."""
+    annotations_file = _annotations_path(data_dir)
+    if not os.path.exists(annotations_file):
+        package_directory = os.path.dirname(os.path.abspath(__file__))
+        packaged_file = os.path.join(package_directory, "data", "well_annotations.csv")
+        if os.path.exists(packaged_file):
+            return packaged_file
+    return annotations_file
+
+
+def load_well_annotations(data_dir=None):
+    """Returns the well annotation index (see
+    alleninf.utils.build_well_annotations): a DataFrame indexed by well id
+    with donor, structure id, acronym and name, ontology paths (of ids and of
+    acronyms) and hemisphere of every well."""
+    annotations_file = get_annotations_file(data_dir)
+    if not os.path.exists(annotations_file):
+        raise IOError("Well annotations %s not found. Build them with "
+                      "alleninf.utils.build_well_annotations." % annotations_file)
+    return pd.read_csv(annotations_file, header=0, index_col=0)
+
+
+def get_well_masks():
+    """Boolean masks over the annotated wells for each hemisphere and for
+    every structure of the ontology (a well belongs to a structure and to
+    all of its ancestors). They are computed once per process."""
+    if "masks" not in _well_masks:
+        annotations = load_well_annotations()
+        n_wells = len(annotations)
+        structures = {}
+        acronyms = {}
+        for position, (id_path, acronym_path) in enumerate(zip(
+                annotations["structure_id_path"], annotations["structure_acronym_path"])):
+            for structure_id, acronym in zip(id_path.strip("/").split("/"),
+                                             acronym_path.strip("/").split("/")):
+                structure_id = int(structure_id)
+                if structure_id not in structures:
+                    structures[structure_id] = np.zeros(n_wells, dtype=bool)
+                    acronyms[acronym.lower()] = structure_id
+                structures[structure_id][position] = True
+        hemispheres = dict((side, np.asarray(annotations["hemisphere"] == side))
+                           for side in ["L", "R"])
+        _well_masks["masks"] = Bunch(well_ids=np.asarray(annotations.index),
+                                     structures=structures,
+                                     acronyms=acronyms,
+                                     hemispheres=hemispheres)
+    return _well_masks["masks"]
+
+
+def _structure_mask(masks, term):
+    if term.isdigit() and int(term) in masks.structures:
+        return masks.structures[int(term)]
+    if term.lower() in masks.acronyms:
+        return masks.structures[masks.acronyms[term.lower()]]
+    raise Exception("Unknown structure %s (use ontology ids or acronyms)" % term)
+
+
+def select_wells(selection):
+    """Returns the ids of the wells matching a selection: comma separated
+    structure acronyms or ontology ids (wells in any of them, by default all
+    wells), left or right (wells in that hemisphere) and terms prefixed with
+    - (wells excluded), e.g. "Cx,left" or "-CB,-BS"."""
+    masks = get_well_masks()
+    included = None
+    selected = np.ones(len(masks.well_ids), dtype=bool)
+    for term in [term.strip() for term in selection.split(",") if term.strip()]:
+        if term.lower() in ("left", "right"):
+            selected &= masks.hemispheres[term[0].upper()]
+        elif term.startswith("-"):
+            selected &= ~_structure_mask(masks, term[1:])
+        else:
+            mask = _structure_mask(masks, term)
+            included = mask if included is None else (included | mask)
+    if included is not None:
+        selected &= included
+    return masks.well_ids[selected]
@@ -1,13 +1,27 @@
 import json
 import urllib2
 import os
+import hashlib
 from tables import open_file
 import pandas as pd
 import numpy as np
-from alleninf.datasets import fetch_microarray_expression
+from sklearn.datasets.base import Bunch
+from alleninf.datasets import fetch_microarray_expression, _get_dataset_dir
 
 api_url = "http://api.brain-map.org/api/v2/data/query.json"
 
+# versions of the on-disk layouts of the prebuilt gene expression matrices
+# and of the donor partitioned expression store
+GENE_MATRIX_FORMAT_VERSION = 1
+STORE_FORMAT_VERSION = 2
+
+# storage types of donor partitions; integer partitions hold per probe scaled
+# codes with the lowest code reserved for missing values
+STORE_DTYPES = ("float32", "float16", "int16", "int8")
+
+_gene_matrix_cache = {}
+_probe_quality_cache = {}
+
 
 def get_probes_from_genes(gene_names):
     if not isinstance(gene_names, list):
@@ -50,39 +64,331 @@ def get_expression_values_from_probe_ids_restapi(probe_ids):
         ','.join(probe_ids))
     data = json.load(urllib2.urlopen(api_url + api_query))
 
-    expression_values = [[float(expression_value) for expression_value in data[
-        "msg"]["probes"][i]["expression_level"]] for i in range(len(probe_ids))]
+    expression_values = [[float(expression_value) for expression_value in probe[
+        "expression_level"]] for probe in data["msg"]["probes"]]
+    row_probe_ids = [int(probe["id"]) for probe in data["msg"]["probes"]]
     well_ids = [sample["sample"]["well"] for sample in data["msg"]["samples"]]
     donor_names = [sample["donor"]["name"]
                    for sample in data["msg"]["samples"]]
     well_coordinates = [sample["sample"]["mri"]
                         for sample in data["msg"]["samples"]]
 
-    return expression_values, well_ids, donor_names
-
+    return expression_values, well_ids, donor_names, row_probe_ids
 
-def get_expression_values_from_probe_ids_hdf(probe_ids):
-    files = fetch_microarray_expression()
-    hdf_file = files.microarray_expression
 
-    h_handle = open_file(hdf_file, "r")
-    donors = [g._v_name for g in list(h_handle.walkGroups("/"))[1:]]
-    h_handle.close()
-
-    probe_ids = ["'%s'" % probe_id for probe_id in probe_ids]
-    where_query = "index in [%s]" % (",".join(probe_ids))
+def get_expression_values_from_probe_ids_hdf(probe_ids, donors=None, wells=None):
+    """Returns expression values (one row per probe), well ids, donor names
+    and the probe id of every row. Rows follow the order of probe_ids;
+    probes missing from the store are left out."""
+    where_query = "index in [%s]" % (",".join("'%s'" % probe_id for probe_id in probe_ids))
 
     expression_values = []
     well_ids = []
     donor_names = []
-    for donor in donors:
-        df = pd.read_hdf(hdf_file, donor, where=where_query, close=True)
+    row_probe_ids = None
+    for donor, df in read_donor_expression(donors=donors, where=where_query, wells=wells):
+        if row_probe_ids is None:
+            # the store returns rows in its own order
+            row_probe_ids = [probe_id for probe_id in probe_ids if probe_id in df.index]
+        df = df.loc[row_probe_ids]
         well_ids += [int(col[len("well_id_"):]) for col in df.columns]
         donor_names += [donor, ] * len(df.columns)
         expression_values.append(np.array(df))
 
     expression_values = list(np.concatenate(expression_values, axis=1))
-    return expression_values, well_ids, donor_names
+    return expression_values, well_ids, donor_names, row_probe_ids
+
+
+def get_store_dir(data_dir=None):
+    """Directory of the donor partitioned expression store."""
+    return os.path.join(_get_dataset_dir('microarray_expression', data_dir=data_dir,
+                                         create_dir=False), "store")
+
+
+def load_store_manifest(data_dir=None):
+    """Returns the manifest of the donor partitioned expression store or None
+    if there is no such store."""
+    manifest_file = os.path.join(get_store_dir(data_dir), "manifest.json")
+    if not os.path.exists(manifest_file):
+        return None
+    with open(manifest_file) as f:
+        manifest = json.load(f)
+    # version 1 stores only differ by lacking quantized partitions
+    if manifest["format_version"] > STORE_FORMAT_VERSION:
+        raise IOError("Expression store %s has format version %s (expected %s)." % (
+            manifest_file, manifest["format_version"], STORE_FORMAT_VERSION))
+    return manifest
+
+
+def store_version(data_dir=None):
+    """String identifying the content of the expression store. It changes
+    whenever a donor partition is added or replaced."""
+    manifest = load_store_manifest(data_dir)
+    if manifest is not None:
+        entries = sorted((donor, entry["md5"]) for donor, entry in manifest["donors"].items())
+        return hashlib.md5(json.dumps(entries)).hexdigest()
+    hdf_file = fetch_microarray_expression(data_dir=data_dir).microarray_expression
+    return "%s-%d-%d" % (os.path.basename(hdf_file), os.path.getsize(hdf_file),
+                         os.path.getmtime(hdf_file))
+
+
+def dequantize(codes, offsets, scales, dtype, out=None):
+    """Converts stored values (rows of probes with the given offsets and
+    scales) back to float32."""
+    if out is None:
+        out = np.empty(codes.shape, dtype=np.float32)
+    out[:] = codes
+    if dtype == "float16" or dtype == "float32":
+        return out
+    out -= np.iinfo(dtype).min + 1
+    out *= scales[:, np.newaxis]
+    out += offsets[:, np.newaxis]
+    out[codes == np.iinfo(dtype).min] = np.nan
+    return out
+
+
+def _partition_layout(store, partition, where=None, columns=None):
+    """Describes the rows (all, or those selected by where) and columns to
+    read from the table of a donor partition."""
+    storer = store.get_storer("expression")
+    if len(storer.values_axes) != 1:
+        raise Exception("%s is not a donor partition" % partition)
+    # an empty selection gives the labels of the rows and columns
+    empty = store.select("expression", start=0, stop=0)
+    if columns is None:
+        positions = np.arange(len(empty.columns))
+    else:
+        positions = empty.columns.get_indexer(columns)
+        if (positions < 0).any():
+            raise Exception("Columns not found in %s" % partition)
+    rows = None
+    n_rows = storer.table.nrows
+    if where is not None:
+        rows = store.select_as_coordinates("expression", where=where).values
+        n_rows = len(rows)
+    return Bunch(table=storer.table, index_field=storer.index_axes[0].cname,
+                 values_field=storer.values_axes[0].cname, index_name=empty.index.name,
+                 columns=empty.columns[positions], positions=positions,
+                 all_columns=columns is None, rows=rows, n_rows=n_rows)
+
+
+def _partition_chunks(store, layout, dtype, chunksize, out=None):
+    """Yields (start, probe ids, float32 values) for every chunk of up to
+    chunksize rows. Values are dequantized into out[start:...] if given,
+    otherwise into a new array per chunk."""
+    if dtype not in STORE_DTYPES:
+        raise Exception("Unknown storage type %s" % dtype)
+    quantization = None
+    if dtype not in ("float32", "float16"):
+        quantization = store.select("quantization")
+    for start in range(0, layout.n_rows, chunksize):
+        if layout.rows is None:
+            chunk = layout.table.read(start, min(start + chunksize, layout.n_rows))
+        else:
+            chunk = layout.table.read_coordinates(layout.rows[start:start + chunksize])
+        codes = chunk[layout.values_field]
+        if not layout.all_columns:
+            codes = codes[:, layout.positions]
+        if out is None:
+            values = np.empty(codes.shape, dtype=np.float32)
+        else:
+            values = out[start:start + len(chunk)]
+        probe_ids = chunk[layout.index_field]
+        if quantization is None:
+            dequantize(codes, None, None, dtype, out=values)
+        else:
+            chunk_quantization = quantization.reindex(probe_ids)
+            dequantize(codes, chunk_quantization["offset"].values.astype(np.float32),
+                       chunk_quantization["scale"].values.astype(np.float32), dtype, out=values)
+        yield start, probe_ids, values
+
+
+def iter_partition(partition, dtype="float32", where=None, chunksize=2000, columns=None):
+    """Yields a donor partition as float32 probes x wells DataFrames of up to
+    chunksize probes, so that a scan of the store only holds one chunk of
+    stored and one of dequantized values in memory."""
+    store = pd.HDFStore(partition, "r")
+    try:
+        layout = _partition_layout(store, partition, where, columns)
+        for _, probe_ids, values in _partition_chunks(store, layout, dtype, chunksize):
+            yield pd.DataFrame(values, index=pd.Index(probe_ids, name=layout.index_name),
+                               columns=layout.columns, copy=False)
+    finally:
+        store.close()
+
+
+def read_partition(partition, dtype="float32", where=None, chunksize=2000, columns=None):
+    """Reads a donor partition as a float32 probes x wells DataFrame. The
+    stored values are read from the table (and, for quantized partitions,
+    dequantized) chunksize probes at a time into the preallocated result, so
+    besides the result only one chunk of stored values is held in memory."""
+    store = pd.HDFStore(partition, "r")
+    try:
+        layout = _partition_layout(store, partition, where, columns)
+        values = np.empty((layout.n_rows, len(layout.positions)), dtype=np.float32)
+        index = np.empty(layout.n_rows, dtype=layout.table.coldtypes[layout.index_field])
+        for start, probe_ids, _ in _partition_chunks(store, layout, dtype, chunksize, out=values):
+            index[start:start + len(probe_ids)] = probe_ids
+    finally:
+        store.close()
+    return pd.DataFrame(values, index=pd.Index(index, name=layout.index_name),
+                        columns=layout.columns)
+
+
+def _well_columns(hdf_file, key, wells):
+    """Names of the columns of the given wells stored under key."""
+    store = pd.HDFStore(hdf_file, "r")
+    try:
+        columns = store.get_storer(key).non_index_axes[0][1]
+    finally:
+        store.close()
+    wanted = set("well_id_%d" % well_id for well_id in wells)
+    return [column for column in columns if column in wanted]
+
+
+def _donor_sources(donors=None, data_dir=None):
+    """Yields (donor, file, key, storage type) of the requested donors (all
+    by default): partitions of the donor partitioned store if it exists,
+    otherwise groups of the single file store (fetched if needed), for which
+    the storage type is None."""
+    manifest = load_store_manifest(data_dir)
+    if manifest is not None:
+        store_dir = get_store_dir(data_dir)
+        for donor in donors or sorted(manifest["donors"]):
+            if donor not in manifest["donors"]:
+                raise Exception("Donor %s is not in the expression store %s" % (donor, store_dir))
+            entry = manifest["donors"][donor]
+            yield (donor, os.path.join(store_dir, entry["file"]), "expression",
+                   entry.get("dtype", "float32"))
+    else:
+        hdf_file = fetch_microarray_expression(data_dir=data_dir).microarray_expression
+        h_handle = open_file(hdf_file, "r")
+        available = [g._v_name for g in list(h_handle.walk_groups("/"))[1:]]
+        h_handle.close()
+        for donor in donors or available:
+            yield donor, hdf_file, donor, None
+
+
+def read_donor_expression(donors=None, where=None, data_dir=None, wells=None):
+    """Yields (donor, probes x wells DataFrame) pairs. If a donor partitioned
+    store exists only the partitions of the requested donors (all by default)
+    are opened, otherwise the single file store is read (and fetched if
+    needed). If wells (ids) are given only their columns are read and donors
+    without any of them are skipped."""
+    for donor, path, key, dtype in _donor_sources(donors, data_dir):
+        columns = None
+        if wells is not None:
+            columns = _well_columns(path, key, wells)
+            if not columns:
+                continue
+        if dtype is None:
+            yield donor, pd.read_hdf(path, key, where=where, columns=columns, close=True)
+        else:
+            yield donor, read_partition(path, dtype, where=where, columns=columns)
+
+
+def iter_donor_expression(donors=None, where=None, data_dir=None, chunksize=2000):
+    """Like read_donor_expression, but yields (donor, probes x wells
+    DataFrame) pairs for chunks of up to chunksize probes, in the order of
+    the store, so that genome-wide scans only hold one chunk in memory.
+    Quantized partitions are read as stored and dequantized chunk by
+    chunk."""
+    for donor, path, key, dtype in _donor_sources(donors, data_dir):
+        if dtype is None:
+            chunks = pd.read_hdf(path, key, where=where, chunksize=chunksize)
+        else:
+            chunks = iter_partition(path, dtype, where=where, chunksize=chunksize)
+        for chunk in chunks:
+            yield donor, chunk
+
+
+def _gene_matrix_path(method, data_dir=None):
+    matrix_dir = _get_dataset_dir('microarray_expression', data_dir=data_dir,
+                                  create_dir=False)
+    return os.path.join(matrix_dir, "gene_expression_%s" % method)
+
+
+def gene_expression_matrix_available(method="average", data_dir=None):
+    base = _gene_matrix_path(method, data_dir)
+    return os.path.exists(base + ".npy") and os.path.exists(base + ".json")
+
+
+def load_gene_expression_matrix(method="average", data_dir=None):
+    """Opens the prebuilt genes x wells matrix for the given probe reduction
+    method (see alleninf.utils.build_gene_expression_matrices). The values are
+    memory mapped, so only the rows of the requested genes are read. A matrix
+    built from another version of the expression store is refused."""
+    base = _gene_matrix_path(method, data_dir)
+    if base not in _gene_matrix_cache:
+        if not gene_expression_matrix_available(method, data_dir):
+            raise IOError("Gene expression matrix %s.npy not found. Build it with "
+                          "alleninf.utils.build_gene_expression_matrices." % base)
+        with open(base + ".json") as f:
+            meta = json.load(f)
+        if meta["format_version"] != GENE_MATRIX_FORMAT_VERSION:
+            raise IOError("Gene expression matrix %s.npy has format version %s (expected %s). "
+                          "Please rebuild it." % (base, meta["format_version"],
+                                                  GENE_MATRIX_FORMAT_VERSION))
+        # a matrix built from an older version of the store would silently
+        # combine stale values with the current store
+        recorded = meta["source"].get("store_version")
+        if recorded is not None and load_store_manifest(data_dir) is not None \
+                and recorded != store_version(data_dir):
+            raise IOError("Gene expression matrix %s.npy was built from another version of "
+                          "the expression store. Please rebuild it with "
+                          "alleninf.utils.build_gene_expression_matrices." % base)
+        _gene_matrix_cache[base] = Bunch(
+            expression=np.load(base + ".npy", mmap_mode="r"),
+            genes=meta["genes"],
+            gene_index={gene: i for i, gene in enumerate(meta["genes"])},
+            well_ids=meta["well_ids"],
+            donor_names=meta["donor_names"],
+            meta=meta)
+    return _gene_matrix_cache[base]
+
+
+def _probe_quality_path(data_dir=None):
+    return os.path.join(_get_dataset_dir('microarray_expression', data_dir=data_dir,
+                                         create_dir=False), "probe_quality.h5")
+
+
+def probe_quality_available(data_dir=None):
+    return os.path.exists(_probe_quality_path(data_dir))
+
+
+def load_probe_quality(data_dir=None):
+    """Returns the precomputed probe quality table (see
+    alleninf.utils.build_probe_quality_table), a DataFrame indexed by probe
+    id. It is read once per process."""
+    path = _probe_quality_path(data_dir)
+    if path not in _probe_quality_cache:
+        if not probe_quality_available(data_dir):
+            raise IOError("Probe quality table %s not found. Build it with "
+                          "alleninf.utils.build_probe_quality_table." % path)
+        _probe_quality_cache[path] = pd.read_hdf(path, "quality")
+    return _probe_quality_cache[path]
+
+
+def get_expression_values_from_genes(gene_names, method="average", data_dir=None, wells=None):
+    """Returns gene level expression values (one row per gene) read from the
+    prebuilt gene expression matrix together with well ids and donor names.
+    If wells (ids) are given only those wells are returned."""
+    if not isinstance(gene_names, list):
+        gene_names = [gene_names]
+    matrix = load_gene_expression_matrix(method, data_dir)
+    missing = [gene for gene in gene_names if gene not in matrix.gene_index]
+    if missing:
+        raise Exception("Could not find %s in the gene expression matrix. Check "
+                        "http://help.brain-map.org/download/attachments/2818165/HBA_ISH_GeneList.pdf?version=1&modificationDate=1348783035873 "
+                        "for list of available genes." % ", ".join(missing))
+    rows = [matrix.gene_index[gene] for gene in gene_names]
+    if wells is None:
+        return (np.asarray(matrix.expression[rows]), list(matrix.well_ids),
+                list(matrix.donor_names))
+    columns = np.flatnonzero(np.in1d(matrix.well_ids, wells))
+    expression_values = np.asarray(matrix.expression[np.ix_(rows, columns)])
+    return (expression_values, list(np.asarray(matrix.well_ids)[columns]),
+            list(np.asarray(matrix.donor_names)[columns]))
 
 
 def get_mni_coordinates_from_wells(well_ids):
@@ -94,6 +400,6 @@ def get_mni_coordinates_from_wells(well_ids):
 
 if __name__ == '__main__':
     probes_dict = get_probes_from_genes("HTR1A")
-    expression_values, well_ids, donor_names = get_expression_values_from_probe_ids_hdf(
+    expression_values, well_ids, donor_names, probe_ids = get_expression_values_from_probe_ids_hdf(
         probes_dict.keys())
     print get_mni_coordinates_from_wells(well_ids)
@@ -0,0 +1,171 @@
+import os
+import re
+import json
+import multiprocessing
+import numpy as np
+import tables
+
+from alleninf.api import load_gene_expression_matrix, get_mni_coordinates_from_wells
+from alleninf.data import get_values_at_locations
+from alleninf.result_cache import file_hash
+
+
+def parse_memory(string):
+    """Parses sizes like 512M, 4G or 1000000 (bytes)."""
+    match = re.match(r"^\s*([\d.]+)\s*([kKmMgGtT]?)[bB]?\s*$", str(string))
+    if not match:
+        raise ValueError("Could not parse memory size %r" % string)
+    exponent = {"": 0, "k": 1, "m": 2, "g": 3, "t": 4}[match.group(2).lower()]
+    return int(float(match.group(1)) * 1024 ** exponent)
+
+
+def tile_size(n_wells, max_memory, n_jobs=1):
+    """Largest square tile (maps x genes) whose inputs, squared genes and
+    partial products fit in max_memory bytes shared by n_jobs workers."""
+    budget = max_memory / float(n_jobs) / 8
+    # 3 * s * n_wells (map values, validity, genes) + s * n_wells (genes^2)
+    # + 4 * s * s (products and result)
+    a, b = 4.0, 4.0 * n_wells
+    size = int((-b + np.sqrt(b * b + 4 * a * budget)) / (2 * a))
+    if size < 1:
+        raise Exception("Memory budget of %d bytes is too small" % max_memory)
+    return size
+
+
+def _sample_map(args):
+    stat_map, mask, radius, reference, coordinates = args
+    return np.array(get_values_at_locations(stat_map, coordinates, radius=radius,
+                                            mask_file=mask, reference_file=reference),
+                    dtype=np.float32)
+
+
+def correlate_tile(map_values, expression):
+    """Pearson correlations between every map (rows of map_values, NaN for
+    wells outside the map's mask) and every gene (rows of expression) using
+    only the wells valid for each map. Computed with three dense matrix
+    products over the wells."""
+    valid = ~np.isnan(map_values)
+    m = np.where(valid, map_values, 0).astype(np.float64)
+    v = valid.astype(np.float64)
+    g = np.asarray(expression, dtype=np.float64)
+    n = v.sum(axis=1)[:, np.newaxis]
+    sm = m.sum(axis=1)[:, np.newaxis]
+    smm = (m * m).sum(axis=1)[:, np.newaxis]
+    sg = v.dot(g.T)
+    sgg = v.dot((g * g).T)
+    smg = m.dot(g.T)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        cov = smg - sm * sg / n
+        return (cov / np.sqrt((smm - sm * sm / n) * (sgg - sg * sg / n))).astype(np.float32)
+
+
+def _tile_worker(args):
+    i, j, map_values, gene_slice, method = args
+    expression = load_gene_expression_matrix(method).expression[gene_slice]
+    return i, j, correlate_tile(map_values, expression)
+
+
+def _open_output(output_file, stat_maps, genes, n_wells, size, settings):
+    """Creates the output file or reopens it to resume an interrupted run.
+    settings (a dictionary) are stored in the file and a run with different
+    settings is not resumed."""
+    if os.path.exists(output_file):
+        h5 = tables.open_file(output_file, "a")
+        attrs = h5.root._v_attrs
+        if list(attrs.maps) != list(stat_maps) or list(attrs.genes) != list(genes):
+            h5.close()
+            raise Exception("%s was computed for different maps or genes" % output_file)
+        changed = [name for name, value in sorted(settings.items())
+                   if getattr(attrs, name, None) != value]
+        if changed:
+            h5.close()
+            raise Exception("%s was computed with a different %s; use another output file"
+                            % (output_file, ", ".join(changed)))
+        print "Resuming from %s" % output_file
+        return h5
+    h5 = tables.open_file(output_file + ".tmp", "w")
+    filters = tables.Filters(complevel=5, complib="blosc")
+    n_maps, n_genes = len(stat_maps), len(genes)
+    h5.create_carray("/", "map_values", tables.Float32Atom(dflt=np.nan),
+                     (n_maps, n_wells), filters=filters)
+    h5.create_carray("/", "map_done", tables.BoolAtom(), (n_maps,))
+    h5.create_carray("/", "correlations", tables.Float32Atom(dflt=np.nan),
+                     (n_maps, n_genes), filters=filters,
+                     chunkshape=(min(max(size, 16), n_maps, 256),
+                                 min(max(size, 16), n_genes, 1024)))
+    h5.create_carray("/", "tile_done", tables.BoolAtom(),
+                     (-(-n_maps // size), -(-n_genes // size)))
+    attrs = h5.root._v_attrs
+    attrs.maps = list(stat_maps)
+    attrs.genes = list(genes)
+    attrs.tile_size = size
+    for name, value in settings.items():
+        setattr(attrs, name, value)
+    h5.close()
+    os.rename(output_file + ".tmp", output_file)
+    return tables.open_file(output_file, "a")
+
+
+def correlation_matrix(stat_maps, output_file, max_memory=2 ** 30, n_jobs=1,
+                       method="average", mask_file=None, radius=4, reference_file=None):
+    """Correlates every map with every gene of the prebuilt gene expression
+    matrix, writing the maps x genes matrix to the 'correlations' array of an
+    HDF5 file.
+
+    Maps are first sampled at the well locations (stored in 'map_values'),
+    on the grid of reference_file if given (see get_values_at_locations).
+    The matrix is then computed in square tiles sized to fit max_memory
+    bytes across n_jobs worker processes, each tile being written as soon as
+    it is done. Completed maps and tiles are recorded in the file, so running
+    again with the same arguments resumes an interrupted computation (the
+    probe reduction method, gene expression matrix, mask, radius and
+    reference have to be the same)."""
+    matrix = load_gene_expression_matrix(method)
+    n_wells = len(matrix.well_ids)
+    settings = {"method": method, "mask_md5": file_hash(mask_file) or "",
+                "radius": float(radius), "reference_md5": file_hash(reference_file) or "",
+                # a rebuilt matrix can hold other values or wells
+                "matrix_version": json.dumps([matrix.meta["created"], matrix.meta["source"]],
+                                             sort_keys=True),
+                "n_wells": n_wells}
+    h5 = _open_output(output_file, stat_maps, matrix.genes, n_wells,
+                      tile_size(n_wells, max_memory, n_jobs), settings)
+    pool = multiprocessing.Pool(n_jobs)
+    try:
+        size = h5.root._v_attrs.tile_size
+        map_done = h5.root.map_done[:]
+        todo = np.where(~map_done)[0]
+        if len(todo):
+            print "Sampling %d maps at %d well locations" % (len(todo), n_wells)
+            coordinates = [tuple(c) for c in
+                           get_mni_coordinates_from_wells(matrix.well_ids)]
+            args = [(stat_maps[i], mask_file, radius, reference_file, coordinates)
+                    for i in todo]
+            for i, values in zip(todo, pool.imap(_sample_map, args)):
+                h5.root.map_values[i] = values
+                h5.root.map_done[i] = True
+            h5.flush()
+
+        # the maps x wells values are small compared to the maps x genes
+        # matrix; keeping them in memory means only this thread uses the file
+        map_values = h5.root.map_values[:]
+        tile_done = h5.root.tile_done[:]
+        tiles = zip(*np.where(~tile_done))
+        print "Computing %d of %d tiles (%d maps x %d genes each)" % (
+            len(tiles), tile_done.size, size, size)
+
+        def tile_args():
+            for i, j in tiles:
+                yield (i, j, map_values[i * size:(i + 1) * size],
+                       slice(j * size, (j + 1) * size), method)
+
+        for n, (i, j, tile) in enumerate(pool.imap_unordered(_tile_worker, tile_args())):
+            h5.root.correlations[i * size:(i + 1) * size, j * size:(j + 1) * size] = tile
+            h5.root.tile_done[i, j] = True
+            h5.flush()
+            print "Finished %d of %d tiles" % (n + 1, len(tiles))
+    finally:
+        pool.close()
+        pool.join()
+        h5.close()
+    return output_file
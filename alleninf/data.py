@@ -5,19 +5,27 @@ import numpy as np
 import nibabel as nb
 import numpy.linalg as npl
 
+from alleninf.api import load_probe_quality
+
+_resampled_masks = {}
+_well_voxels = {}
+
 #code from neurosynth
 def get_sphere(coords, r, vox_dims, dims):
     """ # Return all points within r mm of coordinates. Generates a cube
     and then discards all points outside sphere. Only returns values that
     fall within the dimensions of the image."""
+    sphere = np.round(_sphere_offsets(r, vox_dims) + coords)
+    return sphere[(np.min(sphere, 1) >= 0) & (np.max(np.subtract(sphere, dims), 1) <= -1),:].astype(int)
+
+def _sphere_offsets(r, vox_dims):
     r = float(r)
     xx, yy, zz = [slice(-r / vox_dims[i], r / vox_dims[
-                        i] + 0.01, 1) for i in range(len(coords))]
+                        i] + 0.01, 1) for i in range(len(vox_dims))]
     cube = np.vstack([row.ravel() for row in np.mgrid[xx, yy, zz]])
     sphere = cube[:, np.sum(np.dot(np.diag(
         vox_dims), cube) ** 2, 0) ** .5 <= r]
-    sphere = np.round(sphere.T + coords)
-    return sphere[(np.min(sphere, 1) >= 0) & (np.max(np.subtract(sphere, dims), 1) <= -1),:].astype(int)
+    return sphere.T
 
 def read_donor_data(data_dir):
     donor_ids = [path.split(os.path.sep)[-2] for path in glob(os.path.join(data_dir, "*", "MicroarrayExpression.csv"))]
@@ -36,40 +44,107 @@ def read_donor_data(data_dir):
             main_df = pd.concat([main_df, df], ignore_index=True)
     return main_df
 
-def get_values_at_locations(nifti_file, locations, radius, mask_file=None,  verbose=False):
-    values = []
+def _grid_key(affine, shape):
+    return (np.asarray(affine, dtype=np.float64).tostring(), tuple(shape[:3]))
+
+def resample_to_grid(data, affine, target_affine, target_shape, order=0, cval=0):
+    """Resamples a 3D array defined on the grid of affine onto the grid given
+    by target_affine and target_shape (nearest neighbour for order=0,
+    trilinear for order=1)."""
+    from scipy import ndimage
+    transform = npl.inv(affine).dot(target_affine)
+    return ndimage.affine_transform(np.asarray(data, dtype=np.float64), transform[:3, :3],
+                                    offset=transform[:3, 3], output_shape=tuple(target_shape[:3]),
+                                    order=order, cval=cval)
+
+def get_mask(mask_file, affine, shape, verbose=False):
+    """Boolean mask (non zero and non NaN voxels of mask_file) on the grid
+    given by affine and shape. Masks on a different grid are resampled
+    (nearest neighbour) once per mask file and grid and cached."""
+    mask_file = os.path.abspath(mask_file)
+    key = (mask_file, os.path.getmtime(mask_file), os.path.getsize(mask_file)) + _grid_key(affine, shape)
+    if key not in _resampled_masks:
+        nii = nb.load(mask_file)
+        mask_data = nii.get_data()
+        mask_data = mask_data.reshape(mask_data.shape[:3])
+        mask = np.logical_and(np.logical_not(np.isnan(mask_data)), mask_data > 0)
+        if _grid_key(nii.get_affine(), mask.shape) != _grid_key(affine, shape):
+            if verbose:
+                print "Resampling mask %s onto the grid of the map" % mask_file
+            mask = resample_to_grid(mask, nii.get_affine(), affine, shape, order=0) > 0.5
+        _resampled_masks[key] = mask
+    return _resampled_masks[key]
+
+def get_well_voxels(locations, radius, affine, shape):
+    """Flat indices of the voxels within radius mm of each location on the
+    grid given by affine and shape, together with the position of the
+    location each voxel belongs to. Computed once per grid, radius and set of
+    locations and cached."""
+    locations = np.asarray(locations, dtype=np.float64).reshape(-1, 3)
+    key = _grid_key(affine, shape) + (radius, locations.tostring())
+    if key not in _well_voxels:
+        shape = tuple(shape[:3])
+        centers = nb.affines.apply_affine(npl.inv(affine), locations)
+        # python rounding (half away from zero) as in the per location code
+        centers = np.sign(centers) * np.floor(np.abs(centers) + 0.5)
+        if radius:
+            zooms = np.sqrt((np.asarray(affine)[:3, :3] ** 2).sum(axis=0))
+            offsets = _sphere_offsets(radius, zooms)
+        else:
+            #if radius is not set use a single point
+            offsets = np.zeros((1, 3))
+        voxels = np.round(centers[:, np.newaxis, :] + offsets[np.newaxis, :, :]).reshape(-1, 3).astype(int)
+        owners = np.repeat(np.arange(len(centers)), len(offsets))
+        inside = np.all((voxels >= 0) & (voxels < np.array(shape)), axis=1)
+        # with half voxel offsets rounding can hit a voxel twice
+        n_voxels = int(np.prod(shape))
+        pairs = np.unique(owners[inside] * n_voxels +
+                          np.ravel_multi_index(tuple(voxels[inside].T), shape))
+        _well_voxels[key] = (pairs % n_voxels, pairs // n_voxels)
+    return _well_voxels[key]
+
+def get_values_at_locations(nifti_file, locations, radius, mask_file=None,  verbose=False,
+                            reference_file=None):
+    """Averages the map within a sphere of radius mm around each location
+    (NaN for locations without voxels in the mask).
+
+    A mask on a different grid than the map is resampled onto the grid of
+    the map. If reference_file is given, the map (trilinear) and the mask are
+    resampled onto its grid instead, so that maps of different resolutions
+    share one grid. Resampled masks and the voxels of each location are
+    cached per grid."""
     nii = nb.load(nifti_file)
     data = nii.get_data()
-    
+    data = data.reshape(data.shape[:3])
+    affine = nii.get_affine()
+    if reference_file:
+        reference = nb.load(reference_file)
+        if _grid_key(reference.get_affine(), reference.shape) != _grid_key(affine, data.shape):
+            if verbose:
+                print "Resampling %s onto the grid of %s" % (nifti_file, reference_file)
+            data = resample_to_grid(data, affine, reference.get_affine(), reference.shape,
+                                    order=1, cval=np.nan)
+            affine = reference.get_affine()
+
     if mask_file:
-        mask_data = nb.load(mask_file).get_data()
-        mask = np.logical_and(np.logical_not(np.isnan(mask_data)), mask_data > 0)
+        mask = get_mask(mask_file, affine, data.shape, verbose=verbose)
     else:
         if verbose:
             print "No mask provided - using implicit (not NaN, not zero) mask"
         mask = np.logical_and(np.logical_not(np.isnan(data)), data != 0)
-        
-    for location in locations:
-        coord_data = [round(i) for i in nb.affines.apply_affine(npl.inv(nii.get_affine()), location)]
-        sph_mask = (np.zeros(mask.shape) == True)
-        if radius:
-            sph = tuple(get_sphere(coord_data, vox_dims=nii.get_header().get_zooms(),r=radius, dims=nii.shape).T)
-            sph_mask[sph] = True
-        else:
-            #if radius is not set use a single point
-            sph_mask[coord_data[0], coord_data[1], coord_data[2]] = True
-        
-        roi = np.logical_and(mask, sph_mask)
-        
-        #If the roi is outside of the statmap mask we should treat it as a missing value
-        if np.any(roi):
-            val = data[roi].mean()
-        else:
-            val = np.nan
-        values.append(val)
-    return values
 
-def combine_expression_values(expression_values, method="average"):
+    voxels, owners = get_well_voxels(locations, radius, affine, data.shape)
+    #If the roi is outside of the statmap mask we should treat it as a missing value
+    valid = mask.ravel()[voxels]
+    n_locations = len(np.asarray(locations).reshape(-1, 3))
+    sums = np.bincount(owners[valid], weights=data.ravel()[voxels[valid]],
+                       minlength=n_locations)
+    counts = np.bincount(owners[valid], minlength=n_locations)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        values = sums / counts
+    return list(values)
+
+def combine_expression_values(expression_values, method="average", probe_ids=None):
     if method == "average":
         return list(np.array(expression_values).mean(axis=0))
     elif method == "pca":
@@ -77,8 +152,89 @@ def combine_expression_values(expression_values, method="average"):
         pca = TruncatedSVD(n_components=1)
         pca.fit(np.array(expression_values))
         return list(pca.components_[0,:])
+    elif method == "max_variance":
+        expression_values = np.array(expression_values)
+        return list(expression_values[expression_values.var(axis=1).argmax()])
+    elif method in ("differential_stability", "stability_weighted"):
+        if probe_ids is None:
+            raise Exception("Method %s requires probe ids" % method)
+        if len(probe_ids) != len(expression_values):
+            raise Exception("Got %d probe ids for %d probes" % (len(probe_ids),
+                                                                len(expression_values)))
+        stability = get_probe_stability(probe_ids)
+        return list(reduce_probes_to_genes(expression_values, np.zeros(len(stability), dtype=int),
+                                           1, method=method, stability=stability)[0])
+    else:
+        raise Exception("Uknown method")
+
+def get_probe_stability(probe_ids):
+    """Differential stability of the given probes from the precomputed probe
+    quality table (NaN for probes missing from it)."""
+    return load_probe_quality()["differential_stability"].reindex(list(probe_ids)).values
+
+def reduce_probes_to_genes(expression_values, gene_codes, n_genes, method="average",
+                           stability=None):
+    """Collapses a probes x wells matrix into a genes x wells matrix in one
+    batched pass. gene_codes gives the row of the output each probe belongs
+    to. Methods mirror combine_expression_values: average, pca (first right
+    singular vector, with its sign chosen to agree with the probe average),
+    max_variance (the probe with the highest variance across wells),
+    differential_stability (the probe with the highest differential
+    stability) and stability_weighted (average weighted by the positive part
+    of the differential stability). The last two require the stability of
+    every probe."""
+    expression_values = np.asarray(expression_values, dtype=np.float32)
+    gene_codes = np.asarray(gene_codes, dtype=np.int64)
+    n_probes, n_wells = expression_values.shape
+    counts = np.bincount(gene_codes, minlength=n_genes)
+    reduced = np.empty((n_genes, n_wells), dtype=np.float32)
+    reduced.fill(np.nan)
+    if method in ("differential_stability", "stability_weighted"):
+        if stability is None:
+            raise Exception("Method %s requires the stability of the probes" % method)
+        stability = np.asarray(stability, dtype=np.float64)
+
+    if method in ("average", "stability_weighted"):
+        from scipy import sparse
+        if method == "average":
+            weights = np.ones(n_probes)
+        else:
+            weights = np.clip(np.nan_to_num(stability), 0, None)
+            # genes without a stable probe fall back to the plain average
+            totals = np.bincount(gene_codes, weights=weights, minlength=n_genes)
+            weights[totals[gene_codes] == 0] = 1
+        totals = np.bincount(gene_codes, weights=weights, minlength=n_genes)
+        weights = sparse.csr_matrix((weights / totals[gene_codes],
+                                     (gene_codes, np.arange(n_probes))),
+                                    shape=(n_genes, n_probes))
+        reduced[counts > 0] = weights.dot(expression_values)[counts > 0]
+    elif method in ("max_variance", "differential_stability"):
+        if method == "max_variance":
+            scores = expression_values.var(axis=1)
+        else:
+            scores = np.where(np.isnan(stability), -np.inf, stability)
+        # sort by gene and then by decreasing score - the first probe of
+        # each gene is the one we want
+        order = np.lexsort((-scores, gene_codes))
+        first = np.ones(n_probes, dtype=bool)
+        first[1:] = gene_codes[order][1:] != gene_codes[order][:-1]
+        reduced[gene_codes[order][first]] = expression_values[order][first]
+    elif method == "pca":
+        order = np.argsort(gene_codes, kind="mergesort")
+        probe_counts = counts[gene_codes[order]]
+        # genes with the same number of probes are decomposed together
+        for n in np.unique(probe_counts):
+            probes = order[probe_counts == n]
+            genes = gene_codes[probes][::n]
+            stack = expression_values[probes].reshape(len(genes), n, n_wells)
+            _, _, vt = np.linalg.svd(stack, full_matrices=False)
+            components = vt[:, 0, :]
+            signs = np.sign((components * stack.mean(axis=1)).sum(axis=1))
+            signs[signs == 0] = 1
+            reduced[genes] = components * signs[:, np.newaxis]
     else:
         raise Exception("Uknown method")
+    return reduced
 
 if __name__ == '__main__':
     data_dir='/Users/filo/Dropbox/papers/beyond_blobs/data/donors'
@@ -16,6 +16,8 @@ import time
 import hashlib
 import fnmatch
 import warnings
+import threading
+import json
 import cPickle as pickle
 
 import numpy as np
@@ -35,14 +37,28 @@ def _format_time(t):
 def _md5_sum_file(path):
     """ Calculates the MD5 sum of a file.
     """
+    return _md5_update_from_file(hashlib.md5(), path).hexdigest()
+
+
+def _md5_update_from_file(m, path, size=None, offset=0):
+    """ Feeds size bytes (up to the end of the file by default) of a file,
+    starting at offset, to a hashlib object and returns it.
+    """
     f = open(path, 'rb')
-    m = hashlib.md5()
-    while True:
-        data = f.read(8192)
-        if not data:
-            break
-        m.update(data)
-    return m.hexdigest()
+    remaining = size
+    try:
+        f.seek(offset)
+        while remaining is None or remaining > 0:
+            n = 8192 if remaining is None else min(8192, remaining)
+            data = f.read(n)
+            if not data:
+                break
+            m.update(data)
+            if remaining is not None:
+                remaining -= len(data)
+    finally:
+        f.close()
+    return m
 
 
 def _read_md5_sum_file(path):
@@ -105,7 +121,7 @@ def _chunk_report_(bytes_so_far, total_size, t0):
 
 
 def _chunk_read_(response, local_file, chunk_size=8192, report_hook=None,
-                 initial_size=0, total_size=None, verbose=0):
+                 initial_size=0, total_size=None, verbose=0, hasher=None):
     """Download a file chunk by chunk and show advancement
 
     Parameters
@@ -125,6 +141,10 @@ def _chunk_read_(response, local_file, chunk_size=8192, report_hook=None,
     initial_size: int, optional
         If resuming, indicate the initial size of the file
 
+    hasher: hashlib object, optional
+        If given, it is updated with every chunk written to the file so the
+        checksum does not require reading the file again.
+
     Returns
     -------
     data: string
@@ -154,6 +174,8 @@ def _chunk_read_(response, local_file, chunk_size=8192, report_hook=None,
             break
 
         local_file.write(chunk)
+        if hasher is not None:
+            hasher.update(chunk)
         if report_hook:
             _chunk_report_(bytes_so_far, total_size, t0)
 
@@ -257,8 +279,223 @@ def _uncompress_file(file_, delete_archive=True):
         raise
 
 
+class _HeadRequest(urllib2.Request):
+    def get_method(self):
+        return "HEAD"
+
+
+class _HeadRedirectHandler(urllib2.HTTPRedirectHandler):
+    """Follows redirections of HEAD requests with HEAD requests (urllib2
+    turns them into GET requests, which would start the download)."""
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        new_request = urllib2.HTTPRedirectHandler.redirect_request(
+            self, req, fp, code, msg, headers, newurl)
+        if new_request is None or req.get_method() != "HEAD":
+            return new_request
+        return _HeadRequest(new_request.get_full_url(),
+                            headers=dict(new_request.header_items()),
+                            origin_req_host=new_request.get_origin_req_host(),
+                            unverifiable=True)
+
+
+def _get_ranged_size(url):
+    """Checks with a HEAD request whether the server accepts byte range
+    requests for url.
+
+    Returns
+    -------
+    (size, url): (int or None, string)
+        Total size of the file (None if ranges are not supported or the
+        server rejects the request) and the final url after redirections.
+    """
+    request = _HeadRequest(url, headers={"Range": "bytes=0-0"})
+    try:
+        response = urllib2.build_opener(_HeadRedirectHandler).open(request)
+    except urllib2.HTTPError:
+        # e.g. 405 (no HEAD) or 416: fall back to a single stream
+        return None, url
+    try:
+        headers = response.info()
+        content_range = headers.getheader('Content-Range')
+        if response.getcode() == 206 and content_range:
+            size = content_range.strip().rsplit('/', 1)[-1]
+        elif headers.getheader('Accept-Ranges', '').strip() == 'bytes':
+            size = headers.getheader('Content-Length')
+        else:
+            size = None
+        if size is None or not size.isdigit():
+            return None, response.geturl()
+        return int(size), response.geturl()
+    finally:
+        response.close()
+
+
+def _write_json(path, obj, **kwargs):
+    """Writes obj as JSON to path through a temporary file, which replaces
+    the previous version atomically (on POSIX), so that readers never see a
+    truncated file."""
+    with open(path + ".tmp", "w") as f:
+        json.dump(obj, f, **kwargs)
+    os.rename(path + ".tmp", path)
+
+
+def _write_store_manifest(store_dir, manifest):
+    """Replaces the manifest of a donor partitioned store."""
+    _write_json(os.path.join(store_dir, 'manifest.json'), manifest,
+                indent=1, sort_keys=True)
+
+
+def _segments_state_file(temp_full_name):
+    return temp_full_name + ".segments"
+
+
+def _load_segments_state(temp_full_name, url, total_size, n_segments):
+    """Returns the list of [start, end, downloaded] segments of a partial
+    download, starting from scratch if there is no matching state file."""
+    state_file = _segments_state_file(temp_full_name)
+    if os.path.exists(temp_full_name) and os.path.exists(state_file):
+        try:
+            with open(state_file) as f:
+                state = json.load(f)
+            if state["size"] == total_size:
+                return state["segments"]
+        except (ValueError, KeyError):
+            pass
+    segment_size = -(-total_size // n_segments)
+    segments = [[start, min(start + segment_size, total_size), 0]
+                for start in range(0, total_size, segment_size)]
+    # preallocate the file so that segments can be written at their offsets
+    local_file = open(temp_full_name, "wb")
+    local_file.truncate(total_size)
+    local_file.close()
+    _save_segments_state(temp_full_name, url, total_size, segments)
+    return segments
+
+
+def _save_segments_state(temp_full_name, url, total_size, segments):
+    state_file = _segments_state_file(temp_full_name)
+    _write_json(state_file, {"url": url, "size": total_size,
+                             "segments": segments})
+
+
+def _download_segment(url, temp_full_name, segment, save_state, progress,
+                      errors, chunk_size=2 ** 20):
+    """Downloads the missing part of one segment, recording progress in the
+    segment so that the download can be resumed."""
+    try:
+        start, end, done = segment
+        if start + done >= end:
+            return
+        request = urllib2.Request(
+            url, headers={"Range": "bytes=%d-%d" % (start + done, end - 1)})
+        response = urllib2.urlopen(request)
+        if response.getcode() != 206:
+            raise IOError("Server ignored the range request for %s" % url)
+        local_file = open(temp_full_name, "r+b")
+        try:
+            local_file.seek(start + done)
+            while start + segment[2] < end:
+                chunk = response.read(min(chunk_size, end - start - segment[2]))
+                if not chunk:
+                    raise IOError("Connection closed before the end of the "
+                                  "segment %d-%d" % (start, end))
+                local_file.write(chunk)
+                local_file.flush()
+                save_state(segment, len(chunk))
+                progress.set()
+        finally:
+            local_file.close()
+            response.close()
+    except Exception as e:
+        errors.append(e)
+        progress.set()
+
+
+def _contiguous_size(segments):
+    """Number of bytes downloaded without gaps from the start of the file"""
+    size = 0
+    for start, end, done in segments:
+        size = start + done
+        if start + done < end:
+            break
+    return size
+
+
+def _fetch_file_segmented(url, temp_full_name, total_size, n_segments,
+                          hasher=None, verbose=0, save_interval=1.):
+    """Downloads a file in n_segments byte ranges fetched in parallel.
+
+    Progress of every segment is saved next to the partial file (at most
+    every save_interval seconds, and when the download stops), so an
+    interrupted download only fetches the missing bytes. If a hasher is given
+    it is fed with the downloaded bytes in order while the download runs (they
+    are read back from the freshly written, cached part of the file).
+    """
+    segments = _load_segments_state(temp_full_name, url, total_size, n_segments)
+    initial_size = sum(segment[2] for segment in segments)
+    lock = threading.Lock()
+    progress = threading.Event()
+    errors = []
+    last_save = [time.time()]
+
+    def save_state(segment, n_bytes):
+        with lock:
+            segment[2] += n_bytes
+            if time.time() - last_save[0] >= save_interval:
+                _save_segments_state(temp_full_name, url, total_size, segments)
+                last_save[0] = time.time()
+
+    threads = [threading.Thread(target=_download_segment,
+                                args=(url, temp_full_name, segment,
+                                      save_state, progress, errors))
+               for segment in segments]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    hashed = 0
+    # unbuffered, so that read-ahead never caches parts not written yet
+    hash_file = open(temp_full_name, "rb", 0) if hasher is not None else None
+    t0 = time.time()
+    try:
+        while True:
+            progress.wait(0.5)
+            progress.clear()
+            with lock:
+                contiguous = _contiguous_size(segments)
+                bytes_so_far = sum(segment[2] for segment in segments)
+            while hash_file is not None and hashed < contiguous:
+                data = hash_file.read(min(2 ** 20, contiguous - hashed))
+                hasher.update(data)
+                hashed += len(data)
+            _chunk_report_(bytes_so_far, total_size, t0)
+            if errors or not any(thread.is_alive() for thread in threads):
+                break
+    finally:
+        if hash_file is not None:
+            hash_file.close()
+        with lock:
+            _save_segments_state(temp_full_name, url, total_size, segments)
+    sys.stderr.write('\n')
+    for thread in threads:
+        thread.join()
+    if errors or _contiguous_size(segments) != total_size:
+        _save_segments_state(temp_full_name, url, total_size, segments)
+        if errors:
+            raise errors[0]
+        raise IOError("Download of %s is incomplete" % url)
+    if hasher is not None and hashed < total_size:
+        # the threads may finish after the last contiguous snapshot
+        _md5_update_from_file(hasher, temp_full_name, offset=hashed)
+    if verbose > 0:
+        print "Downloaded %d bytes (%d resumed) in %d segments" % (
+            total_size, initial_size, len(segments))
+    os.remove(_segments_state_file(temp_full_name))
+
+
 def _fetch_file(url, data_dir, resume=True, overwrite=False,
-                md5sum=None, verbose=0):
+                md5sum=None, verbose=0, n_segments=4,
+                segmented_min_size=2 ** 26):
     """Load requested file, downloading it if needed or requested.
 
     Parameters
@@ -282,6 +519,14 @@ def _fetch_file(url, data_dir, resume=True, overwrite=False,
     verbose: int, optional
         Defines the level of verbosity of the output
 
+    n_segments: int, optional
+        Number of byte ranges downloaded in parallel when the server supports
+        range requests. Default: 4
+
+    segmented_min_size: int, optional
+        Files smaller than this (in bytes) are downloaded in a single stream.
+        Default: 64MB
+
     Returns
     -------
     files: string
@@ -290,7 +535,8 @@ def _fetch_file(url, data_dir, resume=True, overwrite=False,
     Notes
     -----
     If, for any reason, the download procedure fails, all downloaded files are
-    removed.
+    removed. The checksum is computed while the file is downloaded and the
+    file is moved to its final location only once it has been verified.
     """
     # Determine data path
     if not os.path.exists(data_dir):
@@ -309,38 +555,63 @@ def _fetch_file(url, data_dir, resume=True, overwrite=False,
         else:
             return full_name
     if os.path.exists(temp_full_name):
-        if overwrite:
+        if overwrite or not resume:
             os.remove(temp_full_name)
+    if os.path.exists(_segments_state_file(temp_full_name)) and \
+            not os.path.exists(temp_full_name):
+        os.remove(_segments_state_file(temp_full_name))
     t0 = time.time()
     local_file = None
     initial_size = 0
+    hasher = hashlib.md5() if md5sum is not None else None
     try:
         # Download data
         print 'Downloading data from %s ...' % url
-        if resume and os.path.exists(temp_full_name):
-            url_opener = ResumeURLOpener()
-            # Download has been interrupted, we try to resume it.
-            local_file_size = os.path.getsize(temp_full_name)
-            # If the file exists, then only download the remainder
-            url_opener.addheader("Range", "bytes=%s-" % (local_file_size))
-            try:
-                data = url_opener.open(url)
-            except urllib2.HTTPError:
-                # There is a problem that may be due to resuming. Switch back
-                # to complete download method
-                return _fetch_file(url, data_dir, resume=False,
-                                   overwrite=False)
-            local_file = open(temp_full_name, "ab")
-            initial_size = local_file_size
+        total_size, ranged_url = None, url
+        if n_segments > 1:
+            total_size, ranged_url = _get_ranged_size(url)
+        if total_size is not None and total_size >= segmented_min_size:
+            _fetch_file_segmented(ranged_url, temp_full_name, total_size,
+                                  n_segments, hasher=hasher, verbose=verbose)
         else:
-            data = urllib2.urlopen(url)
-            local_file = open(temp_full_name, "wb")
-        _chunk_read_(data, local_file, report_hook=True,
-                     initial_size=initial_size, verbose=verbose)
-        # temp file must be closed prior to the move
-        if not local_file.closed:
-            local_file.close()
-        shutil.move(temp_full_name, full_name)
+            if os.path.exists(_segments_state_file(temp_full_name)):
+                # a segmented download cannot be resumed as a single stream
+                os.remove(_segments_state_file(temp_full_name))
+                os.remove(temp_full_name)
+            if resume and os.path.exists(temp_full_name):
+                url_opener = ResumeURLOpener()
+                # Download has been interrupted, we try to resume it.
+                local_file_size = os.path.getsize(temp_full_name)
+                # If the file exists, then only download the remainder
+                url_opener.addheader("Range", "bytes=%s-" % (local_file_size))
+                try:
+                    data = url_opener.open(url)
+                except urllib2.HTTPError:
+                    # There is a problem that may be due to resuming. Switch back
+                    # to complete download method
+                    return _fetch_file(url, data_dir, resume=False,
+                                       overwrite=False, md5sum=md5sum,
+                                       verbose=verbose, n_segments=n_segments,
+                                       segmented_min_size=segmented_min_size)
+                if hasher is not None:
+                    _md5_update_from_file(hasher, temp_full_name)
+                local_file = open(temp_full_name, "ab")
+                initial_size = local_file_size
+            else:
+                data = urllib2.urlopen(url)
+                local_file = open(temp_full_name, "wb")
+            _chunk_read_(data, local_file, report_hook=True,
+                         initial_size=initial_size, verbose=verbose,
+                         hasher=hasher)
+            # temp file must be closed prior to the move
+            if not local_file.closed:
+                local_file.close()
+        if hasher is not None and hasher.hexdigest() != md5sum:
+            os.remove(temp_full_name)
+            raise ValueError("File %s checksum verification has failed."
+                             " Dataset fetching aborted." % full_name)
+        # the file only appears under its final name once it is complete
+        os.rename(temp_full_name, full_name)
         dt = time.time() - t0
         print '...done. (%i seconds, %i min)' % (dt, dt / 60)
     except urllib2.HTTPError, e:
@@ -359,10 +630,6 @@ def _fetch_file(url, data_dir, resume=True, overwrite=False,
         if local_file is not None:
             if not local_file.closed:
                 local_file.close()
-    if md5sum is not None:
-        if (_md5_sum_file(full_name) != md5sum):
-            raise ValueError("File %s checksum verification has failed."
-                             " Dataset fetching aborted." % local_file)
     return full_name
 
 
@@ -561,3 +828,83 @@ def fetch_microarray_expression(data_dir=None, url=None, resume=True,
             resume=resume)
 
     return Bunch(microarray_expression=files_[0])
+
+
+def fetch_microarray_expression_store(url, data_dir=None, donors=None,
+                                      resume=True, verbose=0):
+    """Fetches (or refreshes) the donor partitioned expression store.
+
+    Parameters
+    ----------
+    url: string
+        Base url of the store, containing manifest.json and one partition
+        file per donor.
+
+    data_dir: string, optional
+        Path of the data directory. Used to force data storage in a specified
+        location. Default: None
+
+    donors: list of string, optional
+        Donors to fetch. Default: all donors listed in the remote manifest.
+
+    Returns
+    -------
+    store_dir: string
+        Path of the store directory.
+
+    Notes
+    -----
+    Only partitions missing locally or with a checksum different from the
+    remote manifest are downloaded. Each partition is verified before it
+    replaces the local one, and the local manifest is updated afterwards.
+    When all donors are fetched, local donors no longer in the remote
+    manifest are removed.
+    """
+    if not url.endswith('/'):
+        url += '/'
+    store_dir = os.path.join(_get_dataset_dir('microarray_expression',
+                                              data_dir=data_dir), 'store')
+    incoming_dir = os.path.join(store_dir, 'incoming')
+    remote = json.load(urllib2.urlopen(url + 'manifest.json'))
+
+    manifest_file = os.path.join(store_dir, 'manifest.json')
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            local = json.load(f)
+    else:
+        local = {'format_version': remote['format_version'], 'donors': {}}
+    # older layouts are read by the current code, so stores of different
+    # versions can be mixed as long as neither is newer than this version
+    from alleninf.api import STORE_FORMAT_VERSION
+    for name, manifest in [('Remote', remote), ('Local', local)]:
+        if manifest['format_version'] > STORE_FORMAT_VERSION:
+            raise IOError("%s store has format version %s, this version of alleninf "
+                          "reads up to %s. Please upgrade alleninf."
+                          % (name, manifest['format_version'], STORE_FORMAT_VERSION))
+    local['format_version'] = max(local['format_version'], remote['format_version'])
+
+    for donor in donors or sorted(remote['donors']):
+        entry = remote['donors'][donor]
+        partition = os.path.join(store_dir, entry['file'])
+        if donor in local['donors'] and os.path.exists(partition) and \
+                local['donors'][donor]['md5'] == entry['md5']:
+            continue
+        dl_file = _fetch_file(url + entry['file'], incoming_dir, resume=resume,
+                              md5sum=entry['md5'], verbose=verbose)
+        os.rename(dl_file, partition)
+        local['donors'][donor] = entry
+        _write_store_manifest(store_dir, local)
+
+    if donors is None:
+        dropped = sorted(set(local['donors']) - set(remote['donors']))
+        if dropped:
+            entries = [local['donors'].pop(donor) for donor in dropped]
+            # the manifest stops listing the partitions before they go away
+            _write_store_manifest(store_dir, local)
+            for donor, entry in zip(dropped, entries):
+                if verbose > 0:
+                    print 'Removing donor %s (not in the remote store)' % donor
+                partition = os.path.join(store_dir, entry['file'])
+                if os.path.exists(partition):
+                    os.remove(partition)
+    return store_dir
@@ -0,0 +1,116 @@
+import hashlib
+import numpy as np
+import nibabel as nb
+import scipy.sparse as sp
+from scipy.spatial import cKDTree
+from sklearn.datasets.base import Bunch
+
+from alleninf.api import load_gene_expression_matrix, get_mni_coordinates_from_wells
+from alleninf.data import get_mask
+
+_neighbors_cache = {}
+
+
+def _array_key(array):
+    array = np.ascontiguousarray(array)
+    return hashlib.md5(array.tostring()).hexdigest()
+
+
+def get_voxel_neighbors(affine, mask, well_coordinates, k=8, max_distance=None):
+    """For every voxel of the mask (a boolean 3D array on the grid defined by
+    affine) finds the k nearest wells. Returns a Bunch with the flat indices
+    of the voxels, their neighbours (n_voxels x k indices into
+    well_coordinates) and distances in mm (inf, with index
+    len(well_coordinates), where fewer than k wells are within max_distance).
+    The structure is computed once per grid, mask and wells and cached."""
+    well_coordinates = np.asarray(well_coordinates, dtype=np.float64)
+    key = (_array_key(np.asarray(affine, dtype=np.float64)), mask.shape,
+           _array_key(np.packbits(mask)), _array_key(well_coordinates), k,
+           max_distance)
+    if key not in _neighbors_cache:
+        voxels = np.flatnonzero(mask)
+        ijk = np.column_stack(np.unravel_index(voxels, mask.shape))
+        xyz = nb.affines.apply_affine(affine, ijk)
+        tree = cKDTree(well_coordinates)
+        upper_bound = np.inf if max_distance is None else max_distance
+        distances, neighbors = tree.query(xyz, k=k, distance_upper_bound=upper_bound)
+        _neighbors_cache[key] = Bunch(voxels=voxels,
+                                      neighbors=np.asarray(neighbors).reshape(-1, k),
+                                      distances=np.asarray(distances).reshape(-1, k))
+    return _neighbors_cache[key]
+
+
+def interpolation_weights(neighbors, n_wells, method="idw", power=2, fwhm=6):
+    """Sparse n_voxels x n_wells matrix of interpolation weights.
+
+    method is nearest (value of the closest well), idw (inverse distance
+    weighting with the given power) or gaussian (Gaussian kernel with the
+    given FWHM in mm)."""
+    distances = neighbors.distances
+    if method == "nearest":
+        distances = distances[:, :1]
+        weights = np.ones_like(distances)
+    elif method == "idw":
+        # wells at the centre of a voxel would get an infinite weight
+        weights = 1.0 / np.maximum(distances, 1e-3) ** power
+    elif method == "gaussian":
+        sigma = fwhm / np.sqrt(8 * np.log(2))
+        weights = np.exp(-distances ** 2 / (2 * sigma ** 2))
+    else:
+        raise Exception("Unknown interpolation method %s" % method)
+    found = np.isfinite(distances)
+    rows = np.repeat(np.arange(len(distances)), distances.shape[1]).reshape(distances.shape)
+    return sp.csr_matrix((weights[found], (rows[found], neighbors.neighbors[:, :distances.shape[1]][found])),
+                         shape=(len(distances), n_wells))
+
+
+def expression_maps(gene_names, reference_file, method="idw", probes_reduction_method="average",
+                    mask_file=None, k=8, power=2, fwhm=6, max_distance=None, batch_size=100):
+    """Estimates the expression of each gene at every voxel of the grid of
+    reference_file from the well samples in the prebuilt gene expression
+    matrix. Returns a 4D NIFTI image with one volume per gene.
+
+    Voxels are those of the mask (mask_file, resampled if needed, or, if not
+    given, the non zero and non NaN voxels of reference_file). Each voxel is
+    a weighted average of its k nearest wells (see interpolation_weights)
+    closer than max_distance mm; voxels outside the mask or without wells
+    are NaN. All genes share one neighbour structure and are rendered in
+    batches of batch_size with a sparse matrix product."""
+    if not isinstance(gene_names, list):
+        gene_names = [gene_names]
+    matrix = load_gene_expression_matrix(probes_reduction_method)
+    missing = [gene for gene in gene_names if gene not in matrix.gene_index]
+    if missing:
+        raise Exception("Could not find %s in the gene expression matrix." % ", ".join(missing))
+
+    nii = nb.load(reference_file)
+    if mask_file:
+        mask = get_mask(mask_file, nii.get_affine(), nii.shape)
+    else:
+        data = nii.get_data()
+        mask = np.logical_and(np.logical_not(np.isnan(data)), data != 0)
+    mask = mask.reshape(nii.shape[:3])
+
+    coordinates = get_mni_coordinates_from_wells(matrix.well_ids)
+    neighbors = get_voxel_neighbors(nii.get_affine(), mask, coordinates, k=k,
+                                    max_distance=max_distance)
+    weights = interpolation_weights(neighbors, len(matrix.well_ids), method=method,
+                                    power=power, fwhm=fwhm)
+
+    out = np.empty((mask.size, len(gene_names)), dtype=np.float32)
+    out.fill(np.nan)
+    for start in range(0, len(gene_names), batch_size):
+        genes = gene_names[start:start + batch_size]
+        values = np.asarray(matrix.expression[[matrix.gene_index[gene] for gene in genes]],
+                            dtype=np.float64).T
+        # wells without a value for a gene do not contribute to its estimate
+        valid = ~np.isnan(values)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            estimates = (weights.dot(np.where(valid, values, 0)) /
+                         weights.dot(valid.astype(np.float64)))
+        out[neighbors.voxels, start:start + len(genes)] = estimates
+
+    header = nii.get_header().copy()
+    header.set_data_dtype(np.float32)
+    return nb.Nifti1Image(out.reshape(mask.shape + (len(gene_names),)),
+                          nii.get_affine(), header)
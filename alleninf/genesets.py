@@ -0,0 +1,125 @@
+import numpy as np
+import pandas as pd
+
+from alleninf.api import load_gene_expression_matrix
+
+
+def read_gmt(gmt_file):
+    """Reads gene sets from a GMT file (one set per line: name, description
+    and member genes separated by tabs)."""
+    gene_sets = {}
+    with open(gmt_file) as f:
+        for line in f:
+            fields = line.rstrip("\r\n").split("\t")
+            if len(fields) < 3:
+                continue
+            gene_sets[fields[0]] = [gene for gene in fields[2:] if gene]
+    return gene_sets
+
+
+def correlate_with_genes(nifti_values, expression_values, chunk_size=2000):
+    """Pearson correlation between map values sampled at the wells and every
+    row of a genes x wells expression matrix. Wells with NaN map values are
+    ignored. The matrix is processed in chunks of rows so it can be memory
+    mapped."""
+    nifti_values = np.asarray(nifti_values, dtype=np.float64)
+    valid = ~np.isnan(nifti_values)
+    z = nifti_values[valid] - nifti_values[valid].mean()
+    z /= np.sqrt((z ** 2).sum())
+
+    correlations = np.empty(expression_values.shape[0])
+    for start in range(0, expression_values.shape[0], chunk_size):
+        chunk = np.asarray(expression_values[start:start + chunk_size],
+                           dtype=np.float64)[:, valid]
+        chunk -= chunk.mean(axis=1)[:, np.newaxis]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            correlations[start:start + chunk_size] = chunk.dot(z) / np.sqrt((chunk ** 2).sum(axis=1))
+    return correlations
+
+
+def _random_set_scores(scores, max_size, n_permutations, random_state,
+                       batch_size=500):
+    """Null distribution of the mean score of random gene sets for every set
+    size up to max_size. Each permutation draws max_size genes without
+    replacement; its running means give a random set for every size at once.
+    Returns an array of shape (n_permutations, max_size)."""
+    n_genes = len(scores)
+    null = np.empty((n_permutations, max_size))
+    for start in range(0, n_permutations, batch_size):
+        n = min(batch_size, n_permutations - start)
+        keys = random_state.rand(n, n_genes)
+        idx = np.argpartition(keys, max_size - 1, axis=1)[:, :max_size]
+        null[start:start + n] = np.cumsum(scores[idx], axis=1) / np.arange(1, max_size + 1)
+    return null
+
+
+def _fdr(p_values):
+    """Benjamini-Hochberg adjusted p values."""
+    p_values = np.asarray(p_values)
+    n = len(p_values)
+    order = np.argsort(p_values)
+    adjusted = p_values[order] * n / np.arange(1, n + 1)
+    adjusted = np.minimum.accumulate(adjusted[::-1])[::-1]
+    result = np.empty(n)
+    result[order] = np.minimum(adjusted, 1)
+    return result
+
+
+def gene_set_enrichment(correlations, genes, gene_sets, n_permutations=10000,
+                        min_size=5, max_size=500, random_seed=0):
+    """Scores gene sets using ranks of the map-gene correlations.
+
+    The score of a set is the mean centered rank of its member genes (scaled to
+    [-0.5, 0.5]; positive when the set is enriched in genes correlating
+    positively with the map). Two tailed p values are obtained by comparing it
+    with random sets of the same size. Returns a DataFrame sorted by p value."""
+    correlations = np.asarray(correlations, dtype=np.float64)
+    known = ~np.isnan(correlations)
+    genes = np.asarray(genes)[known]
+    correlations = correlations[known]
+    n_genes = len(genes)
+    ranks = correlations.argsort().argsort()
+    scores = (ranks - (n_genes - 1) / 2.0) / n_genes
+    gene_index = pd.Series(np.arange(n_genes), index=genes)
+
+    names, sizes, set_scores = [], [], []
+    for name, members in gene_sets.items():
+        idx = gene_index.reindex(members).dropna().values.astype(int)
+        idx = np.unique(idx)
+        if len(idx) < min_size or len(idx) > max_size:
+            continue
+        names.append(name)
+        sizes.append(len(idx))
+        set_scores.append(scores[idx].mean())
+    if not names:
+        raise Exception("None of the gene sets has between %d and %d genes present in the data" % (min_size, max_size))
+    sizes = np.array(sizes)
+    set_scores = np.array(set_scores)
+
+    random_state = np.random.RandomState(random_seed)
+    null = np.abs(_random_set_scores(scores, min(sizes.max(), n_genes),
+                                     n_permutations, random_state))
+    null.sort(axis=0)
+    exceeding = np.empty(len(names))
+    for size in np.unique(sizes):
+        selected = sizes == size
+        exceeding[selected] = n_permutations - np.searchsorted(
+            null[:, size - 1], np.abs(set_scores[selected]), side="left")
+    p_values = (exceeding + 1) / (n_permutations + 1.0)
+
+    results = pd.DataFrame({"size": sizes, "score": set_scores,
+                            "p": p_values, "p_fdr": _fdr(p_values)},
+                           index=names, columns=["size", "score", "p", "p_fdr"])
+    results.index.name = "gene_set"
+    return results.iloc[np.argsort(p_values, kind="mergesort")]
+
+
+def map_gene_set_enrichment(nifti_values, well_ids, gene_sets, method="average",
+                            **kwargs):
+    """Correlates map values sampled at the given wells with all genes of the
+    prebuilt gene expression matrix and scores the gene sets."""
+    matrix = load_gene_expression_matrix(method)
+    well_values = pd.Series(np.asarray(nifti_values, dtype=np.float64),
+                            index=well_ids).reindex(matrix.well_ids).values
+    correlations = correlate_with_genes(well_values, matrix.expression)
+    return gene_set_enrichment(correlations, matrix.genes, gene_sets, **kwargs)
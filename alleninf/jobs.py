@@ -0,0 +1,198 @@
+import os
+import multiprocessing
+import traceback
+import numpy as np
+import pandas as pd
+
+from alleninf.api import get_probes_from_genes,\
+    get_expression_values_from_probe_ids, get_mni_coordinates_from_wells,\
+    gene_expression_matrix_available, get_expression_values_from_genes
+from alleninf.data import get_values_at_locations, combine_expression_values
+from alleninf.welltable import WellTable
+from alleninf.analysis import run_inference
+
+manifest_columns = ["stat_map", "gene", "method", "mask", "radius", "reference"]
+# run wide parameters are recorded with every task, so that results of runs
+# with different settings are never mistaken for each other
+task_columns = manifest_columns + ["probes_reduction_method", "n_samples", "n_burnin"]
+result_columns = task_columns + ["n_wells", "estimate", "t", "p", "zero_percentile"]
+_string_sizes = {"stat_map": 512, "gene": 64, "method": 32, "mask": 512, "reference": 512,
+                 "probes_reduction_method": 32}
+
+# populated in the parent process before the pool is started, so that forked
+# workers share the expression values instead of loading them again
+_expression = {}
+_last_map = {}
+
+
+def read_manifest(manifest_file, method="approximate_random", radius=4, reference=""):
+    """Reads a CSV manifest with one task per row. Columns stat_map and gene
+    are required; method, mask, radius and reference (the grid maps are
+    resampled onto, see alleninf.data.get_values_at_locations) are optional
+    and default to the given values."""
+    tasks = pd.read_csv(manifest_file)
+    for column in ["stat_map", "gene"]:
+        if column not in tasks.columns:
+            raise Exception("Manifest %s has no %s column" % (manifest_file, column))
+    defaults = {"method": method, "mask": "", "radius": radius, "reference": reference or ""}
+    for column, default in defaults.items():
+        if column not in tasks.columns:
+            tasks[column] = default
+        tasks[column] = tasks[column].fillna(default)
+    tasks["radius"] = tasks["radius"].astype(float)
+    return tasks[manifest_columns]
+
+
+def _task_key(task):
+    return (str(task["stat_map"]), str(task["gene"]), str(task["method"]),
+            str(task["mask"]), float(task["radius"]), str(task["reference"]),
+            str(task["probes_reduction_method"]),
+            int(task["n_samples"]), int(task["n_burnin"]))
+
+
+def completed_tasks(results_file):
+    """Returns the set of task keys already present in the results table."""
+    if not os.path.exists(results_file):
+        return set()
+    store = pd.HDFStore(results_file, "r")
+    try:
+        if "results" not in store:
+            return set()
+        missing = set(task_columns) - set(store.get_storer("results").data_columns)
+        if missing:
+            raise Exception("Results in %s were written without %s; use a new results file."
+                            % (results_file, ", ".join(sorted(missing))))
+        done = store.select("results", columns=task_columns)
+    finally:
+        store.close()
+    return set(_task_key(row) for _, row in done.iterrows())
+
+
+def load_expression(genes, probes_reduction_method="average"):
+    """Loads expression values for all genes into the module level cache
+    shared with the workers. Returns a dictionary with the error of every
+    gene that could not be loaded."""
+    use_matrix = gene_expression_matrix_available(probes_reduction_method)
+    errors = {}
+    for gene in genes:
+        if (gene, probes_reduction_method) in _expression:
+            continue
+        print "Loading expression values for %s" % gene
+        try:
+            if use_matrix:
+                values, well_ids, donor_names = get_expression_values_from_genes(
+                    gene, method=probes_reduction_method)
+                values = values[0]
+            else:
+                probes_dict = get_probes_from_genes(gene)
+                expression_values, well_ids, donor_names, probe_ids = \
+                    get_expression_values_from_probe_ids(probes_dict.keys())
+                values = combine_expression_values(
+                    expression_values, method=probes_reduction_method,
+                    probe_ids=probe_ids)
+        except Exception as e:
+            errors[gene] = str(e)
+            continue
+        _expression[gene, probes_reduction_method] = (np.asarray(values, dtype=np.float64),
+                                                      well_ids, donor_names)
+    return errors
+
+
+def _map_values(stat_map, mask, radius, reference, well_ids):
+    # tasks are scheduled grouped by map, so remembering the last map avoids
+    # sampling it again for every gene
+    key = (stat_map, mask, radius, reference, tuple(well_ids))
+    if key not in _last_map:
+        _last_map.clear()
+        _last_map[key] = np.array(get_values_at_locations(
+            stat_map, get_mni_coordinates_from_wells(well_ids),
+            mask_file=mask or None, radius=radius,
+            reference_file=reference or None), dtype=np.float64)
+    return _last_map[key]
+
+
+def run_task(task):
+    """Runs a single (map, gene, method) analysis without plotting and returns
+    a dictionary with one row of the results table. The task also gives the
+    probe reduction method and the MCMC settings (see run_jobs)."""
+    values, well_ids, donor_names = _expression[task["gene"], task["probes_reduction_method"]]
+    nifti_values = _map_values(task["stat_map"], task["mask"], task["radius"],
+                               task["reference"], well_ids)
+    data = WellTable.from_wells(nifti_values, values, donor_names, well_ids=well_ids,
+                                expression_label="%s expression" % task["gene"]).dropna()
+
+    result = dict((column, task[column]) for column in task_columns)
+    stats = run_inference(data, task["method"], int(task["n_samples"]),
+                          int(task["n_burnin"]), plot=False)
+    stats["n_wells"] = stats.pop("n")
+    result.update(stats)
+    return result
+
+
+def _run_task_safe(task):
+    try:
+        return task, run_task(task), None
+    except Exception:
+        return task, None, traceback.format_exc()
+
+
+def _append_result(results_file, result):
+    frame = pd.DataFrame([result], columns=result_columns)
+    for column in ["n_wells", "n_samples", "n_burnin"]:
+        frame[column] = frame[column].astype(np.int64)
+    store = pd.HDFStore(results_file, "a")
+    try:
+        store.append("results", frame, format="table", data_columns=task_columns,
+                     min_itemsize=_string_sizes, index=False)
+        store.flush()
+    finally:
+        store.close()
+
+
+def run_jobs(tasks, results_file, n_jobs=None, probes_reduction_method="average",
+             n_samples=2000, n_burnin=500):
+    """Runs all tasks not yet present in results_file over a process pool.
+
+    Every finished task is appended to the results table (HDF5) as soon as it
+    completes, so an interrupted run can be restarted with the same manifest
+    and only the missing tasks are computed. The probe reduction method and
+    the MCMC settings are part of every task, so rerunning a manifest with
+    different settings computes all tasks again. Failed tasks are reported
+    and not recorded, so they are retried on the next run."""
+    tasks = tasks.copy()
+    tasks["probes_reduction_method"] = probes_reduction_method
+    tasks["n_samples"] = n_samples
+    tasks["n_burnin"] = n_burnin
+    done = completed_tasks(results_file)
+    todo = [task for _, task in tasks.iterrows() if _task_key(task) not in done]
+    print "%d of %d tasks already completed, %d to run" % (len(tasks) - len(todo), len(tasks), len(todo))
+    if not todo:
+        return 0
+
+    errors = load_expression(sorted(set(task["gene"] for task in todo)), probes_reduction_method)
+    failed = 0
+    for task in todo:
+        if task["gene"] in errors:
+            failed += 1
+            print "Task %s failed: %s" % (", ".join(str(v) for v in _task_key(task)), errors[task["gene"]])
+    todo = [task for task in todo if task["gene"] not in errors]
+    if not todo:
+        return failed
+    todo.sort(key=_task_key)
+    n_jobs = n_jobs or multiprocessing.cpu_count()
+    # consecutive tasks share the same map, keep them on the same worker
+    chunksize = max(1, len(todo) // (4 * n_jobs))
+    pool = multiprocessing.Pool(n_jobs)
+    try:
+        for i, (task, result, error) in enumerate(pool.imap_unordered(
+                _run_task_safe, todo, chunksize)):
+            if error is not None:
+                failed += 1
+                print "Task %s failed:\n%s" % (", ".join(str(v) for v in _task_key(task)), error)
+            else:
+                _append_result(results_file, result)
+            print "Finished %d of %d tasks" % (i + 1, len(todo))
+    finally:
+        pool.close()
+        pool.join()
+    return failed
@@ -0,0 +1,111 @@
+import os
+import numpy as np
+import pandas as pd
+import nibabel as nb
+import numpy.linalg as npl
+
+from alleninf.data import get_mask, resample_to_grid
+from alleninf.spatial import get_well_index
+
+_well_parcels_cache = {}
+
+
+def _atlas_key(atlas_file):
+    atlas_file = os.path.abspath(atlas_file)
+    return (atlas_file, os.path.getmtime(atlas_file), os.path.getsize(atlas_file))
+
+
+def _load_labels(atlas_file):
+    nii = nb.load(atlas_file)
+    labels = np.asarray(nii.get_data())
+    if labels.ndim == 4 and labels.shape[3] == 1:
+        labels = labels[..., 0]
+    labels = np.nan_to_num(labels).round().astype(np.int64)
+    if labels.min() < 0:
+        raise Exception("Atlas %s contains negative labels" % atlas_file)
+    return nii, labels
+
+
+def get_well_parcels_table(atlas_file):
+    """Returns a pandas Series mapping every well id of the well index (see
+    alleninf.spatial.get_well_index) to the label of the parcel containing it
+    (0 for wells outside of the atlas). The assignment is computed once per
+    atlas file and cached."""
+    key = _atlas_key(atlas_file)
+    if key not in _well_parcels_cache:
+        index = get_well_index()
+        nii, labels = _load_labels(atlas_file)
+        ijk = np.round(nb.affines.apply_affine(npl.inv(nii.get_affine()),
+                                               index.coordinates)).astype(int)
+        inside = np.all((ijk >= 0) & (ijk < np.array(labels.shape)), axis=1)
+        parcels = np.zeros(len(index.well_ids), dtype=np.int64)
+        parcels[inside] = labels[tuple(ijk[inside].T)]
+        _well_parcels_cache[key] = pd.Series(parcels, index=index.well_ids)
+    return _well_parcels_cache[key]
+
+
+def get_well_parcels(atlas_file, well_ids):
+    """Returns an array with the parcel label for each of the wells."""
+    return get_well_parcels_table(atlas_file).loc[list(well_ids)].values
+
+
+def aggregate_by_parcel(values, parcels, n_parcels, groups=None, n_groups=None):
+    """Averages values within each parcel using a single bincount.
+
+    values can be a vector (one value per well/voxel) or a 2D array with one
+    row per gene. NaNs are ignored. If groups (integer codes, e.g. donors) are
+    provided, averages are computed separately for each group. Returns an
+    array of shape ([n_genes,] [n_groups,] n_parcels) with NaN for empty
+    parcels."""
+    values = np.asarray(values, dtype=np.float64)
+    squeeze = values.ndim == 1
+    values = np.atleast_2d(values)
+    n_rows = values.shape[0]
+
+    bins = np.asarray(parcels, dtype=np.int64)
+    n_bins = n_parcels
+    if groups is not None:
+        bins = np.asarray(groups, dtype=np.int64) * n_parcels + bins
+        n_bins = n_groups * n_parcels
+    valid = ~np.isnan(values)
+    idx = (bins[np.newaxis, :] + n_bins * np.arange(n_rows)[:, np.newaxis])
+    sums = np.bincount(idx[valid], weights=values[valid],
+                       minlength=n_rows * n_bins)
+    counts = np.bincount(idx[valid], minlength=n_rows * n_bins)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = sums / counts
+    shape = (n_rows, n_groups, n_parcels) if groups is not None else (n_rows, n_parcels)
+    means = means.reshape(shape)
+    if squeeze:
+        means = means[0]
+    return means
+
+
+def get_parcel_values(nifti_file, atlas_file, mask_file=None, verbose=False):
+    """Averages a statistical map within each parcel of a label image.
+    Returns a vector indexed by parcel label (NaN for parcels not covered by
+    the mask). An atlas or mask on a different grid is resampled (nearest
+    neighbour) onto the grid of the map; the vector still covers every label
+    of the original atlas (wells are assigned on that grid, see
+    get_well_parcels), NaN for parcels lost in the resampling."""
+    nii = nb.load(nifti_file)
+    data = np.asarray(nii.get_data())
+    data = data.reshape(data.shape[:3])
+    affine = nii.get_affine()
+    atlas_nii, labels = _load_labels(atlas_file)
+    n_parcels = labels.max() + 1
+    if labels.shape != data.shape or not np.allclose(atlas_nii.get_affine(), affine):
+        if verbose:
+            print "Resampling atlas %s onto the grid of the map" % atlas_file
+        labels = resample_to_grid(labels, atlas_nii.get_affine(), affine, data.shape,
+                                  order=0).round().astype(np.int64)
+
+    if mask_file:
+        mask = get_mask(mask_file, affine, data.shape, verbose=verbose)
+    else:
+        if verbose:
+            print "No mask provided - using implicit (not NaN, not zero) mask"
+        mask = np.logical_and(np.logical_not(np.isnan(data)), data != 0)
+    mask = np.logical_and(mask, labels > 0)
+
+    return aggregate_by_parcel(data[mask], labels[mask], n_parcels)
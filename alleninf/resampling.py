@@ -0,0 +1,130 @@
+import multiprocessing
+import numpy as np
+from sklearn.datasets.base import Bunch
+
+
+def _segment_moments(x, y, starts, counts):
+    """Means of x and y and the sums of squares and products of their
+    deviations from these means within contiguous segments (donors) starting
+    at the given offsets, along the last axis. Centring keeps the precision
+    when values have a large offset."""
+    mx = np.add.reduceat(x, starts, axis=-1) / counts
+    my = np.add.reduceat(y, starts, axis=-1) / counts
+    dx = x - np.repeat(mx, counts, axis=-1)
+    dy = y - np.repeat(my, counts, axis=-1)
+    return [mx, my] + [np.add.reduceat(v, starts, axis=-1)
+                       for v in (dx * dx, dy * dy, dx * dy)]
+
+
+def _slopes(mx, my, sxx, syy, sxy):
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return sxy / sxx
+
+
+def _pooled_correlations(counts, mx, my, sxx, syy, sxy):
+    """Correlation of the wells of all segments pooled together from the
+    segment moments (along the last axis). Segments with a count of zero
+    are left out."""
+    counts = np.asarray(counts, dtype=np.float64)
+    n = counts.sum(axis=-1)[..., np.newaxis]
+    dx = mx - (counts * mx).sum(axis=-1)[..., np.newaxis] / n
+    dy = my - (counts * my).sum(axis=-1)[..., np.newaxis] / n
+    included = counts > 0
+    pooled = [(np.where(included, s, 0) + counts * d).sum(axis=-1)
+              for s, d in [(sxx, dx * dx), (syy, dy * dy), (sxy, dx * dy)]]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return pooled[2] / np.sqrt(pooled[0] * pooled[1])
+
+
+def _percentile_ci(values, confidence):
+    """Percentile confidence interval of the replicates along the first axis
+    (NaN without replicates)."""
+    if not len(values):
+        return np.full((2, ) + values.shape[1:], np.nan)
+    return np.percentile(values, [50 * (1 - confidence), 50 * (1 + confidence)], axis=0)
+
+
+def _bootstrap_chunk(args):
+    """Evaluates n_replicates within donor bootstrap replicates. Wells are
+    sorted by donor; every replicate is a row of an index matrix drawing each
+    position from the wells of the same donor."""
+    x, y, starts, counts, n_replicates, seed = args
+    random_state = np.random.RandomState(seed)
+    offsets = np.repeat(starts, counts)
+    sizes = np.repeat(counts, counts)
+    idx = offsets + (random_state.rand(n_replicates, len(x)) * sizes).astype(np.intp)
+    moments = _segment_moments(x[idx], y[idx], starts, counts)
+    return _slopes(*moments), _pooled_correlations(counts, *moments)
+
+
+def stability_analysis(table, n_bootstrap=1000, confidence=0.95,
+                       random_seed=0, n_jobs=1, chunk_size=100):
+    """Leave-one-donor-out and within donor bootstrap stability of the
+    approximate random effects slope (average of per donor slopes) and of the
+    fixed effects correlation.
+
+    Bootstrap replicates resample wells with replacement within each donor
+    and are evaluated in chunks (optionally over n_jobs processes, each chunk
+    with its own seed derived from random_seed, so results do not depend on
+    n_jobs). With n_bootstrap=0 only the leave-one-donor-out estimates are
+    computed and the confidence intervals are NaN. Returns a Bunch with the estimates, percentile confidence
+    intervals, leave-one-donor-out estimates and donor influence (change of
+    the estimate when the donor is left out)."""
+    if n_bootstrap < 0:
+        raise Exception("The number of bootstrap replicates can not be negative")
+    order = np.argsort(table.donor_codes, kind="mergesort")
+    x = np.asarray(table.map_values[order], dtype=np.float64)
+    y = np.asarray(table.expression_values[order], dtype=np.float64)
+    codes = table.donor_codes[order]
+    present = np.unique(codes)
+    if len(present) < 2:
+        raise Exception("Stability analysis requires at least two donors")
+    donors = table.donors[present]
+    counts = np.bincount(codes)[present]
+    starts = np.searchsorted(codes, present)
+
+    moments = _segment_moments(x, y, starts, counts)
+    donor_slopes = _slopes(*moments)
+    slope = donor_slopes.mean()
+    correlation = _pooled_correlations(counts, *moments)
+
+    # leaving a donor out removes its slope from the average and its
+    # moments from the pooled ones
+    n_donors = len(present)
+    lodo_slopes = (donor_slopes.sum() - donor_slopes) / (n_donors - 1)
+    lodo_correlations = _pooled_correlations(counts * (1 - np.eye(n_donors, dtype=counts.dtype)),
+                                             *moments)
+
+    seeds = np.random.RandomState(random_seed).randint(
+        np.iinfo(np.int32).max, size=-(-n_bootstrap // chunk_size))
+    chunks = [(x, y, starts, counts,
+               min(chunk_size, n_bootstrap - i * chunk_size), seed)
+              for i, seed in enumerate(seeds)]
+    if not chunks:
+        results = [(np.empty((0, n_donors)), np.empty(0))]
+    elif n_jobs == 1:
+        results = map(_bootstrap_chunk, chunks)
+    else:
+        pool = multiprocessing.Pool(n_jobs)
+        try:
+            results = pool.map(_bootstrap_chunk, chunks)
+        finally:
+            pool.close()
+            pool.join()
+    bootstrap_donor_slopes = np.concatenate([r[0] for r in results])
+    bootstrap_slopes = bootstrap_donor_slopes.mean(axis=1)
+    bootstrap_correlations = np.concatenate([r[1] for r in results])
+
+    return Bunch(donors=list(donors),
+                 slope=slope,
+                 slope_ci=_percentile_ci(bootstrap_slopes, confidence),
+                 correlation=correlation,
+                 correlation_ci=_percentile_ci(bootstrap_correlations, confidence),
+                 donor_slopes=donor_slopes,
+                 donor_slopes_ci=_percentile_ci(bootstrap_donor_slopes, confidence).T,
+                 lodo_slopes=lodo_slopes,
+                 lodo_correlations=lodo_correlations,
+                 slope_influence=lodo_slopes - slope,
+                 correlation_influence=lodo_correlations - correlation,
+                 bootstrap_slopes=bootstrap_slopes,
+                 bootstrap_correlations=bootstrap_correlations)
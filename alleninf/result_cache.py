@@ -0,0 +1,97 @@
+import os
+import json
+import hashlib
+from glob import glob
+
+from alleninf.api import gene_expression_matrix_available, load_gene_expression_matrix
+from alleninf.datasets import _get_dataset_dir, _md5_sum_file, _write_json
+
+# bump when the statistics stored in the cache change meaning
+CACHE_FORMAT_VERSION = 1
+
+_file_hashes = {}
+
+
+def file_hash(path):
+    """MD5 of the content of a file (None for no file). Computed once per
+    path, modification time and size."""
+    if not path:
+        return None
+    path = os.path.abspath(path)
+    key = (path, os.path.getmtime(path), os.path.getsize(path))
+    if key not in _file_hashes:
+        _file_hashes[key] = _md5_sum_file(path)
+    return _file_hashes[key]
+
+
+def expression_version(probes_reduction_method="average", probe_exclusion_keyword=None):
+    """Identifies the expression data an analysis would use: the prebuilt
+    gene expression matrix (which records the version of the expression
+    store it was built from) or the Allen Brain Atlas API."""
+    if not probe_exclusion_keyword and gene_expression_matrix_available(probes_reduction_method):
+        meta = load_gene_expression_matrix(probes_reduction_method).meta
+        return json.dumps([meta["method"], meta["created"], meta["source"]], sort_keys=True)
+    return "api.brain-map.org"
+
+
+class ResultCache(object):
+    """Statistics of finished analyses stored as small JSON files in the
+    result_cache folder of the alleninf data directory. Every access marks
+    an entry as recently used; once the entries take more than max_size
+    bytes the least recently used ones are removed."""
+
+    def __init__(self, cache_dir=None, max_size=100 * 2 ** 20):
+        if cache_dir is None:
+            cache_dir = _get_dataset_dir("result_cache")
+        elif not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, **params):
+        """Key of an analysis described by the given (JSON serializable)
+        parameters."""
+        params["cache_format_version"] = CACHE_FORMAT_VERSION
+        return hashlib.sha1(json.dumps(params, sort_keys=True)).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".json")
+
+    def get(self, key):
+        """Returns the stored result or None."""
+        path = self._path(key)
+        try:
+            with open(path) as f:
+                result = json.load(f)
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return result
+
+    def put(self, key, result):
+        _write_json(self._path(key), result)
+        self.evict()
+
+    def evict(self):
+        """Removes least recently used entries until the cache fits in
+        max_size bytes."""
+        entries = []
+        for path in glob(os.path.join(self.cache_dir, "*.json")):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
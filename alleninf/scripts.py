@@ -1,15 +1,29 @@
 #!/usr/bin/env python
 import argparse
 import os
+import sys
+import json
+import threading
+import Queue
 import numpy as np
-import pandas as pd
 import nibabel as nb
 
 from alleninf.api import get_probes_from_genes,\
-    get_expression_values_from_probe_ids, get_mni_coordinates_from_wells
+    get_expression_values_from_probe_ids, get_mni_coordinates_from_wells,\
+    gene_expression_matrix_available, get_expression_values_from_genes,\
+    load_gene_expression_matrix
 from alleninf.data import get_values_at_locations, combine_expression_values
-from alleninf.analysis import fixed_effects, approximate_random_effects,\
-    bayesian_random_effects
+from alleninf.parcellation import get_well_parcels, get_parcel_values,\
+    aggregate_by_parcel
+from alleninf.jobs import read_manifest, run_jobs
+from alleninf.genesets import read_gmt, map_gene_set_enrichment
+from alleninf.welltable import WellTable
+from alleninf.resampling import stability_analysis
+from alleninf.crossproduct import correlation_matrix, parse_memory
+from alleninf.expression_maps import expression_maps
+from alleninf.result_cache import ResultCache, file_hash, expression_version
+from alleninf.anatomy import select_wells, get_annotations_file
+from alleninf.analysis import run_inference
 
 
 def nifti_file(string):
@@ -35,9 +49,9 @@ def main():
         description="Compare a statistical map with gene expression patterns from Allen Human Brain Atlas.")
     parser.add_argument(
         "stat_map", help="Unthresholded statistical map in the form of a 3D NIFTI file (.nii or .nii.gz) in MNI space.", type=nifti_file)
-    parser.add_argument("gene_name", help="Name of the gene you want to compare your map with. For list of all available genes see: "
+    parser.add_argument("gene_name", help="Name of the gene(s) you want to compare your map with. For list of all available genes see: "
                         "http://help.brain-map.org/download/attachments/2818165/HBA_ISH_GeneList.pdf?version=1&modificationDate=1348783035873.",
-                        type=str)
+                        type=str, nargs="*")
     parser.add_argument("--inference_method", help="Which model to use: fixed - fixed effects, approximate_random - approximate random effects (default), "
                         "bayesian_random - Bayesian hierarchical model (requires PyMC3).",
                         default="approximate_random")
@@ -45,66 +59,448 @@ def main():
                         default=2000, type=int)
     parser.add_argument("--n_burnin", help="(Bayesian hierarchical model) How many of the first samples to discard (default 500).",
                         default=500, type=float)
-    parser.add_argument("--probes_reduction_method", help="How to combine multiple probes: average (default) or pca - use first principal component (requires scikit-learn).",
+    parser.add_argument("--probes_reduction_method", help="How to combine multiple probes: average (default), pca - use first principal component (requires scikit-learn), "
+                        "max_variance - use the probe with the highest variance across wells, differential_stability - use the probe most consistent "
+                        "across donors or stability_weighted - average of probes weighted by their consistency across donors (the last two require "
+                        "a probe quality table built with alleninf.utils.build_probe_quality_table). If a gene expression matrix was built "
+                        "with alleninf.utils.build_gene_expression_matrices it is used instead of fetching individual probes.",
                         default="average")
-    parser.add_argument("--mask", help="Explicit mask for the analysis in the form of a 3D NIFTI file (.nii or .nii.gz) in the same space and "
-                        "dimensionality as the stat_map. If not specified an implicit mask (non zero and non NaN voxels) will be used.",
+    parser.add_argument("--mask", help="Explicit mask for the analysis in the form of a 3D NIFTI file (.nii or .nii.gz) in MNI space "
+                        "(resampled if its grid differs from the stat_map). If not specified an implicit mask (non zero and non NaN voxels) will be used.",
                         type=nifti_file)
     parser.add_argument("--radius", help="Radius in mm of of the sphere used to average statistical values at the location of each probe (default: 4mm).",
                         default=4, type=float)
     parser.add_argument("--probe_exclusion_keyword", help="If the probe name includes this string the probe will not be used.",
                         type=str)
+    parser.add_argument("--atlas", help="Parcellation in the form of a 3D NIFTI label image (.nii or .nii.gz) in MNI space "
+                        "(resampled if its grid differs from the stat_map). If specified, the map and the expression values are averaged "
+                        "within each parcel and compared across parcels instead of wells.",
+                        type=nifti_file)
+    parser.add_argument("--reference", help="3D NIFTI file (.nii or .nii.gz) in MNI space defining the grid the map (trilinear) and the mask are "
+                        "resampled onto before sampling the wells, so that maps of different resolutions are compared on one grid "
+                        "(default: the grid of the stat_map). Not used with --atlas.",
+                        type=nifti_file)
+    parser.add_argument("--gene_list", help="Text file with names of genes to compare the map with (one per line).")
+    parser.add_argument("--output", help="Append statistics of each gene as a JSON line to this file as soon as the gene is analysed "
+                        "('-' for standard output, in which case progress messages are printed to standard error).")
+    parser.add_argument("--n_bootstrap", help="Number of within donor bootstrap replicates used to estimate confidence intervals "
+                        "of the slope and correlation, together with leave-one-donor-out influence (default 0 - no stability analysis). "
+                        "Not available with --atlas and --inference_method fixed, which pool the donors.",
+                        default=0, type=int)
+    parser.add_argument("--seed", help="Random seed for the bootstrap (default 0).", default=0, type=int)
+    parser.add_argument("--n_jobs", help="Number of processes used for the bootstrap (default 1).", default=1, type=int)
+    parser.add_argument("--wells", help="Use only wells from these structures, e.g. 'Cx,left' or '-CB,-BS': comma separated ontology acronyms or ids "
+                        "(wells in any of them), left or right (wells in that hemisphere) and terms starting with - (wells excluded). "
+                        "Requires the well annotation index built with alleninf.utils.build_well_annotations. Without a prebuilt gene "
+                        "expression matrix (or with --probe_exclusion_keyword) the Allen Brain Atlas API still returns all wells, so "
+                        "excluding wells does not reduce the download.")
+    parser.add_argument("--no_cache", "--no-cache", help="Always run the analysis instead of reusing statistics of an identical earlier analysis "
+                        "(same map, mask, atlas, parameters and expression data) from the result cache in the alleninf data directory.",
+                        action="store_true")
 
     args = parser.parse_args()
 
-    print "Fetching probe ids for gene %s" % args.gene_name
-    probes_dict = get_probes_from_genes(args.gene_name)
-    print "Found %s probes: %s" % (len(probes_dict), ", ".join(probes_dict.values()))
+    gene_names = list(args.gene_name)
+    if args.gene_list:
+        gene_names += read_gene_list(args.gene_list)
+    if not gene_names:
+        parser.error("specify at least one gene name or a --gene_list file")
+    if args.n_bootstrap and args.atlas and args.inference_method == "fixed":
+        # parcels of all donors are pooled, leaving no donors to resample
+        parser.error("--n_bootstrap can not be used with --atlas and --inference_method fixed")
+
+    stdout = sys.stdout
+    results_file = None
+    if args.output == "-":
+        # keep stdout for the results, progress messages go to stderr
+        results_file = sys.stdout
+        sys.stdout = sys.stderr
+    elif args.output:
+        results_file = open(args.output, "a")
+
+    try:
+        wells = None
+        if args.wells:
+            wells = select_wells(args.wells)
+            print "Selected %d wells matching %s" % (len(wells), args.wells)
+
+        # plots are only shown when a single gene is analysed
+        plot = len(gene_names) == 1
+        map_cache = {}
+        cache = None
+        cached = {}
+        if not args.no_cache:
+            cache = ResultCache()
+            cache_keys = _cache_keys(cache, args, gene_names)
+            for gene_name in gene_names:
+                result = cache.get(cache_keys[gene_name])
+                if result is not None:
+                    cached[gene_name] = result
+        # only genes without a cached result are fetched
+        fetched = prefetch_expression([gene_name for gene_name in gene_names if gene_name not in cached],
+                                      args.probes_reduction_method, args.probe_exclusion_keyword,
+                                      wells=wells)
+        for gene_name in gene_names:
+            if gene_name in cached:
+                result = cached[gene_name]
+                print "Using cached result for %s: estimate = %s, p = %s" % (
+                    gene_name, result["estimate"], result["p"])
+                _write_result(results_file, result)
+                continue
+            gene_name, expression, error = next(fetched)
+            result = {"gene": gene_name, "method": args.inference_method}
+            if error is None:
+                try:
+                    data = _prepare_table(args, gene_name, expression, map_cache)
+                    if args.inference_method == "fixed":
+                        print "Performing fixed effect analysis"
+                    elif args.inference_method == "approximate_random":
+                        print "Performing approximate random effect analysis"
+                    elif args.inference_method == "bayesian_random":
+                        print "Fitting Bayesian hierarchical model"
+                    result.update(run_inference(data, args.inference_method,
+                                                args.n_samples, args.n_burnin, plot=plot))
+                    if args.n_bootstrap:
+                        result.update(_run_stability_analysis(data, args))
+                    if cache is not None:
+                        cache.put(cache_keys[gene_name], result)
+                except Exception as e:
+                    if len(gene_names) == 1:
+                        raise
+                    error = e
+            if error is not None:
+                if len(gene_names) == 1:
+                    raise error
+                print "Analysis of %s failed: %s" % (gene_name, error)
+                result["error"] = str(error)
+            _write_result(results_file, result)
+        if cache is not None:
+            print "Result cache: %d hits, %d misses" % (cache.hits, cache.misses)
+    finally:
+        sys.stdout = stdout
+        if results_file is not None and results_file is not stdout:
+            results_file.close()
+
+
+def _without_nan(value):
+    """Replaces NaN (not valid JSON) by None, also in nested results."""
+    if isinstance(value, dict):
+        return dict((k, _without_nan(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [_without_nan(v) for v in value]
+    if isinstance(value, (float, np.floating)) and np.isnan(value):
+        return None
+    return value
+
 
-    if args.probe_exclusion_keyword:
-        probes_dict = {probe_id: probe_name for (probe_id, probe_name) in probes_dict.iteritems() if not args.probe_exclusion_keyword in probe_name}
-        print "Probes after applying exclusion cryterion: %s" % (", ".join(probes_dict.values()))
+def _write_result(results_file, result):
+    if results_file is not None:
+        results_file.write(json.dumps(_without_nan(result)) + "\n")
+        results_file.flush()
+
+
+def _cache_keys(cache, args, gene_names):
+    """Result cache keys of the analyses of each gene."""
+    params = {"stat_map": file_hash(args.stat_map),
+              "mask": file_hash(args.mask),
+              "atlas": file_hash(args.atlas),
+              "reference": file_hash(args.reference),
+              "wells": [args.wells, file_hash(get_annotations_file()) if args.wells else None],
+              "expression": expression_version(args.probes_reduction_method,
+                                               args.probe_exclusion_keyword)}
+    for name in ["inference_method", "n_samples", "n_burnin", "probes_reduction_method",
+                 "radius", "probe_exclusion_keyword", "n_bootstrap", "seed"]:
+        params[name] = getattr(args, name)
+    return dict((gene_name, cache.key(gene=gene_name, **params)) for gene_name in gene_names)
+
+
+def _run_stability_analysis(data, args):
+    print "Estimating stability with %d bootstrap replicates and leave-one-donor-out" % args.n_bootstrap
+    stability = stability_analysis(data, n_bootstrap=args.n_bootstrap,
+                                   random_seed=args.seed, n_jobs=args.n_jobs)
+    print "Averaged slope across donors = %g (95%% CI %g to %g)" % (
+        stability.slope, stability.slope_ci[0], stability.slope_ci[1])
+    print "Correlation across all donors = %g (95%% CI %g to %g)" % (
+        stability.correlation, stability.correlation_ci[0], stability.correlation_ci[1])
+    for donor, lodo_slope, influence in zip(stability.donors, stability.lodo_slopes,
+                                            stability.slope_influence):
+        print "Without donor %s: averaged slope = %g (change %+g)" % (donor, lodo_slope, influence)
+    return {"slope_ci": list(stability.slope_ci),
+            "correlation_ci": list(stability.correlation_ci),
+            "lodo_slopes": dict(zip(stability.donors, stability.lodo_slopes)),
+            "lodo_correlations": dict(zip(stability.donors, stability.lodo_correlations)),
+            "donor_slope_influence": dict(zip(stability.donors, stability.slope_influence))}
+
+
+def read_gene_list(gene_list_file):
+    """Reads gene names (or other items), one per line. Empty lines and lines
+    starting with # are skipped."""
+    with open(gene_list_file) as f:
+        return [line.strip() for line in f
+                if line.strip() and not line.strip().startswith("#")]
+
+
+def get_gene_expression(gene_name, probes_reduction_method="average",
+                        probe_exclusion_keyword=None, wells=None):
+    """Returns combined expression values, well ids and donor names of a
+    gene, restricted to the given wells (ids) if specified."""
+    if not probe_exclusion_keyword and gene_expression_matrix_available(probes_reduction_method):
+        print "Reading %s expression values from the prebuilt gene expression matrix" % gene_name
+        expression_values, well_ids, donor_names = get_expression_values_from_genes(
+            gene_name, method=probes_reduction_method, wells=wells)
+        combined_expression_values = expression_values[0]
+        print "Found data from %s wells sampled across %s donors" % (len(well_ids), len(set(donor_names)))
+    else:
+        print "Fetching probe ids for gene %s" % gene_name
+        probes_dict = get_probes_from_genes(gene_name)
+        print "Found %s probes: %s" % (len(probes_dict), ", ".join(probes_dict.values()))
 
-    print "Fetching expression values for probes %s" % (", ".join(probes_dict.values()))
-    expression_values, well_ids, donor_names = get_expression_values_from_probe_ids(
-        probes_dict.keys())
-    print "Found data from %s wells sampled across %s donors" % (len(well_ids), len(set(donor_names)))
+        if probe_exclusion_keyword:
+            probes_dict = {probe_id: probe_name for (probe_id, probe_name) in probes_dict.iteritems() if not probe_exclusion_keyword in probe_name}
+            print "Probes after applying exclusion cryterion: %s" % (", ".join(probes_dict.values()))
+
+        print "Fetching expression values for probes %s" % (", ".join(probes_dict.values()))
+        expression_values, well_ids, donor_names, probe_ids = get_expression_values_from_probe_ids(
+            probes_dict.keys())
+        if wells is not None:
+            # the Allen Brain Atlas API has no well filter - all wells are
+            # downloaded and the selection only applies afterwards
+            selected = np.in1d(well_ids, wells)
+            expression_values = [np.asarray(values)[selected] for values in expression_values]
+            well_ids = list(np.asarray(well_ids)[selected])
+            donor_names = list(np.asarray(donor_names)[selected])
+        print "Found data from %s wells sampled across %s donors" % (len(well_ids), len(set(donor_names)))
+
+        print "Combining information from selected probes"
+        combined_expression_values = combine_expression_values(
+            expression_values, method=probes_reduction_method, probe_ids=probe_ids)
+    return combined_expression_values, well_ids, donor_names
+
+
+def prefetch_expression(gene_names, probes_reduction_method="average",
+                        probe_exclusion_keyword=None, n_ahead=2, wells=None):
+    """Yields (gene_name, expression, error) for every gene. Expression values
+    are fetched by a background thread up to n_ahead genes in advance, so that
+    fetching overlaps with the analysis of the previous genes."""
+    queue = Queue.Queue(maxsize=n_ahead)
+
+    def fetch():
+        for gene_name in gene_names:
+            try:
+                queue.put((gene_name, get_gene_expression(
+                    gene_name, probes_reduction_method, probe_exclusion_keyword, wells), None))
+            except Exception as e:
+                queue.put((gene_name, None, e))
+
+    thread = threading.Thread(target=fetch)
+    thread.daemon = True
+    thread.start()
+    for _ in gene_names:
+        yield queue.get()
+
+
+def _prepare_table(args, gene_name, expression, map_cache):
+    """Builds the WellTable of one gene. Values of the map (or its parcels)
+    are computed for the first gene and reused for the following ones."""
+    combined_expression_values, well_ids, donor_names = expression
+    expression_label = "%s expression" % gene_name
+    wells_key = tuple(well_ids)
+    if args.atlas:
+        if "parcels" not in map_cache:
+            print "Averaging values within parcels of %s" % args.atlas
+            map_cache["parcels"] = get_parcel_values(
+                args.stat_map, args.atlas, mask_file=args.mask, verbose=True)
+        parcel_values = map_cache["parcels"]
+        n_parcels = len(parcel_values)
+        well_parcels = get_well_parcels(args.atlas, well_ids)
+        if args.inference_method == "fixed":
+            # pool wells from all donors within each parcel
+            donors, donor_codes = np.array(["all"]), np.zeros(len(well_ids), dtype=int)
+        else:
+            donors, donor_codes = np.unique(donor_names, return_inverse=True)
+        parcel_expression = aggregate_by_parcel(
+            combined_expression_values, well_parcels, n_parcels,
+            groups=donor_codes, n_groups=len(donors))
+        data = WellTable(np.tile(parcel_values, len(donors)), parcel_expression.ravel(),
+                         np.repeat(np.arange(len(donors)), n_parcels), donors,
+                         well_ids=np.tile(np.arange(n_parcels), len(donors)),
+                         expression_label=expression_label)
+        # label 0 is the atlas background
+        data = data.select(data.well_ids > 0)
+        len_before = len(data)
+        data = data.dropna()
+        print "Comparing %s parcel averages (%s empty parcels skipped)" % (len(data), len_before - len(data))
+    else:
+        if wells_key not in map_cache:
+            print "Translating locations of the wells to MNI space"
+            mni_coordinates = get_mni_coordinates_from_wells(well_ids)
+            print "Checking values of the provided NIFTI file at well locations"
+            nifti_values = get_values_at_locations(
+                args.stat_map, mni_coordinates, mask_file=args.mask, radius=args.radius, verbose=True,
+                reference_file=args.reference)
+            map_cache[wells_key] = (nifti_values, mni_coordinates)
+        nifti_values, mni_coordinates = map_cache[wells_key]
+
+        data = WellTable.from_wells(nifti_values, combined_expression_values, donor_names,
+                                    well_ids=well_ids, coordinates=mni_coordinates,
+                                    expression_label=expression_label)
+        len_before = len(data)
+        data = data.dropna()
+        nans = len_before - len(data)
+        if nans > 0:
+            print "%s wells fall outside of the mask" % nans
+    return data
+
+
+def gene_sets_main():
+    parser = argparse.ArgumentParser(
+        description="Test whether a statistical map is associated with sets of genes from Allen Human Brain Atlas. "
+                    "Requires gene expression matrices built with alleninf.utils.build_gene_expression_matrices.")
+    parser.add_argument(
+        "stat_map", help="Unthresholded statistical map in the form of a 3D NIFTI file (.nii or .nii.gz) in MNI space.", type=nifti_file)
+    parser.add_argument("gene_sets", help="Gene sets in the GMT format (one set per line: name, description and tab separated gene names).")
+    parser.add_argument("--probes_reduction_method", help="Which gene expression matrix to use: average (default), pca, max_variance, "
+                        "differential_stability or stability_weighted.",
+                        default="average")
+    parser.add_argument("--mask", help="Explicit mask for the analysis in the form of a 3D NIFTI file (.nii or .nii.gz) in MNI space "
+                        "(resampled if its grid differs from the stat_map). If not specified an implicit mask (non zero and non NaN voxels) will be used.",
+                        type=nifti_file)
+    parser.add_argument("--radius", help="Radius in mm of of the sphere used to average statistical values at the location of each probe (default: 4mm).",
+                        default=4, type=float)
+    parser.add_argument("--reference", help="3D NIFTI file (.nii or .nii.gz) in MNI space defining the grid the map (trilinear) and the mask are "
+                        "resampled onto before sampling the wells, so that maps of different resolutions are compared on one grid "
+                        "(default: the grid of the stat_map).",
+                        type=nifti_file)
+    parser.add_argument("--n_permutations", help="Number of random gene sets of matching size used to estimate p values (default 10000).",
+                        default=10000, type=int)
+    parser.add_argument("--min_size", help="Skip gene sets with fewer genes present in the data (default 5).",
+                        default=5, type=int)
+    parser.add_argument("--max_size", help="Skip gene sets with more genes present in the data (default 500).",
+                        default=500, type=int)
+    parser.add_argument("--seed", help="Random seed (default 0).", default=0, type=int)
+    parser.add_argument("--output", help="Save the results table to this CSV file.")
 
-    print "Combining information from selected probes"
-    combined_expression_values = combine_expression_values(
-        expression_values, method=args.probes_reduction_method)
+    args = parser.parse_args()
 
-    print "Translating locations of the wells to MNI space"
-    mni_coordinates = get_mni_coordinates_from_wells(well_ids)
+    gene_sets = read_gmt(args.gene_sets)
+    print "Read %s gene sets from %s" % (len(gene_sets), args.gene_sets)
 
-    print "Checking values of the provided NIFTI file at well locations"
+    matrix = load_gene_expression_matrix(args.probes_reduction_method)
+    print "Checking values of the provided NIFTI file at %s well locations" % len(matrix.well_ids)
     nifti_values = get_values_at_locations(
-        args.stat_map, mni_coordinates, mask_file=args.mask, radius=args.radius, verbose=True)
-
-    # preparing the data frame
-    names = ["NIFTI values", "%s expression" % args.gene_name, "donor ID"]
-    data = pd.DataFrame(np.array(
-        [nifti_values, combined_expression_values, donor_names]).T, columns=names)
-    data = data.convert_objects(convert_numeric=True)
-    len_before = len(data)
-    data.dropna(axis=0, inplace=True)
-    nans = len_before - len(data)
-    if nans > 0:
-        print "%s wells fall outside of the mask" % nans
-
-    if args.inference_method == "fixed":
-        print "Performing fixed effect analysis"
-        fixed_effects(data, ["NIFTI values", "%s expression" % args.gene_name])
-
-    if args.inference_method == "approximate_random":
-        print "Performing approximate random effect analysis"
-        approximate_random_effects(
-            data, ["NIFTI values", "%s expression" % args.gene_name], "donor ID")
-
-    if args.inference_method == "bayesian_random":
-        print "Fitting Bayesian hierarchical model"
-        bayesian_random_effects(
-            data, ["NIFTI values", "%s expression" % args.gene_name], "donor ID", args.n_samples, args.n_burnin)
+        args.stat_map, get_mni_coordinates_from_wells(matrix.well_ids),
+        mask_file=args.mask, radius=args.radius, verbose=True, reference_file=args.reference)
+
+    print "Correlating the map with %s genes and scoring gene sets" % len(matrix.genes)
+    results = map_gene_set_enrichment(
+        nifti_values, matrix.well_ids, gene_sets, method=args.probes_reduction_method,
+        n_permutations=args.n_permutations, min_size=args.min_size,
+        max_size=args.max_size, random_seed=args.seed)
+    print results.head(20).to_string()
+    if args.output:
+        results.to_csv(args.output)
+
+
+def jobs_main():
+    parser = argparse.ArgumentParser(
+        description="Run many map and gene comparisons listed in a manifest, saving results as they complete.")
+    parser.add_argument("manifest", help="CSV file with one task per row. Required columns: stat_map, gene. Optional columns: "
+                        "method (fixed, approximate_random or bayesian_random), mask, radius, reference.")
+    parser.add_argument("results", help="HDF5 file the results are appended to. Tasks already present in it "
+                        "(with the same probes reduction method and MCMC settings) are skipped.")
+    parser.add_argument("--inference_method", help="Method used for tasks not specifying one (default approximate_random).",
+                        default="approximate_random")
+    parser.add_argument("--radius", help="Radius in mm used for tasks not specifying one (default: 4mm).",
+                        default=4, type=float)
+    parser.add_argument("--reference", help="3D NIFTI file defining the grid maps and masks are resampled onto, for tasks not specifying one "
+                        "(default: the grid of each map). Maps of different resolutions then share one grid and the voxels sampled at the wells.",
+                        type=nifti_file)
+    parser.add_argument("--probes_reduction_method", help="How to combine multiple probes: average (default), pca, max_variance, "
+                        "differential_stability or stability_weighted.",
+                        default="average")
+    parser.add_argument("--n_samples", help="(Bayesian hierarchical model) Number of samples for MCMC model estimation (default 2000).",
+                        default=2000, type=int)
+    parser.add_argument("--n_burnin", help="(Bayesian hierarchical model) How many of the first samples to discard (default 500).",
+                        default=500, type=int)
+    parser.add_argument("--n_jobs", help="Number of worker processes (default: number of CPUs).", type=int)
+
+    args = parser.parse_args()
+
+    tasks = read_manifest(args.manifest, method=args.inference_method, radius=args.radius,
+                          reference=args.reference)
+    failed = run_jobs(tasks, args.results, n_jobs=args.n_jobs,
+                      probes_reduction_method=args.probes_reduction_method,
+                      n_samples=args.n_samples, n_burnin=args.n_burnin)
+    if failed:
+        print "%d tasks failed and will be retried on the next run" % failed
+        return 1
+
+
+def correlation_matrix_main():
+    parser = argparse.ArgumentParser(
+        description="Correlate many statistical maps with all genes, writing the maps x genes matrix to an HDF5 file. "
+                    "Requires gene expression matrices built with alleninf.utils.build_gene_expression_matrices.")
+    parser.add_argument("maps", help="Text file with paths of 3D NIFTI maps in MNI space (one per line).")
+    parser.add_argument("output", help="HDF5 output file. If it exists, an interrupted computation is resumed.")
+    parser.add_argument("--max_memory", "--max-memory", help="Memory used for computing tiles of the matrix, e.g. 512M or 4G (default 1G).",
+                        default="1G", type=parse_memory)
+    parser.add_argument("--n_jobs", help="Number of worker processes (default 1).", default=1, type=int)
+    parser.add_argument("--probes_reduction_method", help="Which gene expression matrix to use: average (default), pca, max_variance, "
+                        "differential_stability or stability_weighted.",
+                        default="average")
+    parser.add_argument("--mask", help="Explicit mask for all maps in the form of a 3D NIFTI file (.nii or .nii.gz) "
+                        "(resampled if its grid differs from a map). If not specified an implicit mask (non zero and non NaN voxels) will be used.",
+                        type=nifti_file)
+    parser.add_argument("--radius", help="Radius in mm of of the sphere used to average statistical values at the location of each probe (default: 4mm).",
+                        default=4, type=float)
+    parser.add_argument("--reference", help="3D NIFTI file defining the grid all maps (trilinear) and the mask are resampled onto before "
+                        "sampling the wells (default: the grid of each map).",
+                        type=nifti_file)
+
+    args = parser.parse_args()
+
+    stat_maps = read_gene_list(args.maps)
+    correlation_matrix(stat_maps, args.output, max_memory=args.max_memory,
+                       n_jobs=args.n_jobs, method=args.probes_reduction_method,
+                       mask_file=args.mask, radius=args.radius, reference_file=args.reference)
+
+
+def expression_maps_main():
+    parser = argparse.ArgumentParser(
+        description="Estimate voxelwise gene expression from the well samples of the Allen Human Brain Atlas, "
+                    "writing one volume per gene to a 4D NIFTI file. "
+                    "Requires gene expression matrices built with alleninf.utils.build_gene_expression_matrices.")
+    parser.add_argument("reference", help="3D NIFTI file (.nii or .nii.gz) in MNI space defining the output grid.", type=nifti_file)
+    parser.add_argument("output", help="Output 4D NIFTI file.")
+    parser.add_argument("gene_name", help="Names of the genes to map.", nargs="*")
+    parser.add_argument("--gene_list", help="Text file with names of genes to map (one per line).")
+    parser.add_argument("--method", help="Interpolation between wells: nearest, idw (inverse distance weighting, default) or gaussian.",
+                        default="idw", choices=["nearest", "idw", "gaussian"])
+    parser.add_argument("--k", help="Number of nearest wells contributing to each voxel (default 8).", default=8, type=int)
+    parser.add_argument("--power", help="(idw) Power of the inverse distance (default 2).", default=2, type=float)
+    parser.add_argument("--fwhm", help="(gaussian) FWHM of the kernel in mm (default 6mm).", default=6, type=float)
+    parser.add_argument("--max_distance", help="Ignore wells further away than this many mm (default: no limit).", type=float)
+    parser.add_argument("--mask", help="Explicit mask in the form of a 3D NIFTI file (.nii or .nii.gz) in MNI space. "
+                        "If not specified an implicit mask (non zero and non NaN voxels of the reference) will be used.",
+                        type=nifti_file)
+    parser.add_argument("--probes_reduction_method", help="Which gene expression matrix to use: average (default), pca, max_variance, "
+                        "differential_stability or stability_weighted.",
+                        default="average")
+
+    args = parser.parse_args()
+
+    gene_names = list(args.gene_name)
+    if args.gene_list:
+        gene_names += read_gene_list(args.gene_list)
+    if not gene_names:
+        parser.error("provide gene names or --gene_list")
+
+    print "Estimating expression of %d genes" % len(gene_names)
+    nii = expression_maps(gene_names, args.reference, method=args.method,
+                          probes_reduction_method=args.probes_reduction_method,
+                          mask_file=args.mask, k=args.k, power=args.power,
+                          fwhm=args.fwhm, max_distance=args.max_distance)
+    nb.save(nii, args.output)
 
 
 if __name__ == '__main__':
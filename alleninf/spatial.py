@@ -0,0 +1,115 @@
+import os
+import numpy as np
+import pandas as pd
+import nibabel as nb
+import numpy.linalg as npl
+from scipy.spatial import cKDTree
+from sklearn.datasets.base import Bunch
+
+from alleninf.api import read_donor_expression
+
+_well_index = {}
+
+
+def get_well_index():
+    """Returns a Bunch with well_ids, their MNI coordinates and a KD-tree over
+    the coordinates. It is built once per process."""
+    if "index" not in _well_index:
+        package_directory = os.path.dirname(os.path.abspath(__file__))
+        frame = pd.read_csv(os.path.join(
+            package_directory, "data", "corrected_mni_coordinates.csv"), header=0, index_col=0)
+        coordinates = frame.values.astype(np.float64)
+        _well_index["index"] = Bunch(well_ids=np.asarray(frame.index),
+                                     coordinates=coordinates,
+                                     tree=cKDTree(coordinates))
+    return _well_index["index"]
+
+
+def _as_points(points):
+    points = np.atleast_2d(np.asarray(points, dtype=np.float64))
+    if points.shape[1] != 3:
+        raise Exception("Expected MNI coordinates (n x 3), got shape %s" % (points.shape,))
+    return points
+
+
+def wells_within_radius(points, radius):
+    """For each of the query points (n x 3 MNI coordinates) returns an array
+    of ids of wells within radius mm, ordered by distance."""
+    index = get_well_index()
+    points = _as_points(points)
+    neighbors = index.tree.query_ball_point(points, radius)
+    result = []
+    for point, idx in zip(points, neighbors):
+        idx = np.asarray(idx, dtype=np.intp)
+        distances = np.sqrt(((index.coordinates[idx] - point) ** 2).sum(axis=1))
+        result.append(index.well_ids[idx[np.argsort(distances)]])
+    return result
+
+
+def nearest_wells(points, k=1):
+    """Returns (distances, well_ids) of the k nearest wells of each query
+    point, both arrays of shape (n_points, k)."""
+    index = get_well_index()
+    distances, idx = index.tree.query(_as_points(points), k=k)
+    distances = np.asarray(distances).reshape(-1, k)
+    idx = np.asarray(idx).reshape(-1, k)
+    return distances, index.well_ids[idx]
+
+
+def wells_in_roi(roi_file):
+    """Returns ids of wells located in non zero voxels of a NIFTI ROI."""
+    index = get_well_index()
+    nii = nb.load(roi_file)
+    roi = np.asarray(nii.get_data())
+    ijk = np.round(nb.affines.apply_affine(npl.inv(nii.get_affine()),
+                                           index.coordinates)).astype(int)
+    inside = np.all((ijk >= 0) & (ijk < np.array(roi.shape[:3])), axis=1)
+    selected = np.zeros(len(ijk), dtype=bool)
+    values = roi[tuple(ijk[inside].T)]
+    selected[inside] = np.logical_and(values != 0, ~np.isnan(values))
+    return index.well_ids[selected]
+
+
+def get_expression_near(points, probe_ids, k=None, radius=None):
+    """Expression of the given probes in wells near each query point.
+
+    Exactly one of k (nearest neighbours) and radius (mm) has to be given.
+    The expression of all probes is read once, only for the union of the
+    neighbouring wells (partitions of donors without any of them are
+    skipped). Returns a Bunch with well_ids, distances and
+    expression: with k these are arrays of shape (n_points, k) and
+    (n_points, k, n_probes), with radius lists with one (n_neighbors,) and
+    (n_neighbors, n_probes) array per point. probe_ids gives the order of the
+    last axis."""
+    if (k is None) == (radius is None):
+        raise Exception("Specify either k or radius")
+    points = _as_points(points)
+    if k is not None:
+        distances, well_ids = nearest_wells(points, k)
+    else:
+        well_ids = wells_within_radius(points, radius)
+        index = get_well_index()
+        coordinates = pd.DataFrame(index.coordinates, index=index.well_ids)
+        distances = [np.sqrt(((coordinates.loc[ids].values - point) ** 2).sum(axis=1))
+                     for ids, point in zip(well_ids, points)]
+
+    probe_ids = list(probe_ids)
+    where_query = "index in [%s]" % (",".join("'%s'" % probe_id for probe_id in probe_ids))
+    neighbors = np.unique(np.concatenate([np.ravel(ids) for ids in well_ids]))
+    frames = []
+    for donor, df in read_donor_expression(where=where_query, wells=neighbors):
+        df.columns = [int(col[len("well_id_"):]) for col in df.columns]
+        frames.append(df.reindex(probe_ids))
+    # wells x probes table of the neighbouring wells with data
+    if frames:
+        expression = pd.concat(frames, axis=1).T
+    else:
+        expression = pd.DataFrame(columns=probe_ids, dtype=np.float32)
+
+    if k is not None:
+        block = expression.reindex(well_ids.ravel()).values
+        block = block.reshape(well_ids.shape + (len(probe_ids),))
+    else:
+        block = [expression.reindex(ids).values for ids in well_ids]
+    return Bunch(well_ids=well_ids, distances=distances, expression=block,
+                 probe_ids=probe_ids)
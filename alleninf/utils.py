@@ -1,34 +1,456 @@
 import os
+import sys
+import json
+import time
+import subprocess
+import hashlib
+from itertools import groupby
+from operator import itemgetter
 import pandas as pd
 import numpy as np
 from glob import glob
+from tables import open_file
+
+from alleninf.api import GENE_MATRIX_FORMAT_VERSION, STORE_FORMAT_VERSION,\
+    STORE_DTYPES, get_store_dir, read_donor_expression, iter_donor_expression,\
+    store_version, read_partition, iter_partition, load_probe_quality
+from alleninf.datasets import _md5_sum_file, _write_store_manifest
+from alleninf.data import reduce_probes_to_genes
+from alleninf.parcellation import get_well_parcels_table, aggregate_by_parcel
+from alleninf.spatial import get_well_index
+from alleninf.anatomy import _annotations_path
+
+def read_donor_csv(donor_dir):
+    """Reads SampleAnnot.csv and MicroarrayExpression.csv of one donor into a
+    probes x wells DataFrame (columns named well_id_<id>)."""
+    sample_locations = pd.read_csv(os.path.join(donor_dir, 'SampleAnnot.csv'))
+    df = pd.DataFrame({"well_id":list(sample_locations.well_id)})
+    expression_data = pd.read_csv(os.path.join(donor_dir,
+            'MicroarrayExpression.csv'),
+        header=None, index_col=0, dtype=np.float32)
+    expression_data.columns = range(expression_data.shape[1])
+    df = pd.concat([df, expression_data.T], axis=1, ignore_index=False)
+    df.set_index("well_id", inplace=True)
+    df = df.transpose()
+
+    df.columns = ["well_id_" + str(int(c)) for c in df.columns]
+    df.index = [int(c) for c in df.index]
+    df.index.name = 'probe_id'
+    return df
 
 def allen_csv_to_hdf(donors_dir, hdf_output='data/microarray_expression.h5'):
     """Takes a directory with one subdirectory for each donor containing a
     SampleAnnot.csv and MicroarrayExpression.csv files. The output is a 
     compressed HDF5 file containing concatenated wells x gene probes table."""
     
-    donor_ids = [p.split(os.sep)[-1] for p in glob(os.path.join(data_dir, "*"))]
+    donor_ids = [p.split(os.sep)[-1] for p in glob(os.path.join(donors_dir, "*"))]
 
     for donor_id in donor_ids:
         print "adding donor %s"%donor_id
-        sample_locations = pd.read_csv(os.path.join(data_dir, 
-                donor_id, 'SampleAnnot.csv'))
-        df = pd.DataFrame({"well_id":list(sample_locations.well_id)})
-        expression_data = pd.read_csv(os.path.join(data_dir, 
-                donor_id, 
-                'MicroarrayExpression.csv'), 
-            header=None, index_col=0, dtype=np.float32)
-        expression_data.columns = range(expression_data.shape[1])
-        df = pd.concat([df, expression_data.T], axis=1, ignore_index=False)
-        df.set_index("well_id", inplace=True)
-        df = df.transpose()
-        
-        df.columns = ["well_id_" + str(int(c)) for c in df.columns]
-        df.index = [int(c) for c in df.index]
-        df.index.name = 'probe_id'
+        df = read_donor_csv(os.path.join(donors_dir, donor_id))
         df.to_hdf(hdf_output, donor_id, mode="a", format='table', complevel=9, complib='blosc')
 
+def _read_store_manifest(store_dir):
+    manifest_file = os.path.join(store_dir, "manifest.json")
+    if not os.path.exists(manifest_file):
+        return {"format_version": STORE_FORMAT_VERSION, "donors": {}}
+    with open(manifest_file) as f:
+        return json.load(f)
+
+def quantize(values, dtype):
+    """Converts a probes x wells array to the given storage type. For integer
+    types returns the codes together with per probe offsets and scales
+    spanning the range of each probe (see alleninf.api.dequantize)."""
+    if dtype not in STORE_DTYPES:
+        raise Exception("Unknown storage type %s" % dtype)
+    if dtype == "float32" or dtype == "float16":
+        return values.astype(dtype), None, None
+    info = np.iinfo(dtype)
+    missing = np.isnan(values)
+    with np.errstate(invalid="ignore"):
+        offsets = np.nan_to_num(np.nanmin(values, axis=1))
+        scales = (np.nan_to_num(np.nanmax(values, axis=1)) - offsets) / (info.max - info.min - 1)
+    scales[scales == 0] = 1
+    codes = np.round((np.where(missing, offsets[:, np.newaxis], values) -
+                      offsets[:, np.newaxis]) / scales[:, np.newaxis]) + (info.min + 1)
+    codes[missing] = info.min
+    return codes.astype(dtype), offsets, scales
+
+def add_donor_partition(store_dir, donor_id, expression, version=None, dtype="float32"):
+    """Adds (or replaces) the partition of one donor in a donor partitioned
+    store. expression is a probes x wells DataFrame as returned by
+    read_donor_csv. The partition is written under a temporary name and the
+    manifest (recording version, checksum, probe set and number of wells of
+    each donor) is updated only once the partition is complete.
+
+    dtype sets how values are stored: float32 (default), float16 or per
+    probe scaled int16 or int8 codes. Quantized partitions are converted back
+    to float32 when read."""
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+    file_name = "%s.h5" % donor_id
+    partition = os.path.join(store_dir, file_name)
+    if os.path.exists(partition + ".tmp"):
+        os.remove(partition + ".tmp")
+    codes, offsets, scales = quantize(np.asarray(expression.values, dtype=np.float64), dtype)
+    pd.DataFrame(codes, index=expression.index, columns=expression.columns).to_hdf(
+        partition + ".tmp", "expression", mode="w", format='table',
+        complevel=9, complib='blosc')
+    if offsets is not None:
+        pd.DataFrame({"offset": offsets, "scale": scales}, index=expression.index).to_hdf(
+            partition + ".tmp", "quantization", mode="a", complevel=9, complib='blosc')
+    os.rename(partition + ".tmp", partition)
+
+    probe_ids = np.asarray(expression.index, dtype=np.int64)
+    manifest = _read_store_manifest(store_dir)
+    manifest["format_version"] = STORE_FORMAT_VERSION
+    manifest["donors"][donor_id] = {
+        "file": file_name,
+        "version": version or time.strftime("%Y-%m-%d"),
+        "md5": _md5_sum_file(partition),
+        "dtype": dtype,
+        "n_wells": expression.shape[1],
+        "n_probes": len(probe_ids),
+        "probes_md5": hashlib.md5(np.sort(probe_ids).tostring()).hexdigest(),
+        "updated": time.strftime("%Y-%m-%dT%H:%M:%S")}
+    probe_sets = set(entry["probes_md5"] for entry in manifest["donors"].values())
+    if len(probe_sets) > 1:
+        print "Warning: donors in %s were measured with different probe sets" % store_dir
+    _write_store_manifest(store_dir, manifest)
+
+def add_donor_from_csv(donor_dir, store_dir, donor_id=None, version=None, dtype="float32"):
+    """Adds (or replaces) one donor in a donor partitioned store from a
+    directory with SampleAnnot.csv and MicroarrayExpression.csv files."""
+    if donor_id is None:
+        donor_id = os.path.basename(os.path.normpath(donor_dir))
+    print "adding donor %s" % donor_id
+    add_donor_partition(store_dir, donor_id, read_donor_csv(donor_dir), version=version,
+                        dtype=dtype)
+
+def remove_donor_partition(store_dir, donor_id):
+    """Removes one donor from a donor partitioned store."""
+    manifest = _read_store_manifest(store_dir)
+    entry = manifest["donors"].pop(donor_id)
+    _write_store_manifest(store_dir, manifest)
+    os.remove(os.path.join(store_dir, entry["file"]))
+
+def allen_csv_to_store(donors_dir, store_dir=None, version=None, dtype="float32"):
+    """Like allen_csv_to_hdf, but creates a donor partitioned store (by
+    default in the alleninf data directory)."""
+    if store_dir is None:
+        store_dir = get_store_dir()
+    for donor_dir in sorted(glob(os.path.join(donors_dir, "*", "MicroarrayExpression.csv"))):
+        add_donor_from_csv(os.path.dirname(donor_dir), store_dir, version=version, dtype=dtype)
+
+def split_hdf_store(hdf_file, store_dir=None, version=None, dtype="float32"):
+    """Converts a single file HDF5 store into a donor partitioned store."""
+    if store_dir is None:
+        store_dir = get_store_dir()
+    h_handle = open_file(hdf_file, "r")
+    donors = [g._v_name for g in list(h_handle.walk_groups("/"))[1:]]
+    h_handle.close()
+    for donor in donors:
+        print "adding donor %s" % donor
+        add_donor_partition(store_dir, donor, pd.read_hdf(hdf_file, donor), version=version,
+                            dtype=dtype)
+
+def _read_store(store_dir):
+    manifest = _read_store_manifest(store_dir)
+    for donor in sorted(manifest["donors"]):
+        entry = manifest["donors"][donor]
+        yield donor, entry, os.path.join(store_dir, entry["file"])
+
+def quantize_store(store_dir, output_dir, dtype="int16"):
+    """Writes a copy of a donor partitioned store with values stored as
+    dtype (see add_donor_partition)."""
+    for donor, entry, partition in _read_store(store_dir):
+        print "quantizing donor %s" % donor
+        add_donor_partition(output_dir, donor,
+                            read_partition(partition, entry.get("dtype", "float32")),
+                            version=entry["version"], dtype=dtype)
+
+def validate_quantized_store(reference_dir, quantized_dir, n_maps=100, random_seed=0):
+    """Compares a quantized store with the full precision store it was made
+    from. For every donor reports the largest absolute error of the values
+    and the largest and mean absolute errors of the correlations between
+    each probe and n_maps random maps (normally distributed values at the
+    wells of the donor). Returns the report as a DataFrame."""
+    random_state = np.random.RandomState(random_seed)
+    reference = dict((donor, (entry, partition)) for donor, entry, partition
+                     in _read_store(reference_dir))
+    rows = []
+    for donor, entry, partition in _read_store(quantized_dir):
+        full = read_partition(reference[donor][1], reference[donor][0].get("dtype", "float32"))
+        approx = read_partition(partition, entry["dtype"]).loc[full.index, full.columns]
+        full, approx = full.values.astype(np.float64), approx.values.astype(np.float64)
+        maps = random_state.randn(full.shape[1], n_maps)
+        maps -= maps.mean(axis=0)
+        maps /= np.sqrt((maps ** 2).sum(axis=0))
+
+        def correlations(values):
+            values = np.where(np.isnan(values), np.nanmean(values, axis=1)[:, np.newaxis], values)
+            values = values - values.mean(axis=1)[:, np.newaxis]
+            with np.errstate(invalid="ignore", divide="ignore"):
+                values /= np.sqrt((values ** 2).sum(axis=1))[:, np.newaxis]
+            return values.dot(maps)
+        errors = np.abs(correlations(full) - correlations(approx))
+        rows.append({"donor": donor, "dtype": entry["dtype"],
+                     "max_abs_error": np.nanmax(np.abs(full - approx)),
+                     "max_correlation_error": np.nanmax(errors),
+                     "mean_correlation_error": np.nanmean(errors)})
+    report = pd.DataFrame(rows, columns=["donor", "dtype", "max_abs_error",
+                                         "max_correlation_error", "mean_correlation_error"])
+    print report.to_string(index=False)
+    return report
+
+def _max_rss_mb():
+    import resource
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on OS X, kilobytes elsewhere
+    return max_rss / 2.0 ** (20 if sys.platform == "darwin" else 10)
+
+def _scan_store(store_dir, chunksize=2000):
+    """Streams every probe of every donor of a store in chunks of chunksize
+    probes. Returns the time taken and how much the scan raised the peak
+    memory of the process (MB)."""
+    baseline = _max_rss_mb()
+    start = time.time()
+    for donor, entry, partition in _read_store(store_dir):
+        for chunk in iter_partition(partition, entry.get("dtype", "float32"),
+                                    chunksize=chunksize):
+            pass
+    return time.time() - start, _max_rss_mb() - baseline
+
+def benchmark_store(store_dir, chunksize=2000):
+    """Times a genome-wide scan (reading every probe of every donor) of a
+    donor partitioned store. The scan streams the partitions in chunks of
+    chunksize probes (see alleninf.api.iter_partition), so a quantized store
+    is only dequantized one chunk at a time. It runs in a new Python process
+    and the reported memory is the measured rise of its peak resident set
+    size during the scan. Also reports the size of the partitions on
+    disk."""
+    disk_bytes = sum(os.path.getsize(partition) for _, _, partition in _read_store(store_dir))
+    code = ("import sys, json; from alleninf.utils import _scan_store; "
+            "print json.dumps(_scan_store(sys.argv[1], int(sys.argv[2])))")
+    output = subprocess.check_output([sys.executable, "-c", code, store_dir, str(chunksize)])
+    scan_seconds, peak_mb = json.loads(output.strip().splitlines()[-1])
+    result = {"store": store_dir,
+              "disk_mb": disk_bytes / 2.0 ** 20,
+              "peak_mb": peak_mb,
+              "scan_seconds": scan_seconds}
+    print "%(store)s: %(disk_mb).1f MB on disk, scan took %(peak_mb).1f MB of peak memory and %(scan_seconds).2f s" % result
+    return result
+
+def build_gene_expression_matrices(probes_file, hdf_file=None, output_dir=None,
+                                   methods=("average", "pca", "max_variance")):
+    """Collapses every probe in the expression store to its gene and saves
+    a genes x wells matrix for each probe reduction method. probes_file is the
+    Probes.csv file distributed with the Allen microarray data. hdf_file is a
+    single file HDF5 store; by default the installed store (donor partitioned
+    if available) is used. Each matrix is saved as gene_expression_<method>.npy
+    (memory mappable) with a gene_expression_<method>.json file describing
+    genes, wells and the store it was built from. By default the matrices are
+    saved next to the store."""
+    if hdf_file is not None:
+        if output_dir is None:
+            output_dir = os.path.dirname(os.path.abspath(hdf_file))
+        h_handle = open_file(hdf_file, "r")
+        donors = [g._v_name for g in list(h_handle.walk_groups("/"))[1:]]
+        h_handle.close()
+        partitions = ((donor, pd.read_hdf(hdf_file, donor)) for donor in donors)
+        source = {"path": os.path.abspath(hdf_file),
+                  "size": os.path.getsize(hdf_file),
+                  "mtime": os.path.getmtime(hdf_file)}
+    else:
+        if output_dir is None:
+            output_dir = os.path.dirname(get_store_dir())
+        partitions = read_donor_expression()
+        source = {"store_version": store_version()}
+
+    expression_values = []
+    well_ids = []
+    donor_names = []
+    probe_ids = None
+    for donor, df in partitions:
+        print "reading donor %s" % donor
+        if probe_ids is None:
+            probe_ids = df.index
+        else:
+            df = df.loc[probe_ids]
+        well_ids += [int(col[len("well_id_"):]) for col in df.columns]
+        donor_names += [donor, ] * len(df.columns)
+        expression_values.append(df.values.astype(np.float32))
+    expression_values = np.concatenate(expression_values, axis=1)
+
+    probes = pd.read_csv(probes_file, index_col="probe_id")
+    gene_symbols = probes["gene_symbol"].reindex(probe_ids)
+    known = np.asarray(gene_symbols.notnull())
+    genes, gene_codes = np.unique(np.asarray(gene_symbols[known], dtype=str),
+                                  return_inverse=True)
+    expression_values = expression_values[known]
+    print "collapsing %d probes into %d genes" % (known.sum(), len(genes))
+
+    meta = {"format_version": GENE_MATRIX_FORMAT_VERSION,
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "source": source,
+            "genes": list(genes),
+            "well_ids": well_ids,
+            "donor_names": donor_names}
+    stability = None
+    if "differential_stability" in methods or "stability_weighted" in methods:
+        stability = load_probe_quality()["differential_stability"].reindex(
+            np.asarray(probe_ids)[known]).values
+    for method in methods:
+        print "computing gene expression matrix (%s)" % method
+        reduced = reduce_probes_to_genes(expression_values, gene_codes,
+                                         len(genes), method=method, stability=stability)
+        base = os.path.join(output_dir, "gene_expression_%s" % method)
+        np.save(base + ".npy", reduced)
+        meta["method"] = method
+        with open(base + ".json", "w") as f:
+            json.dump(meta, f)
+
+def _well_regions(region_size=20, atlas_file=None):
+    """Region code of every well: the atlas parcel containing it or, without
+    an atlas, the cube of region_size mm of the MNI grid it falls in.
+    Returns a Series indexed by well id (-1 for wells outside of the atlas)
+    and the number of regions."""
+    if atlas_file:
+        regions = get_well_parcels_table(atlas_file) - 1
+        return regions, max(regions.max() + 1, 0)
+    index = get_well_index()
+    cells = np.floor(index.coordinates / region_size).astype(np.int64)
+    _, regions = np.unique(cells, axis=0, return_inverse=True)
+    return pd.Series(regions, index=index.well_ids), regions.max() + 1
+
+def _paired_correlations(a, b):
+    """Row by row Pearson correlations of two matrices using the columns
+    present (not NaN) in both. The sums are accumulated in double precision,
+    so the result does not depend on the precision or memory layout of the
+    region averages."""
+    valid = np.logical_and(~np.isnan(a), ~np.isnan(b))
+    a = np.where(valid, a, 0).astype(np.float64)
+    b = np.where(valid, b, 0).astype(np.float64)
+    n = valid.sum(axis=1)
+    sa, sb = a.sum(axis=1), b.sum(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        cov = (a * b).sum(axis=1) - sa * sb / n
+        r = cov / np.sqrt(((a * a).sum(axis=1) - sa * sa / n) *
+                          ((b * b).sum(axis=1) - sb * sb / n))
+    r[n < 3] = np.nan
+    return r
+
+def build_probe_quality_table(region_size=20, atlas_file=None, output_dir=None,
+                              chunk_size=5000):
+    """Computes quality metrics of every probe in the expression store and
+    saves them as probe_quality.h5 (a table indexed by probe id, see
+    alleninf.api.load_probe_quality). By default the table is saved next to
+    the store.
+
+    differential_stability is the correlation of the region averages of a
+    probe between two donors, averaged over all pairs of donors (Hawrylycz
+    et al. 2015). Regions are the parcels of atlas_file or, without an
+    atlas, cubes of region_size mm. The table also holds the mean, standard
+    deviation and number of wells with a value of each probe across all
+    donors."""
+    if output_dir is None:
+        output_dir = os.path.dirname(get_store_dir())
+    well_regions, n_regions = _well_regions(region_size, atlas_file)
+    region_means = []
+    stats = []
+    chunks = iter_donor_expression(chunksize=chunk_size)
+    for donor, donor_chunks in groupby(chunks, key=itemgetter(0)):
+        print "averaging regions of donor %s" % donor
+        means = []
+        donor_stats = []
+        for _, df in donor_chunks:
+            well_ids = [int(col[len("well_id_"):]) for col in df.columns]
+            regions = well_regions.reindex(well_ids).fillna(-1).values.astype(np.int64)
+            inside = regions >= 0
+            values = df.values.astype(np.float64)
+            means.append(pd.DataFrame(
+                aggregate_by_parcel(values[:, inside], regions[inside], n_regions),
+                index=df.index).astype(np.float32))
+            valid = ~np.isnan(values)
+            values[~valid] = 0
+            donor_stats.append(pd.DataFrame({"sums": values.sum(axis=1),
+                                             "squares": (values * values).sum(axis=1),
+                                             "counts": valid.sum(axis=1)},
+                                            index=df.index))
+        region_means.append(pd.concat(means))
+        stats.append(pd.concat(donor_stats))
+    # probes are ordered as in the first donor, the others are aligned to it
+    probe_ids = region_means[0].index
+    region_means = [donor_means.reindex(probe_ids).values for donor_means in region_means]
+    totals = sum(donor_stats.reindex(probe_ids).fillna(0) for donor_stats in stats)
+    sums, squares, counts = (totals[column].values for column in ["sums", "squares", "counts"])
+
+    print "correlating region averages of %d pairs of donors" % (
+        len(region_means) * (len(region_means) - 1) / 2)
+    correlations = [_paired_correlations(region_means[i], region_means[j])
+                    for i in range(len(region_means)) for j in range(i)]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = sums / counts
+        std = np.sqrt(squares / counts - mean * mean)
+    quality = pd.DataFrame({"differential_stability": _nanmean_rows(correlations),
+                            "mean": mean, "std": std, "n_wells": counts.astype(np.int64)},
+                           index=pd.Index(np.asarray(probe_ids, dtype=np.int64), name="probe_id"),
+                           columns=["differential_stability", "mean", "std", "n_wells"])
+    path = os.path.join(output_dir, "probe_quality.h5")
+    quality.to_hdf(path + ".tmp", "quality", mode="w", format="table")
+    os.rename(path + ".tmp", path)
+    return quality
+
+def _nanmean_rows(rows):
+    if not rows:
+        return np.nan
+    rows = np.array(rows)
+    n = (~np.isnan(rows)).sum(axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(n > 0, np.nansum(rows, axis=0) / n, np.nan)
+
+def build_well_annotations(donors_dir, output_file=None):
+    """Builds the well annotation index from SampleAnnot.csv and Ontology.csv
+    of every donor subdirectory of donors_dir. For each well it records the
+    donor, the sampled structure (id, acronym and name), the paths from the
+    root of the ontology to that structure (as ids and as acronyms) and the
+    hemisphere (from the ontology or, where it does not say, the sign of the
+    corrected MNI x coordinate). By default the index is saved in the
+    alleninf data directory, where alleninf.anatomy looks for it before the
+    copy shipped with the package."""
+    if output_file is None:
+        output_file = _annotations_path(create_dir=True)
+    frames = []
+    for annot_file in sorted(glob(os.path.join(donors_dir, "*", "SampleAnnot.csv"))):
+        donor_dir = os.path.dirname(annot_file)
+        samples = pd.read_csv(annot_file)
+        ontology = pd.read_csv(os.path.join(donor_dir, "Ontology.csv"), index_col="id")
+        structures = ontology.loc[samples.structure_id]
+        acronym_paths = ["/%s/" % "/".join(ontology.acronym.reindex(
+            [int(i) for i in path.strip("/").split("/")]).fillna("?"))
+            for path in structures.structure_id_path]
+        frames.append(pd.DataFrame({
+            "donor": os.path.basename(os.path.normpath(donor_dir)),
+            "structure_id": samples.structure_id.values,
+            "structure_acronym": structures.acronym.values,
+            "structure_name": structures.name.values,
+            "structure_id_path": structures.structure_id_path.values,
+            "structure_acronym_path": acronym_paths,
+            "hemisphere": structures.hemisphere.values if "hemisphere" in structures else None},
+            index=pd.Index(samples.well_id.values, name="well_id"),
+            columns=["donor", "structure_id", "structure_acronym", "structure_name",
+                     "structure_id_path", "structure_acronym_path", "hemisphere"]))
+    annotations = pd.concat(frames)
+
+    index = get_well_index()
+    x = pd.Series(index.coordinates[:, 0], index=index.well_ids).reindex(annotations.index)
+    unknown = ~annotations.hemisphere.isin(["L", "R"])
+    annotations.loc[unknown, "hemisphere"] = np.where(
+        x[unknown] < 0, "L", np.where(x[unknown] > 0, "R", ""))
+    annotations.to_csv(output_file)
+    print "annotated %d wells of %d donors" % (len(annotations), len(frames))
+    return annotations
+
 if __name__ == '__main__':
     data_dir='../../../papers/beyond_blobs/data/donors'
     allen_csv_to_hdf(data_dir)
@@ -0,0 +1,85 @@
+import numpy as np
+import pandas as pd
+
+
+def _float_column(values):
+    # keep float32/float64 inputs as they are, without copying
+    values = np.asarray(values)
+    if values.dtype.kind != "f":
+        values = values.astype(np.float64)
+    return values
+
+
+class WellTable(object):
+    """Aligned columns describing the wells (or parcels) entering an analysis.
+
+    map_values and expression_values are float arrays, donors are stored as
+    integer codes (donor_codes) into the donors lookup array. well_ids and
+    coordinates (n x 3) are optional and kept aligned with the other columns.
+    map_label and expression_label are used when reporting and plotting."""
+
+    def __init__(self, map_values, expression_values, donor_codes, donors,
+                 well_ids=None, coordinates=None, map_label="NIFTI values",
+                 expression_label="expression"):
+        self.map_values = _float_column(map_values)
+        self.expression_values = _float_column(expression_values)
+        self.donor_codes = np.asarray(donor_codes, dtype=np.intp)
+        self.donors = np.asarray(donors)
+        self.well_ids = None if well_ids is None else np.asarray(well_ids)
+        self.coordinates = None if coordinates is None else np.asarray(coordinates, dtype=np.float64)
+        self.map_label = map_label
+        self.expression_label = expression_label
+        n = len(self.map_values)
+        for name in ["expression_values", "donor_codes", "well_ids", "coordinates"]:
+            column = getattr(self, name)
+            if column is not None and len(column) != n:
+                raise Exception("Column %s has %d rows instead of %d" % (name, len(column), n))
+
+    @classmethod
+    def from_wells(cls, map_values, expression_values, donor_names, **kwargs):
+        """Builds the table from per well donor names, encoding them as
+        integer codes."""
+        donors, donor_codes = np.unique(np.asarray(donor_names), return_inverse=True)
+        return cls(map_values, expression_values, donor_codes, donors, **kwargs)
+
+    def __len__(self):
+        return len(self.map_values)
+
+    @property
+    def n_donors(self):
+        return len(self.donors)
+
+    @property
+    def donor_names(self):
+        return self.donors[self.donor_codes]
+
+    def with_expression(self, expression_values, expression_label):
+        """Returns a table sharing all columns except the expression values."""
+        return WellTable(self.map_values, expression_values, self.donor_codes,
+                         self.donors, well_ids=self.well_ids,
+                         coordinates=self.coordinates, map_label=self.map_label,
+                         expression_label=expression_label)
+
+    def select(self, rows):
+        """Returns a table restricted to the given rows (boolean mask or
+        indices)."""
+        return WellTable(self.map_values[rows], self.expression_values[rows],
+                         self.donor_codes[rows], self.donors,
+                         well_ids=None if self.well_ids is None else self.well_ids[rows],
+                         coordinates=None if self.coordinates is None else self.coordinates[rows],
+                         map_label=self.map_label,
+                         expression_label=self.expression_label)
+
+    def dropna(self):
+        """Returns the table without rows missing map or expression values."""
+        valid = ~(np.isnan(self.map_values) | np.isnan(self.expression_values))
+        if valid.all():
+            return self
+        return self.select(valid)
+
+    def to_dataframe(self, group_label="donor ID"):
+        """DataFrame view used for plotting."""
+        return pd.DataFrame({self.map_label: self.map_values,
+                             self.expression_label: self.expression_values,
+                             group_label: self.donor_names},
+                            columns=[self.map_label, self.expression_label, group_label])
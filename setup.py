@@ -67,7 +67,7 @@ setup(
     # installed, specify them here.  If using Python 2.6 or less, then these
     # have to be included in MANIFEST.in as well.
     package_data={
-        'alleninf': ['data/corrected_mni_coordinates.csv'],
+        'alleninf': ['data/*.csv'],
     },
 
     # To provide executable scripts, use entry points in preference to the
@@ -76,6 +76,10 @@ setup(
     entry_points={
         'console_scripts': [
             'alleninf=alleninf.scripts:main',
+            'alleninf_genesets=alleninf.scripts:gene_sets_main',
+            'alleninf_jobs=alleninf.scripts:jobs_main',
+            'alleninf_correlation_matrix=alleninf.scripts:correlation_matrix_main',
+            'alleninf_expression_maps=alleninf.scripts:expression_maps_main',
         ],
     },
 )
\ No newline at end of file
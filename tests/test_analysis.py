@@ -0,0 +1,42 @@
+import unittest
+
+import numpy as np
+from scipy.stats import linregress
+
+from alleninf.analysis import donor_slopes
+from alleninf.welltable import WellTable
+
+
+class DonorSlopesTest(unittest.TestCase):
+
+    def check(self, map_values, expression_values, donor_names, n_donors=None):
+        table = WellTable.from_wells(map_values, expression_values, donor_names)
+        if n_donors is not None:
+            # donors without wells (e.g. after masking) are skipped
+            table = WellTable(table.map_values, table.expression_values, table.donor_codes,
+                              list(table.donors) + ["empty"] * (n_donors - table.n_donors))
+        expected = [linregress(map_values[donor_names == donor],
+                               expression_values[donor_names == donor])[0]
+                    for donor in np.unique(donor_names)]
+        np.testing.assert_allclose(donor_slopes(table), expected, rtol=1e-7)
+
+    def test_against_linregress(self):
+        random_state = np.random.RandomState(0)
+        donor_names = np.repeat(["d1", "d2", "d3", "d4"], [20, 35, 50, 15])
+        donor_names = donor_names[random_state.permutation(len(donor_names))]
+        map_values = random_state.randn(len(donor_names))
+        expression_values = 0.5 * map_values + random_state.randn(len(donor_names))
+        self.check(map_values, expression_values, donor_names)
+        self.check(map_values, expression_values, donor_names, n_donors=6)
+
+    def test_large_offset(self):
+        # raw moments lose most digits of the slope here
+        random_state = np.random.RandomState(1)
+        donor_names = np.repeat(["d1", "d2", "d3"], [40, 50, 30])
+        map_values = 1e5 + 0.01 * random_state.randn(len(donor_names))
+        expression_values = 40 * (map_values - 1e5) + 0.01 * random_state.randn(len(donor_names)) + 7
+        self.check(map_values, expression_values, donor_names)
+
+
+if __name__ == "__main__":
+    unittest.main()
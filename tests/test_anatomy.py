@@ -0,0 +1,47 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import pandas as pd
+
+from alleninf import anatomy
+
+
+class WellAnnotationsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.old_data_dir = os.environ.get("ALLENINF_DATA")
+        os.environ["ALLENINF_DATA"] = self.data_dir
+        anatomy._well_masks.clear()
+
+    def tearDown(self):
+        anatomy._well_masks.clear()
+        if self.old_data_dir is None:
+            del os.environ["ALLENINF_DATA"]
+        else:
+            os.environ["ALLENINF_DATA"] = self.old_data_dir
+        shutil.rmtree(self.data_dir)
+
+    def test_data_directory_is_preferred(self):
+        annotations_file = os.path.join(self.data_dir, "microarray_expression",
+                                        "well_annotations.csv")
+        os.makedirs(os.path.dirname(annotations_file))
+        pd.DataFrame({
+            "donor": ["d1"] * 4,
+            "structure_id": [3, 4, 5, 4],
+            "structure_acronym": ["L", "Cx", "CB", "Cx"],
+            "structure_name": ["left cortex", "cortex", "cerebellum", "cortex"],
+            "structure_id_path": ["/1/2/3/", "/1/2/4/", "/1/5/", "/1/2/4/"],
+            "structure_acronym_path": ["/Br/Cx/L/", "/Br/Cx/Cx4/", "/Br/CB/", "/Br/Cx/Cx4/"],
+            "hemisphere": ["L", "R", "L", "L"]},
+            index=pd.Index([10, 11, 12, 13], name="well_id")).to_csv(annotations_file)
+        self.assertEqual(anatomy.get_annotations_file(), annotations_file)
+        self.assertEqual(list(anatomy.select_wells("Cx")), [10, 11, 13])
+        self.assertEqual(list(anatomy.select_wells("Cx,left")), [10, 13])
+        self.assertEqual(list(anatomy.select_wells("-CB,-4")), [10])
+
+
+if __name__ == "__main__":
+    unittest.main()
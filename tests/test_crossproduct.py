@@ -0,0 +1,103 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+import nibabel as nb
+import tables
+from scipy.stats import pearsonr
+
+from alleninf import api
+from alleninf.crossproduct import correlate_tile, correlation_matrix
+
+
+class CorrelateTileTest(unittest.TestCase):
+
+    def test_against_pearsonr(self):
+        random_state = np.random.RandomState(0)
+        map_values = random_state.randn(5, 80)
+        map_values[random_state.rand(5, 80) < 0.2] = np.nan
+        expression = random_state.randn(7, 80) + 3
+        correlations = correlate_tile(map_values, expression)
+        self.assertEqual(correlations.shape, (5, 7))
+        for i in range(5):
+            valid = ~np.isnan(map_values[i])
+            for j in range(7):
+                r, _ = pearsonr(map_values[i, valid], expression[j, valid])
+                self.assertAlmostEqual(correlations[i, j], r, places=5)
+
+
+class CorrelationMatrixTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.old_data_dir = os.environ.get("ALLENINF_DATA")
+        os.environ["ALLENINF_DATA"] = self.tmp_dir
+        random_state = np.random.RandomState(0)
+        package_directory = os.path.dirname(os.path.abspath(api.__file__))
+        well_ids = [int(well_id) for well_id in pd.read_csv(os.path.join(
+            package_directory, "data", "corrected_mni_coordinates.csv"), index_col=0).index[:300]]
+        os.makedirs(os.path.join(self.tmp_dir, "microarray_expression"))
+        self.expression = random_state.randn(20, len(well_ids)).astype(np.float32)
+        for method in ["average", "pca"]:
+            self.save_matrix(method, self.expression, well_ids, "now")
+        affine = np.diag([-2., 2., 2., 1.])
+        affine[:3, 3] = [90, -126, -72]
+        self.maps = []
+        for i in range(3):
+            path = os.path.join(self.tmp_dir, "map%d.nii.gz" % i)
+            nb.save(nb.Nifti1Image(random_state.randn(91, 109, 91).astype(np.float32), affine), path)
+            self.maps.append(path)
+        self.output = os.path.join(self.tmp_dir, "cm.h5")
+
+    def save_matrix(self, method, expression, well_ids, created):
+        base = os.path.join(self.tmp_dir, "microarray_expression", "gene_expression_%s" % method)
+        np.save(base + ".npy", expression)
+        with open(base + ".json", "w") as f:
+            json.dump({"format_version": api.GENE_MATRIX_FORMAT_VERSION,
+                       "created": created, "source": {}, "method": method,
+                       "genes": ["G%d" % i for i in range(20)], "well_ids": well_ids,
+                       "donor_names": ["donor"] * len(well_ids)}, f)
+        api._gene_matrix_cache.clear()
+
+    def tearDown(self):
+        api._gene_matrix_cache.clear()
+        if self.old_data_dir is None:
+            del os.environ["ALLENINF_DATA"]
+        else:
+            os.environ["ALLENINF_DATA"] = self.old_data_dir
+        shutil.rmtree(self.tmp_dir)
+
+    def test_resume_checks_settings(self):
+        correlation_matrix(self.maps, self.output, max_memory=2 ** 16)
+        h5 = tables.open_file(self.output)
+        try:
+            map_values = h5.root.map_values[:]
+            correlations = h5.root.correlations[:]
+            self.assertTrue(h5.root.tile_done[:].all())
+        finally:
+            h5.close()
+        np.testing.assert_allclose(correlations, correlate_tile(map_values, self.expression),
+                                   rtol=1e-5)
+        # the same settings resume (nothing left to do)
+        correlation_matrix(self.maps, self.output, max_memory=2 ** 16)
+        for kwargs in [{"method": "pca"}, {"radius": 2}, {"mask_file": self.maps[0]}]:
+            self.assertRaisesRegexp(Exception, "was computed with a different",
+                                    correlation_matrix, self.maps, self.output,
+                                    max_memory=2 ** 16, **kwargs)
+        # a matrix rebuilt with the same genes, first with new values and
+        # then without one of the wells
+        well_ids = [int(well_id) for well_id in api.load_gene_expression_matrix().well_ids]
+        self.save_matrix("average", self.expression + 1, well_ids, "later")
+        self.assertRaisesRegexp(Exception, "different matrix_version;", correlation_matrix,
+                                self.maps, self.output, max_memory=2 ** 16)
+        self.save_matrix("average", self.expression[:, 1:], well_ids[1:], "now")
+        self.assertRaisesRegexp(Exception, "different n_wells;", correlation_matrix,
+                                self.maps, self.output, max_memory=2 ** 16)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,189 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import numpy.linalg as npl
+import pandas as pd
+import nibabel as nb
+
+from alleninf import api
+from alleninf.data import combine_expression_values, reduce_probes_to_genes,\
+    get_sphere, get_values_at_locations
+from alleninf.utils import add_donor_partition
+
+
+def _probe_frame(probe_ids, well_ids, random_state):
+    return pd.DataFrame(random_state.randn(len(probe_ids), len(well_ids)).astype(np.float32),
+                        index=pd.Index(probe_ids, name="probe_id"),
+                        columns=["well_id_%d" % well_id for well_id in well_ids])
+
+
+def _stability_reference(expression_values, method, stability):
+    """Per gene reference of the stability based reductions."""
+    if method == "differential_stability":
+        return expression_values[np.argmax(np.where(np.isnan(stability), -np.inf, stability))]
+    weights = np.clip(np.nan_to_num(stability), 0, None)
+    if weights.sum() == 0:
+        weights = np.ones(len(weights))
+    return np.average(expression_values, axis=0, weights=weights)
+
+
+class ProbeStabilityTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.old_data_dir = os.environ.get("ALLENINF_DATA")
+        os.environ["ALLENINF_DATA"] = self.data_dir
+        random_state = np.random.RandomState(0)
+        probe_ids = [1005, 1100, 1200, 1300]
+        self.frames = {}
+        for donor, wells in [("donor1", range(10)), ("donor2", range(10, 25))]:
+            self.frames[donor] = _probe_frame(probe_ids, wells, random_state)
+            add_donor_partition(api.get_store_dir(), donor, self.frames[donor])
+        quality = pd.DataFrame({"differential_stability": [0.1, 0.2, 0.9, np.nan]},
+                               index=pd.Index(probe_ids, name="probe_id"))
+        quality.to_hdf(api._probe_quality_path(), "quality")
+        api._probe_quality_cache.clear()
+
+    def tearDown(self):
+        api._probe_quality_cache.clear()
+        if self.old_data_dir is None:
+            del os.environ["ALLENINF_DATA"]
+        else:
+            os.environ["ALLENINF_DATA"] = self.old_data_dir
+        shutil.rmtree(self.data_dir)
+
+    def expected(self, probe_id):
+        return np.concatenate([self.frames[donor].loc[probe_id].values
+                               for donor in ["donor1", "donor2"]])
+
+    def test_reader_follows_requested_order(self):
+        values, well_ids, donor_names, probe_ids = \
+            api.get_expression_values_from_probe_ids_hdf([1200, 1005, 1100, 99999])
+        self.assertEqual(probe_ids, [1200, 1005, 1100])
+        self.assertEqual(well_ids, list(range(25)))
+        for row, probe_id in zip(values, probe_ids):
+            np.testing.assert_array_equal(row, self.expected(probe_id))
+
+    def test_differential_stability_picks_most_stable_probe(self):
+        values, _, _, probe_ids = \
+            api.get_expression_values_from_probe_ids_hdf([1200, 1005, 1100, 99999])
+        combined = combine_expression_values(values, method="differential_stability",
+                                             probe_ids=probe_ids)
+        np.testing.assert_allclose(combined, self.expected(1200), rtol=1e-6)
+
+    def test_stability_weighted(self):
+        values, _, _, probe_ids = \
+            api.get_expression_values_from_probe_ids_hdf([1100, 1300, 1005])
+        combined = combine_expression_values(values, method="stability_weighted",
+                                             probe_ids=probe_ids)
+        # the probe without a stability gets no weight
+        expected = (0.2 * self.expected(1100) + 0.1 * self.expected(1005)) / 0.3
+        np.testing.assert_allclose(combined, expected, rtol=1e-5)
+
+
+class ReduceProbesToGenesTest(unittest.TestCase):
+
+    def test_against_per_gene_reduction(self):
+        random_state = np.random.RandomState(2)
+        gene_codes = random_state.randint(0, 20, 100)
+        expression_values = (random_state.randn(100, 30) + 5).astype(np.float32)
+        for method in ["average", "pca", "max_variance"]:
+            reduced = reduce_probes_to_genes(expression_values, gene_codes, 21, method=method)
+            self.assertTrue(np.isnan(reduced[20]).all())
+            for gene in np.unique(gene_codes):
+                expected = np.array(combine_expression_values(
+                    expression_values[gene_codes == gene], method=method))
+                if method == "pca":
+                    # the sign of a principal component is arbitrary
+                    expected *= np.sign(np.dot(expected, reduced[gene]))
+                np.testing.assert_allclose(reduced[gene], expected, rtol=1e-4, atol=1e-5)
+
+
+class ReduceProbesToGenesStabilityTest(unittest.TestCase):
+
+    def test_against_per_gene_reduction(self):
+        random_state = np.random.RandomState(1)
+        gene_codes = random_state.randint(0, 20, 100)
+        expression_values = random_state.randn(100, 30).astype(np.float32)
+        stability = random_state.uniform(-0.5, 1, 100)
+        stability[random_state.rand(100) < 0.1] = np.nan
+        for method in ["differential_stability", "stability_weighted"]:
+            reduced = reduce_probes_to_genes(expression_values, gene_codes, 21,
+                                             method=method, stability=stability)
+            self.assertTrue(np.isnan(reduced[20]).all())
+            for gene in np.unique(gene_codes):
+                probes = gene_codes == gene
+                np.testing.assert_allclose(
+                    reduced[gene],
+                    _stability_reference(expression_values[probes], method,
+                                         stability[probes]),
+                    rtol=1e-4, atol=1e-5)
+
+
+def _sample_per_location(data, affine, mask, locations, radius):
+    """Per location reference of get_values_at_locations."""
+    values = []
+    zooms = np.sqrt((affine[:3, :3] ** 2).sum(axis=0))
+    for location in locations:
+        coord_data = [round(i) for i in nb.affines.apply_affine(npl.inv(affine), location)]
+        sph_mask = np.zeros(mask.shape, dtype=bool)
+        if radius:
+            sph_mask[tuple(get_sphere(coord_data, vox_dims=zooms, r=radius, dims=mask.shape).T)] = True
+        elif all(0 <= c < n for c, n in zip(coord_data, mask.shape)):
+            sph_mask[tuple(int(c) for c in coord_data)] = True
+        roi = np.logical_and(mask, sph_mask)
+        values.append(data[roi].mean() if np.any(roi) else np.nan)
+    return values
+
+
+class ValuesAtLocationsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        random_state = np.random.RandomState(0)
+        self.affine = np.diag([-2., 2., 2., 1.])
+        self.affine[:3, 3] = [40, -40, -30]
+        self.data = random_state.randn(40, 40, 30).astype(np.float32)
+        self.data[random_state.rand(40, 40, 30) < 0.3] = 0
+        self.map_file = os.path.join(self.tmp_dir, "map.nii.gz")
+        nb.save(nb.Nifti1Image(self.data, self.affine), self.map_file)
+        # including locations outside of the map and on voxel boundaries
+        self.locations = np.vstack([random_state.uniform(-45, 45, (200, 3)),
+                                    [[1, 1, 1], [0, 0, 0], [-39, 39, 29]]])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_against_per_location_sampler(self):
+        mask = self.data != 0
+        for radius in [0, 2, 4, 5.5]:
+            values = get_values_at_locations(self.map_file, self.locations, radius)
+            expected = _sample_per_location(self.data, self.affine, mask, self.locations, radius)
+            np.testing.assert_allclose(values, expected, rtol=1e-5, atol=1e-6)
+
+    def test_mask_on_another_grid(self):
+        fine = self.affine.copy()
+        fine[:3, :3] /= 2
+        fine[:3, 3] += [0.5, -0.5, -0.5]
+        fine_mask = np.zeros((80, 80, 60), dtype=np.uint8)
+        fine_mask[:40] = 1
+        mask_file = os.path.join(self.tmp_dir, "mask.nii.gz")
+        nb.save(nb.Nifti1Image(fine_mask, fine), mask_file)
+        mask = np.zeros(self.data.shape, dtype=bool)
+        mask[:20] = True
+        values = get_values_at_locations(self.map_file, self.locations, 4, mask_file=mask_file)
+        expected = _sample_per_location(self.data, self.affine, mask, self.locations, 4)
+        np.testing.assert_allclose(values, expected, rtol=1e-5, atol=1e-6)
+
+    def test_reference_grid(self):
+        values = get_values_at_locations(self.map_file, self.locations, 4,
+                                         reference_file=self.map_file)
+        expected = get_values_at_locations(self.map_file, self.locations, 4)
+        np.testing.assert_array_equal(values, expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,205 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+import unittest
+import BaseHTTPServer
+import SocketServer
+
+from alleninf import datasets
+
+
+class _RangeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves server.content, honouring byte ranges unless
+    server.ignore_ranges is set. With server.truncate set, ranged responses
+    stop after that many bytes."""
+
+    def log_message(self, *args):
+        pass
+
+    def _range(self):
+        header = self.headers.getheader("Range")
+        if not header or self.server.ignore_ranges:
+            return None
+        start, end = header[len("bytes="):].split("-")
+        end = int(end) if end else len(self.server.content) - 1
+        return int(start), min(end, len(self.server.content) - 1)
+
+    def _send_headers(self):
+        content = self.server.content
+        byte_range = self._range()
+        if byte_range is None:
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(content)))
+            body = content
+        else:
+            start, end = byte_range
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end, len(content)))
+            self.send_header("Content-Length", str(end - start + 1))
+            body = content[start:end + 1]
+        if not self.server.ignore_ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+        return body, byte_range is not None
+
+    def do_HEAD(self):
+        if self.server.reject_head:
+            self.send_error(405)
+            return
+        self._send_headers()
+
+    def do_GET(self):
+        body, ranged = self._send_headers()
+        if ranged and self.server.truncate is not None:
+            body = body[:self.server.truncate]
+        self.wfile.write(body)
+        with self.server.lock:
+            self.server.bytes_served += len(body)
+            self.server.gets += 1
+
+
+class _RangeServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, content):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), _RangeHandler)
+        self.content = content
+        self.ignore_ranges = False
+        self.reject_head = False
+        self.truncate = None
+        self.bytes_served = 0
+        self.gets = 0
+        self.lock = threading.Lock()
+
+
+class SegmentedDownloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.content = os.urandom(3 * 2 ** 20 + 12345)
+        self.md5 = hashlib.md5(self.content).hexdigest()
+        self.server = _RangeServer(self.content)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = "http://127.0.0.1:%d/data.bin" % self.server.server_address[1]
+        self.data_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.data_dir)
+
+    def fetch(self, **kwargs):
+        return datasets._fetch_file(self.url, self.data_dir, n_segments=4,
+                                    segmented_min_size=0, **kwargs)
+
+    def check_file(self, path):
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), self.content)
+        self.assertEqual(sorted(os.listdir(self.data_dir)), ["data.bin"])
+
+    def test_md5_checked_downloads(self):
+        for _ in range(10):
+            path = self.fetch(md5sum=self.md5)
+            self.check_file(path)
+            os.remove(path)
+
+    def test_wrong_md5(self):
+        self.assertRaises(ValueError, self.fetch, md5sum="0" * 32)
+        self.assertFalse(os.path.exists(os.path.join(self.data_dir, "data.bin")))
+
+    def test_interrupted_and_resumed(self):
+        self.server.truncate = 300000
+        self.assertRaises(IOError, self.fetch, md5sum=self.md5)
+        part = os.path.join(self.data_dir, "data.bin.part")
+        with open(part + ".segments") as f:
+            state = json.load(f)
+        self.assertEqual(len(state["segments"]), 4)
+        self.assertTrue(all(done > 0 for _, _, done in state["segments"]))
+
+        self.server.truncate = None
+        served = self.server.bytes_served
+        path = self.fetch(md5sum=self.md5)
+        self.check_file(path)
+        # only the missing bytes of every segment were fetched again
+        resumed = self.server.bytes_served - served
+        self.assertEqual(resumed, len(self.content) -
+                         sum(done for _, _, done in state["segments"]))
+
+    def test_server_ignoring_ranges(self):
+        self.server.ignore_ranges = True
+        path = self.fetch(md5sum=self.md5)
+        self.check_file(path)
+        self.assertEqual(self.server.gets, 1)
+
+    def test_server_rejecting_head(self):
+        self.server.reject_head = True
+        path = self.fetch(md5sum=self.md5)
+        self.check_file(path)
+        self.assertEqual(self.server.gets, 1)
+
+
+class StoreFetchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.remote_dir = tempfile.mkdtemp()
+        self.data_dir = tempfile.mkdtemp()
+        self.url = "file://" + self.remote_dir
+
+    def tearDown(self):
+        shutil.rmtree(self.remote_dir)
+        shutil.rmtree(self.data_dir)
+
+    def publish(self, partitions, format_version=1):
+        manifest = {"format_version": format_version, "donors": {}}
+        for donor, content in partitions.items():
+            with open(os.path.join(self.remote_dir, donor + ".h5"), "wb") as f:
+                f.write(content)
+            manifest["donors"][donor] = {"file": donor + ".h5",
+                                         "md5": hashlib.md5(content).hexdigest()}
+        with open(os.path.join(self.remote_dir, "manifest.json"), "w") as f:
+            json.dump(manifest, f)
+
+    def local_manifest(self, store_dir):
+        with open(os.path.join(store_dir, "manifest.json")) as f:
+            return json.load(f)
+
+    def test_update(self):
+        self.publish({"a": "first a", "b": "first b", "c": "first c"})
+        store_dir = datasets.fetch_microarray_expression_store(self.url, data_dir=self.data_dir)
+        self.assertEqual(sorted(self.local_manifest(store_dir)["donors"]), ["a", "b", "c"])
+        mtime = os.path.getmtime(os.path.join(store_dir, "a.h5"))
+
+        # b changes and c is dropped from the remote store
+        os.remove(os.path.join(self.remote_dir, "c.h5"))
+        self.publish({"a": "first a", "b": "second b"})
+        datasets.fetch_microarray_expression_store(self.url, data_dir=self.data_dir)
+        manifest = self.local_manifest(store_dir)
+        self.assertEqual(sorted(manifest["donors"]), ["a", "b"])
+        self.assertEqual(manifest["format_version"], 1)
+        self.assertEqual(os.path.getmtime(os.path.join(store_dir, "a.h5")), mtime)
+        with open(os.path.join(store_dir, "b.h5")) as f:
+            self.assertEqual(f.read(), "second b")
+        self.assertFalse(os.path.exists(os.path.join(store_dir, "c.h5")))
+        self.assertFalse([name for name in os.listdir(store_dir) if name.endswith(".tmp")])
+
+    def test_selected_donors_keep_the_others(self):
+        self.publish({"a": "first a", "b": "first b"})
+        store_dir = datasets.fetch_microarray_expression_store(self.url, data_dir=self.data_dir)
+        self.publish({"a": "second a"})
+        datasets.fetch_microarray_expression_store(self.url, data_dir=self.data_dir,
+                                                   donors=["a"])
+        self.assertEqual(sorted(self.local_manifest(store_dir)["donors"]), ["a", "b"])
+        self.assertTrue(os.path.exists(os.path.join(store_dir, "b.h5")))
+
+    def test_newer_store_is_refused(self):
+        self.publish({"a": "first a"}, format_version=99)
+        self.assertRaises(IOError, datasets.fetch_microarray_expression_store, self.url,
+                          data_dir=self.data_dir)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,149 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+import nibabel as nb
+
+from alleninf import api
+from alleninf.expression_maps import get_voxel_neighbors, interpolation_weights,\
+    expression_maps
+
+
+def _brute_force(xyz, coordinates, values, method, k, max_distance=None, power=2, fwhm=6):
+    """Per voxel reference: weighted mean of the k nearest wells (closer than
+    max_distance) with values."""
+    distances = np.sqrt(((coordinates - xyz) ** 2).sum(axis=1))
+    nearest = np.argsort(distances, kind="mergesort")[:1 if method == "nearest" else k]
+    if max_distance is not None:
+        nearest = nearest[distances[nearest] < max_distance]
+    nearest = nearest[~np.isnan(values[nearest])]
+    if not len(nearest):
+        return np.nan
+    if method == "nearest":
+        weights = np.ones(1)
+    elif method == "idw":
+        weights = 1.0 / np.maximum(distances[nearest], 1e-3) ** power
+    else:
+        sigma = fwhm / np.sqrt(8 * np.log(2))
+        weights = np.exp(-distances[nearest] ** 2 / (2 * sigma ** 2))
+    return (weights * values[nearest]).sum() / weights.sum()
+
+
+class InterpolationWeightsTest(unittest.TestCase):
+
+    def setUp(self):
+        random_state = np.random.RandomState(0)
+        self.affine = np.diag([2., 2., 2., 1.])
+        self.affine[:3, 3] = [-5, -4, -3]
+        self.mask = random_state.rand(6, 5, 4) < 0.7
+        self.coordinates = random_state.uniform(-8, 8, (30, 3))
+        self.values = random_state.randn(30)
+        ijk = np.column_stack(np.nonzero(self.mask))
+        self.xyz = nb.affines.apply_affine(self.affine, ijk)
+
+    def test_against_brute_force(self):
+        for method, k in [("nearest", 1), ("nearest", 4), ("idw", 4), ("gaussian", 5)]:
+            neighbors = get_voxel_neighbors(self.affine, self.mask, self.coordinates, k=k)
+            np.testing.assert_array_equal(neighbors.voxels, np.flatnonzero(self.mask))
+            weights = interpolation_weights(neighbors, len(self.coordinates), method=method)
+            self.assertEqual(weights.shape, (self.mask.sum(), 30))
+            estimates = weights.dot(self.values) / np.asarray(weights.sum(axis=1)).ravel()
+            expected = [_brute_force(xyz, self.coordinates, self.values, method, k)
+                        for xyz in self.xyz]
+            np.testing.assert_allclose(estimates, expected, rtol=1e-10, err_msg=method)
+
+    def test_hand_computed_weights(self):
+        # one voxel at the origin with wells 1 and 2 mm away
+        mask = np.ones((1, 1, 1), dtype=bool)
+        coordinates = [[1, 0, 0], [0, 2, 0], [10, 10, 10]]
+        neighbors = get_voxel_neighbors(np.eye(4), mask, coordinates, k=2)
+        idw = interpolation_weights(neighbors, 3, method="idw").toarray()
+        np.testing.assert_allclose(idw, [[1, 0.25, 0]])
+        gaussian = interpolation_weights(neighbors, 3, method="gaussian", fwhm=2).toarray()
+        sigma = 2 / np.sqrt(8 * np.log(2))
+        np.testing.assert_allclose(gaussian, [[np.exp(-1 / (2 * sigma ** 2)),
+                                               np.exp(-4 / (2 * sigma ** 2)), 0]])
+
+    def test_max_distance(self):
+        neighbors = get_voxel_neighbors(self.affine, self.mask, self.coordinates, k=3,
+                                        max_distance=2.5)
+        far = np.isinf(neighbors.distances)
+        self.assertTrue(far.any() and not far.all())
+        self.assertTrue((neighbors.neighbors[far] == len(self.coordinates)).all())
+        weights = interpolation_weights(neighbors, len(self.coordinates), method="idw")
+        self.assertEqual(weights.nnz, (~far).sum())
+
+
+class ExpressionMapsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.old_data_dir = os.environ.get("ALLENINF_DATA")
+        os.environ["ALLENINF_DATA"] = self.tmp_dir
+        random_state = np.random.RandomState(1)
+        package_directory = os.path.dirname(os.path.abspath(api.__file__))
+        frame = pd.read_csv(os.path.join(package_directory, "data",
+                                         "corrected_mni_coordinates.csv"), index_col=0)
+        # wells around the reference grid
+        near = (np.abs(frame.values) < 30).all(axis=1)
+        self.well_ids = [int(well_id) for well_id in frame.index[near]]
+        self.coordinates = frame.values[near].astype(np.float64)
+        self.expression = random_state.randn(5, len(self.well_ids)).astype(np.float32)
+        self.expression[random_state.rand(*self.expression.shape) < 0.3] = np.nan
+        matrix_dir = os.path.join(self.tmp_dir, "microarray_expression")
+        os.makedirs(matrix_dir)
+        base = os.path.join(matrix_dir, "gene_expression_average")
+        np.save(base + ".npy", self.expression)
+        with open(base + ".json", "w") as f:
+            json.dump({"format_version": api.GENE_MATRIX_FORMAT_VERSION, "created": "now",
+                       "source": {}, "method": "average", "genes": ["G%d" % i for i in range(5)],
+                       "well_ids": self.well_ids, "donor_names": ["d"] * len(self.well_ids)}, f)
+        api._gene_matrix_cache.clear()
+        self.affine = np.diag([6., 6., 6., 1.])
+        self.affine[:3, 3] = [-24, -24, -24]
+        reference = np.ones((9, 9, 9), dtype=np.float32)
+        reference[0] = 0
+        self.reference_file = os.path.join(self.tmp_dir, "reference.nii.gz")
+        nb.save(nb.Nifti1Image(reference, self.affine), self.reference_file)
+        self.genes = ["G3", "G0", "G4"]
+
+    def tearDown(self):
+        api._gene_matrix_cache.clear()
+        if self.old_data_dir is None:
+            del os.environ["ALLENINF_DATA"]
+        else:
+            os.environ["ALLENINF_DATA"] = self.old_data_dir
+        shutil.rmtree(self.tmp_dir)
+
+    def test_against_brute_force(self):
+        for method, max_distance in [("nearest", None), ("idw", None), ("gaussian", 8)]:
+            maps = expression_maps(self.genes, self.reference_file, method=method, k=4,
+                                   max_distance=max_distance).get_data()
+            self.assertEqual(maps.shape, (9, 9, 9, 3))
+            # voxels outside the implicit mask of the reference
+            self.assertTrue(np.isnan(maps[0]).all())
+            batched = expression_maps(self.genes, self.reference_file, method=method, k=4,
+                                      max_distance=max_distance, batch_size=2).get_data()
+            np.testing.assert_array_equal(batched, maps)
+            for ijk in [(1, 1, 1), (4, 4, 4), (8, 2, 5), (3, 7, 8), (6, 0, 2)]:
+                xyz = nb.affines.apply_affine(self.affine, ijk)
+                for position, gene in enumerate(self.genes):
+                    values = self.expression[int(gene[1:])].astype(np.float64)
+                    expected = _brute_force(xyz, self.coordinates, values, method, 4,
+                                            max_distance=max_distance)
+                    if np.isnan(expected):
+                        self.assertTrue(np.isnan(maps[ijk + (position, )]))
+                    else:
+                        self.assertAlmostEqual(maps[ijk + (position, )], expected, places=5)
+            if max_distance is not None:
+                # voxels without wells within max_distance
+                self.assertTrue(np.isnan(maps[1:]).any())
+                self.assertFalse(np.isnan(maps[1:]).all())
+
+
+if __name__ == "__main__":
+    unittest.main()
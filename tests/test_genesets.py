@@ -0,0 +1,55 @@
+import unittest
+
+import numpy as np
+from scipy import stats
+
+from alleninf.genesets import correlate_with_genes, gene_set_enrichment
+
+
+class CorrelateWithGenesTest(unittest.TestCase):
+
+    def test_against_pearsonr(self):
+        random_state = np.random.RandomState(0)
+        expression = random_state.randn(25, 60)
+        nifti_values = random_state.randn(60)
+        nifti_values[random_state.rand(60) < 0.2] = np.nan
+        valid = ~np.isnan(nifti_values)
+        correlations = correlate_with_genes(nifti_values, expression, chunk_size=7)
+        for row, correlation in zip(expression, correlations):
+            self.assertAlmostEqual(correlation, stats.pearsonr(nifti_values[valid], row[valid])[0])
+
+
+class GeneSetEnrichmentTest(unittest.TestCase):
+
+    def setUp(self):
+        # not the seed of the permutations, which would draw the same numbers
+        random_state = np.random.RandomState(1)
+        self.genes = ["gene%d" % i for i in range(1000)]
+        self.correlations = random_state.uniform(-0.5, 0.5, len(self.genes))
+        self.random_state = random_state
+
+    def test_null_calibration(self):
+        # sets unrelated to the correlations should give uniform p values
+        gene_sets = dict(("set%d" % i, list(self.random_state.choice(
+            self.genes, self.random_state.randint(5, 60), replace=False)))
+            for i in range(400))
+        results = gene_set_enrichment(self.correlations, self.genes, gene_sets,
+                                      n_permutations=2000)
+        self.assertEqual(len(results), 400)
+        self.assertTrue(0.01 < (results.p < 0.05).mean() < 0.1)
+        self.assertTrue(0.4 < results.p.median() < 0.6)
+        self.assertTrue(stats.kstest(results.p, "uniform").pvalue > 0.01)
+
+    def test_enriched_set(self):
+        top = list(np.asarray(self.genes)[np.argsort(self.correlations)[-40:]])
+        bottom = list(np.asarray(self.genes)[np.argsort(self.correlations)[:20]])
+        results = gene_set_enrichment(self.correlations, self.genes,
+                                      {"top": top[::2], "bottom": bottom, "tiny": top[:3]},
+                                      n_permutations=999)
+        self.assertEqual(list(results.index), ["top", "bottom"])
+        self.assertEqual(results.p["top"], 1 / 1000.)
+        self.assertTrue(results.score["top"] > 0 > results.score["bottom"])
+
+
+if __name__ == "__main__":
+    unittest.main()
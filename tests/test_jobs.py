@@ -0,0 +1,59 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+import nibabel as nb
+
+from alleninf import jobs
+
+
+class RunJobsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        random_state = np.random.RandomState(0)
+        affine = np.diag([-2., 2., 2., 1.])
+        affine[:3, 3] = [90, -126, -72]
+        stat_map = os.path.join(self.tmp_dir, "map.nii.gz")
+        nb.save(nb.Nifti1Image(random_state.randn(91, 109, 91).astype(np.float32), affine),
+                stat_map)
+        package_directory = os.path.dirname(os.path.abspath(jobs.__file__))
+        well_ids = list(pd.read_csv(os.path.join(
+            package_directory, "data", "corrected_mni_coordinates.csv"), index_col=0).index[:60])
+        donor_names = ["donor%d" % (i % 3) for i in range(60)]
+        for gene in ["G0", "G1"]:
+            for method in ["average", "pca"]:
+                jobs._expression[gene, method] = (random_state.randn(60), well_ids, donor_names)
+        self.manifest = os.path.join(self.tmp_dir, "manifest.csv")
+        pd.DataFrame({"stat_map": [stat_map, stat_map], "gene": ["G0", "G1"],
+                      "method": ["fixed", "approximate_random"]}).to_csv(self.manifest, index=False)
+        self.results = os.path.join(self.tmp_dir, "results.h5")
+
+    def tearDown(self):
+        jobs._expression.clear()
+        jobs._last_map.clear()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_resume_key(self):
+        tasks = jobs.read_manifest(self.manifest)
+        self.assertEqual(jobs.run_jobs(tasks, self.results, n_jobs=1), 0)
+        self.assertEqual(len(jobs.completed_tasks(self.results)), 2)
+        # the same settings skip every task
+        jobs.run_jobs(tasks, self.results, n_jobs=1)
+        self.assertEqual(len(pd.read_hdf(self.results, "results")), 2)
+        # other settings are new tasks
+        jobs.run_jobs(tasks, self.results, n_jobs=1, probes_reduction_method="pca")
+        jobs.run_jobs(tasks, self.results, n_jobs=1, n_samples=1000)
+        results = pd.read_hdf(self.results, "results")
+        self.assertEqual(len(results), 6)
+        self.assertEqual(sorted(results["probes_reduction_method"]),
+                         ["average"] * 4 + ["pca"] * 2)
+        self.assertEqual(sorted(results["n_samples"]), [1000] * 2 + [2000] * 4)
+        self.assertEqual(len(set(jobs._task_key(row) for _, row in results.iterrows())), 6)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import nibabel as nb
+
+from alleninf.parcellation import aggregate_by_parcel, get_parcel_values, get_well_parcels
+from alleninf.spatial import get_well_index
+
+
+class AggregateByParcelTest(unittest.TestCase):
+
+    def test_against_per_parcel_means(self):
+        random_state = np.random.RandomState(0)
+        values = random_state.randn(3, 200)
+        values[random_state.rand(3, 200) < 0.1] = np.nan
+        parcels = random_state.randint(0, 8, 200)
+        groups = random_state.randint(0, 2, 200)
+        means = aggregate_by_parcel(values, parcels, 10, groups=groups, n_groups=2)
+        self.assertEqual(means.shape, (3, 2, 10))
+        for row in range(3):
+            for group in range(2):
+                for parcel in range(10):
+                    selected = values[row, (parcels == parcel) & (groups == group)]
+                    selected = selected[~np.isnan(selected)]
+                    if len(selected):
+                        self.assertAlmostEqual(means[row, group, parcel], selected.mean())
+                    else:
+                        self.assertTrue(np.isnan(means[row, group, parcel]))
+
+
+class ParcelValuesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.affine = np.diag([-2., 2., 2., 1.])
+        self.affine[:3, 3] = [20, -20, -20]
+        self.data = np.arange(20 * 20 * 20, dtype=np.float32).reshape(20, 20, 20) + 1
+        self.labels = np.zeros((20, 20, 20), dtype=np.int16)
+        self.labels[:10] = 1
+        self.labels[10:] = 2
+        self.map_file = self.save(self.data, self.affine, "map.nii.gz")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def save(self, data, affine, name):
+        path = os.path.join(self.tmp_dir, name)
+        nb.save(nb.Nifti1Image(data, affine), path)
+        return path
+
+    def test_parcel_means(self):
+        atlas_file = self.save(self.labels, self.affine, "atlas.nii.gz")
+        values = get_parcel_values(self.map_file, atlas_file)
+        self.assertTrue(np.isnan(values[0]))
+        self.assertAlmostEqual(values[1], self.data[:10].mean(), places=3)
+        self.assertAlmostEqual(values[2], self.data[10:].mean(), places=3)
+
+    def test_atlas_and_mask_on_another_grid(self):
+        # 1mm versions of the 2mm atlas and of a mask covering x > 0
+        fine = self.affine.copy()
+        fine[:3, :3] /= 2
+        fine[:3, 3] += [0.5, -0.5, -0.5]
+        fine_labels = np.zeros((40, 40, 40), dtype=np.int16)
+        fine_labels[:20] = 1
+        fine_labels[20:] = 2
+        atlas_file = self.save(fine_labels, fine, "atlas.nii.gz")
+        fine_mask = np.zeros((40, 40, 40), dtype=np.uint8)
+        fine_mask[:20] = 1
+        mask_file = self.save(fine_mask, fine, "mask.nii.gz")
+        values = get_parcel_values(self.map_file, atlas_file, mask_file=mask_file)
+        self.assertAlmostEqual(values[1], self.data[:10].mean(), places=3)
+        self.assertTrue(np.isnan(values[2]))
+
+    def test_label_lost_in_resampling(self):
+        # the 1mm voxels sampled by the 2mm grid all have even indices, so a
+        # label only present at odd indices disappears
+        fine = self.affine.copy()
+        fine[:3, :3] /= 2
+        fine_labels = np.zeros((40, 40, 40), dtype=np.int16)
+        fine_labels[:20] = 1
+        fine_labels[20:] = 2
+        fine_labels[21, 21, 21] = 3
+        atlas_file = self.save(fine_labels, fine, "atlas.nii.gz")
+        values = get_parcel_values(self.map_file, atlas_file)
+        self.assertEqual(len(values), 4)
+        self.assertTrue(np.isnan(values[3]))
+        self.assertAlmostEqual(values[1], self.data[:10].mean(), places=3)
+
+        # wells of the lost parcel stay within the bins of their donor
+        parcels = np.array([3, 1, 3, 2])
+        donors = np.array([0, 0, 1, 1])
+        means = aggregate_by_parcel([1., 2., 3., 4.], parcels, len(values),
+                                    groups=donors, n_groups=2)
+        np.testing.assert_array_equal(means[:, 3], [1, 3])
+
+    def test_well_parcels(self):
+        # parcels are the octants of MNI space around the origin, wells
+        # further than 20mm from it are outside of the atlas
+        labels = np.zeros((20, 20, 20), dtype=np.int16)
+        for octant, corner in enumerate(np.ndindex(2, 2, 2)):
+            labels[tuple(slice(10 * c, 10 * c + 10) for c in corner)] = octant + 1
+        atlas_file = self.save(labels, self.affine, "atlas.nii.gz")
+        index = get_well_index()
+        well_ids = index.well_ids[::7]
+        coordinates = index.coordinates[::7]
+        expected = np.zeros(len(well_ids), dtype=np.int64)
+        for i, coordinate in enumerate(coordinates):
+            ijk = np.round(nb.affines.apply_affine(np.linalg.inv(self.affine), coordinate))
+            if np.all((ijk >= 0) & (ijk < 20)):
+                expected[i] = labels[tuple(ijk.astype(int))]
+        self.assertTrue(len(np.unique(expected)) > 2)
+        np.testing.assert_array_equal(get_well_parcels(atlas_file, well_ids), expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
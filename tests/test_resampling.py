@@ -0,0 +1,84 @@
+import unittest
+
+import numpy as np
+from scipy.stats import pearsonr
+
+from alleninf.analysis import approximate_random_effects
+from alleninf.resampling import stability_analysis
+from alleninf.welltable import WellTable
+
+
+def _table(random_state, sizes=(30, 45, 25, 60)):
+    donor_names = np.repeat(["donor%d" % i for i in range(len(sizes))], sizes)
+    # shuffled, so the analysis has to group the wells by donor itself
+    donor_names = donor_names[random_state.permutation(len(donor_names))]
+    map_values = random_state.randn(len(donor_names))
+    expression_values = 0.3 * map_values + random_state.randn(len(donor_names))
+    return WellTable.from_wells(map_values, expression_values, donor_names)
+
+
+class StabilityAnalysisTest(unittest.TestCase):
+
+    def setUp(self):
+        self.table = _table(np.random.RandomState(0))
+
+    def test_leave_one_donor_out(self):
+        stability = stability_analysis(self.table, n_bootstrap=10)
+        self.assertEqual(stability.donors, ["donor0", "donor1", "donor2", "donor3"])
+        self.assertAlmostEqual(stability.slope,
+                               approximate_random_effects(self.table, plot=False)[0])
+        self.assertAlmostEqual(stability.correlation,
+                               pearsonr(self.table.map_values, self.table.expression_values)[0])
+        for code, donor in enumerate(stability.donors):
+            rest = self.table.select(self.table.donor_codes != code)
+            rest = WellTable.from_wells(rest.map_values, rest.expression_values, rest.donor_names)
+            self.assertAlmostEqual(stability.lodo_slopes[code],
+                                   approximate_random_effects(rest, plot=False)[0])
+            self.assertAlmostEqual(stability.lodo_correlations[code],
+                                   pearsonr(rest.map_values, rest.expression_values)[0])
+            self.assertAlmostEqual(stability.slope_influence[code],
+                                   stability.lodo_slopes[code] - stability.slope)
+
+    def test_large_offset(self):
+        random_state = np.random.RandomState(1)
+        table = _table(random_state)
+        table = WellTable.from_wells(1e5 + 0.01 * table.map_values,
+                                     table.map_values + 0.01 * random_state.randn(len(table)),
+                                     table.donor_names)
+        stability = stability_analysis(table, n_bootstrap=0)
+        self.assertAlmostEqual(stability.slope / approximate_random_effects(table, plot=False)[0],
+                               1, places=7)
+        self.assertAlmostEqual(stability.correlation,
+                               pearsonr(table.map_values, table.expression_values)[0], places=10)
+        for code in range(4):
+            rest = table.select(table.donor_codes != code)
+            self.assertAlmostEqual(stability.lodo_correlations[code],
+                                   pearsonr(rest.map_values, rest.expression_values)[0],
+                                   places=10)
+
+    def test_bootstrap_independent_of_n_jobs(self):
+        single = stability_analysis(self.table, n_bootstrap=250, random_seed=3, chunk_size=40)
+        parallel = stability_analysis(self.table, n_bootstrap=250, random_seed=3, chunk_size=40,
+                                      n_jobs=3)
+        self.assertEqual(len(single.bootstrap_slopes), 250)
+        for name in ["slope_ci", "correlation_ci", "donor_slopes_ci", "bootstrap_slopes"]:
+            np.testing.assert_array_equal(getattr(single, name), getattr(parallel, name))
+        self.assertTrue(single.slope_ci[0] < single.slope < single.slope_ci[1])
+        self.assertEqual(single.donor_slopes_ci.shape, (4, 2))
+        other = stability_analysis(self.table, n_bootstrap=250, random_seed=4, chunk_size=40)
+        self.assertFalse(np.array_equal(single.bootstrap_slopes, other.bootstrap_slopes))
+
+    def test_without_bootstrap(self):
+        stability = stability_analysis(self.table, n_bootstrap=0)
+        self.assertTrue(np.isnan(stability.slope_ci).all())
+        self.assertTrue(np.isnan(stability.correlation_ci).all())
+        self.assertEqual(stability.donor_slopes_ci.shape, (4, 2))
+        self.assertEqual(len(stability.lodo_slopes), 4)
+
+    def test_single_donor(self):
+        table = WellTable.from_wells([1., 2., 3.], [2., 1., 3.], ["all"] * 3)
+        self.assertRaisesRegexp(Exception, "at least two donors", stability_analysis, table)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,185 @@
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+import nibabel as nb
+
+from alleninf import api, scripts
+from alleninf.result_cache import ResultCache
+
+
+class ResultCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def put(self, cache, name, age):
+        key = cache.key(name=name)
+        cache.put(key, {"name": name, "padding": "x" * 100})
+        # modification times record the last use
+        os.utime(cache._path(key), (1e9 - age, 1e9 - age))
+        return key
+
+    def test_hits_and_misses(self):
+        cache = ResultCache(self.cache_dir)
+        key = cache.key(name="a")
+        self.assertEqual(cache.get(key), None)
+        cache.put(key, {"estimate": 0.5})
+        self.assertEqual(cache.get(key), {"estimate": 0.5})
+        self.assertEqual(cache.get(cache.key(name="b")), None)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_least_recently_used_are_evicted(self):
+        cache = ResultCache(self.cache_dir)
+        keys = [self.put(cache, name, age) for name, age in [("a", 30), ("b", 20), ("c", 10)]]
+        entry_size = os.path.getsize(cache._path(keys[0]))
+        cache.max_size = 3 * entry_size
+        # reading a marks it as the most recently used entry
+        self.assertNotEqual(cache.get(keys[0]), None)
+        d = cache.key(name="d")
+        cache.put(d, {"name": "d", "padding": "x" * 100})
+        self.assertEqual(sorted(os.listdir(self.cache_dir)),
+                         sorted(os.path.basename(cache._path(key)) for key in [keys[0], keys[2], d]))
+        cache.max_size = entry_size
+        cache.evict()
+        self.assertEqual(os.listdir(self.cache_dir), [os.path.basename(cache._path(d))])
+
+
+class CacheKeysTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.old_data_dir = os.environ.get("ALLENINF_DATA")
+        os.environ["ALLENINF_DATA"] = self.tmp_dir
+        self.cache = ResultCache(os.path.join(self.tmp_dir, "cache"))
+        self.stat_map = os.path.join(self.tmp_dir, "map.nii.gz")
+        self.mask = os.path.join(self.tmp_dir, "mask.nii.gz")
+        for path in [self.stat_map, self.mask]:
+            self.save_image(path, 1)
+        self.args = argparse.Namespace(
+            stat_map=self.stat_map, mask=None, atlas=None, reference=None, wells=None,
+            inference_method="approximate_random", n_samples=2000, n_burnin=500,
+            probes_reduction_method="average", radius=4, probe_exclusion_keyword=None,
+            n_bootstrap=0, seed=0)
+
+    def tearDown(self):
+        api._gene_matrix_cache.clear()
+        if self.old_data_dir is None:
+            del os.environ["ALLENINF_DATA"]
+        else:
+            os.environ["ALLENINF_DATA"] = self.old_data_dir
+        shutil.rmtree(self.tmp_dir)
+
+    def save_image(self, path, value):
+        nb.save(nb.Nifti1Image(np.zeros((3, 3, 3), dtype=np.float32) + value, np.eye(4)), path)
+
+    def key(self, **changes):
+        args = argparse.Namespace(**vars(self.args))
+        for name, value in changes.items():
+            setattr(args, name, value)
+        return scripts._cache_keys(self.cache, args, ["A", "B"])
+
+    def test_key_changes(self):
+        keys = self.key()
+        self.assertNotEqual(keys["A"], keys["B"])
+        self.assertEqual(self.key(), keys)
+        for changes in [{"mask": self.mask}, {"radius": 2}, {"n_bootstrap": 10},
+                        {"inference_method": "fixed"}, {"probe_exclusion_keyword": "CUST"}]:
+            self.assertNotEqual(self.key(**changes)["A"], keys["A"], changes)
+
+        # content of the map, not its name
+        self.save_image(self.stat_map, 2)
+        changed_map = self.key()
+        self.assertNotEqual(changed_map["A"], keys["A"])
+
+        # expression from a prebuilt matrix and a rebuilt one
+        matrix_dir = os.path.join(self.tmp_dir, "microarray_expression")
+        os.makedirs(matrix_dir)
+        keys = [changed_map["A"]]
+        for created in ["now", "later"]:
+            np.save(os.path.join(matrix_dir, "gene_expression_average.npy"), np.zeros((2, 1)))
+            with open(os.path.join(matrix_dir, "gene_expression_average.json"), "w") as f:
+                json.dump({"format_version": api.GENE_MATRIX_FORMAT_VERSION, "created": created,
+                           "source": {}, "method": "average", "genes": ["A", "B"],
+                           "well_ids": [1], "donor_names": ["d"]}, f)
+            api._gene_matrix_cache.clear()
+            keys.append(self.key()["A"])
+        self.assertEqual(len(set(keys)), 3)
+
+
+class MainCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.old_data_dir = os.environ.get("ALLENINF_DATA")
+        os.environ["ALLENINF_DATA"] = self.tmp_dir
+        self.old_argv = sys.argv
+        random_state = np.random.RandomState(0)
+        package_directory = os.path.dirname(os.path.abspath(api.__file__))
+        well_ids = [int(well_id) for well_id in pd.read_csv(os.path.join(
+            package_directory, "data", "corrected_mni_coordinates.csv"), index_col=0).index[:300]]
+        matrix_dir = os.path.join(self.tmp_dir, "microarray_expression")
+        os.makedirs(matrix_dir)
+        base = os.path.join(matrix_dir, "gene_expression_average")
+        np.save(base + ".npy", random_state.randn(2, len(well_ids)).astype(np.float32))
+        with open(base + ".json", "w") as f:
+            json.dump({"format_version": api.GENE_MATRIX_FORMAT_VERSION, "created": "now",
+                       "source": {}, "method": "average", "genes": ["A", "B"],
+                       "well_ids": well_ids, "donor_names": ["d%d" % (i % 3) for i in range(300)]}, f)
+        api._gene_matrix_cache.clear()
+        affine = np.diag([-2., 2., 2., 1.])
+        affine[:3, 3] = [90, -126, -72]
+        self.stat_map = os.path.join(self.tmp_dir, "map.nii.gz")
+        nb.save(nb.Nifti1Image(random_state.randn(91, 109, 91).astype(np.float32), affine),
+                self.stat_map)
+        self.output = os.path.join(self.tmp_dir, "results.json")
+
+    def tearDown(self):
+        api._gene_matrix_cache.clear()
+        sys.argv = self.old_argv
+        if self.old_data_dir is None:
+            del os.environ["ALLENINF_DATA"]
+        else:
+            os.environ["ALLENINF_DATA"] = self.old_data_dir
+        shutil.rmtree(self.tmp_dir)
+
+    def run_main(self, *options):
+        """Runs the analysis of two genes and returns how many were analysed
+        together with the written results."""
+        run_inference = scripts.run_inference
+        analysed = []
+
+        def counting_run_inference(*args, **kwargs):
+            analysed.append(args)
+            return run_inference(*args, **kwargs)
+        if os.path.exists(self.output):
+            os.remove(self.output)
+        sys.argv = ["alleninf", self.stat_map, "A", "B", "--output", self.output] + list(options)
+        scripts.run_inference = counting_run_inference
+        try:
+            scripts.main()
+        finally:
+            scripts.run_inference = run_inference
+        with open(self.output) as f:
+            return len(analysed), [json.loads(line) for line in f]
+
+    def test_second_run_is_cached(self):
+        n_analysed, results = self.run_main()
+        self.assertEqual(n_analysed, 2)
+        self.assertEqual(self.run_main(), (0, results))
+        self.assertEqual(self.run_main("--no_cache"), (2, results))
+        # a different radius is a different analysis
+        self.assertEqual(self.run_main("--radius", "2")[0], 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
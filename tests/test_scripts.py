@@ -0,0 +1,69 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+import numpy as np
+import nibabel as nb
+
+from alleninf import scripts
+
+
+class WriteResultTest(unittest.TestCase):
+
+    def test_nested_nan(self):
+        output = StringIO()
+        scripts._write_result(output, {
+            "gene": "A", "p": float("nan"), "r": np.float64(0.5),
+            "bootstrap": {"slope_ci": [np.nan, 1.0], "n": 10},
+            "leave_one_out": [{"donor": "d1", "r": np.float32(np.nan)}]})
+        result = json.loads(output.getvalue())
+        self.assertEqual(result, {
+            "gene": "A", "p": None, "r": 0.5,
+            "bootstrap": {"slope_ci": [None, 1.0], "n": 10},
+            "leave_one_out": [{"donor": "d1", "r": None}]})
+
+
+class MainOutputTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.old_data_dir = os.environ.get("ALLENINF_DATA")
+        os.environ["ALLENINF_DATA"] = self.data_dir
+        self.old_argv = sys.argv
+        self.stat_map = os.path.join(self.data_dir, "map.nii.gz")
+        nb.save(nb.Nifti1Image(np.ones((4, 4, 4), dtype=np.float32), np.eye(4)), self.stat_map)
+
+    def tearDown(self):
+        sys.argv = self.old_argv
+        if self.old_data_dir is None:
+            del os.environ["ALLENINF_DATA"]
+        else:
+            os.environ["ALLENINF_DATA"] = self.old_data_dir
+        shutil.rmtree(self.data_dir)
+
+    def test_stdout_restored_after_failure(self):
+        stdout = sys.stdout
+        # the well annotations are missing from the empty data directory
+        sys.argv = ["alleninf", self.stat_map, "A", "--output", "-", "--wells", "Cx"]
+        self.assertRaises(IOError, scripts.main)
+        self.assertTrue(sys.stdout is stdout)
+        self.assertFalse(sys.stdout.closed)
+
+    def test_bootstrap_of_pooled_parcels_rejected(self):
+        sys.argv = ["alleninf", self.stat_map, "A", "--atlas", self.stat_map,
+                    "--inference_method", "fixed", "--n_bootstrap", "10"]
+        stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            self.assertRaises(SystemExit, scripts.main)
+            self.assertTrue("--n_bootstrap can not be used" in sys.stderr.getvalue())
+        finally:
+            sys.stderr = stderr
+
+
+if __name__ == "__main__":
+    unittest.main()
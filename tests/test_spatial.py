@@ -0,0 +1,73 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from alleninf import api
+from alleninf.spatial import get_well_index, get_expression_near
+from alleninf.utils import add_donor_partition
+
+
+class ExpressionNearTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.old_data_dir = os.environ.get("ALLENINF_DATA")
+        os.environ["ALLENINF_DATA"] = self.data_dir
+        index = get_well_index()
+        random_state = np.random.RandomState(0)
+        self.probe_ids = [7, 5, 9]
+        self.expression = pd.DataFrame(random_state.randn(len(index.well_ids), 3),
+                                       index=index.well_ids, columns=self.probe_ids)
+        # six donors holding slabs of wells from left to right
+        slabs = np.array_split(np.argsort(index.coordinates[:, 0]), 6)
+        for donor, wells in enumerate(slabs):
+            frame = self.expression.iloc[np.sort(wells)].T
+            frame.index.name = "probe_id"
+            frame.columns = ["well_id_%d" % well_id for well_id in frame.columns]
+            add_donor_partition(api.get_store_dir(), "donor%d" % donor, frame)
+
+    def tearDown(self):
+        if self.old_data_dir is None:
+            del os.environ["ALLENINF_DATA"]
+        else:
+            os.environ["ALLENINF_DATA"] = self.old_data_dir
+        shutil.rmtree(self.data_dir)
+
+    def test_nearest_wells(self):
+        points = [[-40, -20, 10], [30, 10, 40]]
+        read = []
+        read_partition = api.read_partition
+
+        def counting_read_partition(partition, *args, **kwargs):
+            read.append(partition)
+            return read_partition(partition, *args, **kwargs)
+        api.read_partition = counting_read_partition
+        try:
+            near = get_expression_near(points, [9, 7], k=4)
+        finally:
+            api.read_partition = read_partition
+        # only the partitions holding the neighbouring wells are read
+        self.assertTrue(0 < len(read) < 6)
+        self.assertEqual(near.expression.shape, (2, 4, 2))
+        for point_wells, point_expression in zip(near.well_ids, near.expression):
+            np.testing.assert_allclose(point_expression,
+                                       self.expression.loc[point_wells, [9, 7]].values,
+                                       rtol=1e-6)
+
+    def test_radius(self):
+        points = [[-40, -20, 10], [500, 500, 500]]
+        near = get_expression_near(points, self.probe_ids, radius=10)
+        self.assertTrue(len(near.well_ids[0]) > 0)
+        self.assertEqual(near.expression[1].shape, (0, 3))
+        np.testing.assert_allclose(near.expression[0],
+                                   self.expression.loc[near.well_ids[0]].values, rtol=1e-6)
+        near = get_expression_near(points[1:], self.probe_ids, radius=10)
+        self.assertEqual(near.expression[0].shape, (0, 3))
+
+
+if __name__ == "__main__":
+    unittest.main()
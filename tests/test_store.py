@@ -0,0 +1,151 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from alleninf import api
+from alleninf.api import dequantize, read_partition, iter_partition
+from alleninf.utils import quantize, add_donor_partition, build_gene_expression_matrices
+
+
+class QuantizeTest(unittest.TestCase):
+
+    def setUp(self):
+        random_state = np.random.RandomState(0)
+        self.values = random_state.randn(50, 40) * random_state.uniform(0.1, 3, (50, 1)) + \
+            random_state.uniform(2, 12, (50, 1))
+        self.values[random_state.rand(50, 40) < 0.05] = np.nan
+        # constant and all missing probes
+        self.values[3] = 5
+        self.values[4] = np.nan
+
+    def test_round_trip(self):
+        span = np.nan_to_num(np.nanmax(self.values, axis=1) - np.nanmin(self.values, axis=1))
+        for dtype in ["float32", "float16", "int16", "int8"]:
+            codes, offsets, scales = quantize(self.values, dtype)
+            self.assertEqual(codes.dtype, np.dtype(dtype))
+            restored = dequantize(codes, offsets, scales, dtype)
+            self.assertEqual(restored.dtype, np.float32)
+            np.testing.assert_array_equal(np.isnan(restored), np.isnan(self.values))
+            errors = np.nan_to_num(np.abs(restored - self.values))
+            if dtype == "float32":
+                tolerance = np.abs(np.nan_to_num(self.values)) * 1e-7
+            elif dtype == "float16":
+                tolerance = np.abs(np.nan_to_num(self.values)) * 2 ** -11
+            else:
+                # half a quantization step (plus float32 rounding)
+                step = span / (np.iinfo(dtype).max - np.iinfo(dtype).min - 1)
+                tolerance = (step / 2 + 1e-5 * np.nanmax(np.abs(self.values)))[:, np.newaxis]
+            self.assertTrue((errors <= tolerance + 1e-12).all(), dtype)
+
+
+class ReadPartitionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store_dir = tempfile.mkdtemp()
+        random_state = np.random.RandomState(1)
+        values = (random_state.randn(30, 12) + 6).astype(np.float32)
+        values[random_state.rand(30, 12) < 0.05] = np.nan
+        self.expression = pd.DataFrame(values, index=pd.Index(np.arange(30) * 3 + 1000, name="probe_id"),
+                                       columns=["well_id_%d" % i for i in range(12)])
+
+    def tearDown(self):
+        shutil.rmtree(self.store_dir)
+
+    def test_chunks_match_whole_read(self):
+        where = "index in ['1003','1042','1087','5']"
+        columns = ["well_id_7", "well_id_2"]
+        for dtype in ["float32", "float16", "int16", "int8"]:
+            add_donor_partition(self.store_dir, dtype, self.expression, dtype=dtype)
+            partition = os.path.join(self.store_dir, "%s.h5" % dtype)
+            whole = read_partition(partition, dtype, chunksize=1000)
+            self.assertEqual(whole.index.name, "probe_id")
+            self.assertEqual(list(whole.columns), list(self.expression.columns))
+            np.testing.assert_array_equal(whole.index, self.expression.index)
+            if dtype == "float32":
+                np.testing.assert_array_equal(whole.values, self.expression.values)
+            for chunksize in [1, 7]:
+                pd.util.testing.assert_frame_equal(read_partition(partition, dtype, chunksize=chunksize),
+                                                   whole)
+                selected = read_partition(partition, dtype, where=where, columns=columns,
+                                          chunksize=chunksize)
+                pd.util.testing.assert_frame_equal(selected, whole.loc[[1003, 1042, 1087], columns])
+            self.assertEqual(read_partition(partition, dtype, where="index in ['5']").shape, (0, 12))
+
+    def test_iterator_streams_whole_read(self):
+        where = "index in ['1003','1042','1087','5']"
+        columns = ["well_id_7", "well_id_2"]
+        for dtype in ["float32", "float16", "int16", "int8"]:
+            add_donor_partition(self.store_dir, dtype, self.expression, dtype=dtype)
+            partition = os.path.join(self.store_dir, "%s.h5" % dtype)
+            whole = read_partition(partition, dtype)
+            chunks = list(iter_partition(partition, dtype, chunksize=7))
+            self.assertEqual([len(chunk) for chunk in chunks], [7, 7, 7, 7, 2])
+            for chunk in chunks:
+                self.assertEqual(chunk.values.dtype, np.float32)
+                self.assertEqual(chunk.index.name, "probe_id")
+            pd.util.testing.assert_frame_equal(pd.concat(chunks), whole)
+            selected = list(iter_partition(partition, dtype, where=where, columns=columns,
+                                           chunksize=2))
+            self.assertEqual([len(chunk) for chunk in selected], [2, 1])
+            pd.util.testing.assert_frame_equal(pd.concat(selected),
+                                               whole.loc[[1003, 1042, 1087], columns])
+            self.assertEqual(list(iter_partition(partition, dtype, where="index in ['5']")), [])
+
+
+class GeneMatrixStoreVersionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.old_data_dir = os.environ.get("ALLENINF_DATA")
+        os.environ["ALLENINF_DATA"] = self.data_dir
+        random_state = np.random.RandomState(2)
+        self.probe_ids = pd.Index([11, 12, 13], name="probe_id")
+        for donor, wells in [("donor1", range(5)), ("donor2", range(5, 9))]:
+            self.add_donor(donor, wells, random_state)
+        self.probes_file = os.path.join(self.data_dir, "probes.csv")
+        pd.DataFrame({"gene_symbol": ["A", "A", "B"]}, index=self.probe_ids).to_csv(
+            self.probes_file)
+        build_gene_expression_matrices(self.probes_file, methods=["average"])
+        api._gene_matrix_cache.clear()
+
+    def tearDown(self):
+        api._gene_matrix_cache.clear()
+        if self.old_data_dir is None:
+            del os.environ["ALLENINF_DATA"]
+        else:
+            os.environ["ALLENINF_DATA"] = self.old_data_dir
+        shutil.rmtree(self.data_dir)
+
+    def add_donor(self, donor, wells, random_state):
+        add_donor_partition(api.get_store_dir(), donor, pd.DataFrame(
+            random_state.randn(len(self.probe_ids), len(wells)), index=self.probe_ids,
+            columns=["well_id_%d" % well for well in wells]))
+
+    def test_matrix_of_current_store_loads(self):
+        matrix = api.load_gene_expression_matrix("average")
+        self.assertEqual(matrix.genes, ["A", "B"])
+        self.assertEqual(matrix.well_ids, list(range(9)))
+
+    def test_matrix_of_older_store_is_refused(self):
+        self.add_donor("donor2", range(5, 9), np.random.RandomState(3))
+        self.assertRaisesRegexp(IOError, "another version of the expression store",
+                                api.load_gene_expression_matrix, "average")
+
+    def test_donor_iterator_streams_donors(self):
+        whole = dict(api.read_donor_expression())
+        chunks = list(api.iter_donor_expression(chunksize=2))
+        self.assertEqual([(donor, len(chunk)) for donor, chunk in chunks],
+                         [("donor1", 2), ("donor1", 1), ("donor2", 2), ("donor2", 1)])
+        for donor in ["donor1", "donor2"]:
+            pd.util.testing.assert_frame_equal(
+                pd.concat([chunk for name, chunk in chunks if name == donor]), whole[donor])
+        self.assertEqual([donor for donor, _ in api.iter_donor_expression(donors=["donor2"])],
+                         ["donor2"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,51 @@
+import unittest
+
+import numpy as np
+
+from alleninf.welltable import WellTable
+
+
+class WellTableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.map_values = np.array([1., np.nan, 3., 4., 5.])
+        self.expression_values = np.array([10., 20., np.nan, 40., 50.])
+        self.donor_names = np.array(["b", "a", "b", "c", "a"])
+        self.well_ids = np.array([101, 102, 103, 104, 105])
+        self.coordinates = np.arange(15.).reshape(5, 3)
+        self.table = WellTable.from_wells(self.map_values, self.expression_values,
+                                          self.donor_names, well_ids=self.well_ids,
+                                          coordinates=self.coordinates)
+
+    def check_rows(self, table, rows):
+        np.testing.assert_array_equal(table.map_values, self.map_values[rows])
+        np.testing.assert_array_equal(table.expression_values, self.expression_values[rows])
+        np.testing.assert_array_equal(table.donor_names, self.donor_names[rows])
+        np.testing.assert_array_equal(table.well_ids, self.well_ids[rows])
+        np.testing.assert_array_equal(table.coordinates, self.coordinates[rows])
+
+    def test_from_wells(self):
+        self.assertEqual(list(self.table.donors), ["a", "b", "c"])
+        self.assertEqual(list(self.table.donor_codes), [1, 0, 1, 2, 0])
+        self.assertEqual(len(self.table), 5)
+        self.check_rows(self.table, np.arange(5))
+
+    def test_select_and_dropna(self):
+        self.check_rows(self.table.select(self.table.well_ids > 102), [2, 3, 4])
+        self.check_rows(self.table.select([4, 0]), [4, 0])
+        clean = self.table.dropna()
+        self.check_rows(clean, [0, 3, 4])
+        # donors keep their codes even when one loses all its wells
+        self.assertEqual(clean.n_donors, 3)
+        self.assertTrue(clean.dropna() is clean)
+        frame = clean.to_dataframe()
+        self.assertEqual(list(frame["donor ID"]), ["b", "c", "a"])
+
+    def test_misaligned_columns(self):
+        self.assertRaisesRegexp(Exception, "well_ids has 4 rows instead of 5",
+                                WellTable.from_wells, self.map_values, self.expression_values,
+                                self.donor_names, well_ids=self.well_ids[:4])
+
+
+if __name__ == "__main__":
+    unittest.main()